@@ -1,11 +1,31 @@
+import contextlib
+import contextvars
+import email.utils
+import json
+import random
+import threading
+import time
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from collections import deque
+from collections.abc import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from dataclasses import asdict, dataclass, replace
 from enum import Enum
+from typing import TYPE_CHECKING, Any, TypeVar
 
-from anthropic import Anthropic
+from ClientPool import client_pool
+from ContextWindow import estimate_tokens
+from commands import CommandDetector, ToolCall, ToolSpec
 from History import History
-from openai import OpenAI
-from together import Together
+from Logger import logger
+from RateLimiter import RateLimiter, get_rate_limiter, rate_limit_scope
+from ResponseCache import CacheMissError, CacheMode, ResponseCache
+
+# Provider SDKs and httpx are slow to import, so they are only imported once a model of that provider is built.
+if TYPE_CHECKING:
+    import httpx
+    from anthropic import Anthropic
+    from openai import OpenAI
 
 
 class ModelName(str, Enum):
@@ -44,8 +64,109 @@ class ModelArguments:
     together_api_key: str | None = None  # The Together.ai API key.
     fireworks_api_key: str | None = None  # The Fireworks API key.
     anthropic_api_key: str | None = None  # The Anthropic API key.
+    api_base_url: str | None = None  # Overrides the provider's API endpoint, e.g. to use a local mock server.
     api_timeout: int = 60  # The timeout for API requests.
-    api_max_retries: int = 1  # The maximum number of retries for API requests.
+    api_max_retries: int = 3  # The maximum number of retries for failed API requests.
+    api_retry_base_delay: float = 1.0  # The first retry waits up to this many seconds, doubling on each retry.
+    api_retry_max_delay: float = 60.0  # The longest wait before a retry, including waits asked for by Retry-After.
+    api_hedge_percentile: float | None = None  # Send a duplicate query once one is slower than this percentile.
+    api_fallback_model: ModelName | None = None  # The model to fail over to once retries are exhausted.
+    api_max_connections: int = 20  # The maximum number of open connections per client.
+    api_max_keepalive_connections: int = 10  # The maximum number of idle connections kept alive per client.
+    api_keepalive_expiry: float = 30.0  # Seconds an idle connection is kept alive for.
+    api_rate_limit_dir: str | None = None  # Shares client-side rate limits between all agents using this directory.
+    api_requests_per_minute: float | None = None  # The request limit. Learned from response headers if not set.
+    api_tokens_per_minute: float | None = None  # The token limit. Learned from response headers if not set.
+    prompt_caching: bool = True  # Whether to mark the stable prompt prefix as cacheable (Anthropic).
+    cache_mode: CacheMode = CacheMode.off  # Whether to record or replay responses from a local cache.
+    cache_path: str = "responses.sqlite"  # The SQLite file responses are cached in.
+
+
+@dataclass
+class Usage:
+    prompt_tokens: int = 0  # Input tokens, including those read from or written to the prompt cache.
+    completion_tokens: int = 0  # Output tokens.
+    cached_tokens: int = 0  # Input tokens read from the provider's prompt cache.
+    cache_write_tokens: int = 0  # Input tokens written to the provider's prompt cache.
+    # Tokens of the above that were estimated, because the response was cut off before the provider reported them.
+    estimated_tokens: int = 0
+
+    @property
+    def uncached_tokens(self) -> int:
+        return self.prompt_tokens - self.cached_tokens
+
+    @property
+    def cache_hit_rate(self) -> float:
+        return self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+
+    def __iadd__(self, other: "Usage") -> "Usage":
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+        self.cached_tokens += other.cached_tokens
+        self.cache_write_tokens += other.cache_write_tokens
+        self.estimated_tokens += other.estimated_tokens
+        return self
+
+    def __sub__(self, other: "Usage") -> "Usage":
+        return Usage(
+            prompt_tokens=self.prompt_tokens - other.prompt_tokens,
+            completion_tokens=self.completion_tokens - other.completion_tokens,
+            cached_tokens=self.cached_tokens - other.cached_tokens,
+            cache_write_tokens=self.cache_write_tokens - other.cache_write_tokens,
+            estimated_tokens=self.estimated_tokens - other.estimated_tokens,
+        )
+
+    def __str__(self):
+        return (
+            f"prompt={self.prompt_tokens} (cached={self.cached_tokens}, uncached={self.uncached_tokens}, "
+            f"cache_write={self.cache_write_tokens}, hit_rate={self.cache_hit_rate:.1%}) "
+            f"completion={self.completion_tokens}"
+            + (f" estimated={self.estimated_tokens}" if self.estimated_tokens else "")
+        )
+
+    @classmethod
+    def estimate(cls, prompt_tokens: int, completion: str) -> "Usage":
+        completion_tokens = estimate_tokens(completion)
+        return cls(prompt_tokens, completion_tokens, estimated_tokens=prompt_tokens + completion_tokens)
+
+    @classmethod
+    def from_openai(cls, usage: Any) -> "Usage":
+        if usage is None:
+            return cls()
+        details = getattr(usage, "prompt_tokens_details", None)
+        return cls(
+            prompt_tokens=usage.prompt_tokens or 0,
+            completion_tokens=usage.completion_tokens or 0,
+            cached_tokens=(getattr(details, "cached_tokens", None) or 0) if details else 0,
+        )
+
+    @classmethod
+    def from_anthropic(cls, usage: Any) -> "Usage":
+        if usage is None:
+            return cls()
+        cached_tokens = getattr(usage, "cache_read_input_tokens", None) or 0
+        cache_write_tokens = getattr(usage, "cache_creation_input_tokens", None) or 0
+        return cls(
+            prompt_tokens=(getattr(usage, "input_tokens", None) or 0) + cached_tokens + cache_write_tokens,
+            completion_tokens=getattr(usage, "output_tokens", None) or 0,
+            cached_tokens=cached_tokens,
+            cache_write_tokens=cache_write_tokens,
+        )
+
+
+# The usage reported for the request made by the current thread or task. Unlike last_usage, it is not
+# overwritten by concurrent requests to the same model, such as a hedged duplicate.
+request_usage: contextvars.ContextVar[Usage | None] = contextvars.ContextVar("request_usage", default=None)
+
+
+def http_limits(args: ModelArguments) -> "httpx.Limits":
+    import httpx
+
+    return httpx.Limits(
+        max_connections=args.api_max_connections,
+        max_keepalive_connections=args.api_max_keepalive_connections,
+        keepalive_expiry=args.api_keepalive_expiry,
+    )
 
 
 class APIModel(ABC):
@@ -55,114 +176,836 @@ class APIModel(ABC):
         self.temperature = args.temperature
         self.top_p = args.top_p
         self.max_tokens = args.max_tokens
+        self.client = client_pool.get(self.client_key(args), lambda: self.get_client(args))
+        self.usage = Usage()
+        # Shared with the fallback like usage, so that tokens are priced at the rate of the model that served them.
+        self.usage_by_model: dict[ModelName, Usage] = {}
+        self.last_usage = Usage()
+        self.last_stop_reason: str | None = None
+        self.tools: list[ToolSpec] = []
+        self.parallel_tool_calls = True
+
+    def set_tools(self, tools: list[ToolSpec], parallel: bool = True):
+        """Offers the tools to the model as native tools. Without any, commands are called with XML alone.
+
+        Unless parallel, the model is asked for at most one tool call per response.
+        """
+        self.tools = tools
+        self.parallel_tool_calls = parallel
+
+    def record_usage(self, usage: Usage, stop_reason: str | None = None):
+        self.last_usage = usage
+        request_usage.set(usage)
+        self.last_stop_reason = stop_reason
+        self.usage += usage
+        model_usage = self.usage_by_model.setdefault(self.model, Usage())
+        model_usage += usage
+        logger.info(f"====USAGE====\n{usage}\n\n\n")
+
+    def client_key(self, args: ModelArguments) -> tuple:
+        # Clients are shared between every model of the same provider that uses the same credentials and connection
+        # settings. Their response hooks feed the rate limiter, so the limiter's directory is part of the key too.
+        return (
+            type(self).__name__,
+            args.openai_api_key,
+            args.together_api_key,
+            args.fireworks_api_key,
+            args.anthropic_api_key,
+            args.api_base_url,
+            args.api_timeout,
+            args.api_max_retries,
+            args.api_max_connections,
+            args.api_max_keepalive_connections,
+            args.api_keepalive_expiry,
+            args.api_rate_limit_dir,
+        )
+
+    @staticmethod
+    def http_client(args: ModelArguments) -> "httpx.Client":
+        import httpx
+
+        return httpx.Client(timeout=args.api_timeout, limits=http_limits(args), event_hooks=rate_limit_hooks(args))
 
     @abstractmethod
     def query(self, history: History) -> str:
         pass
 
     @abstractmethod
-    def get_client(self, args: ModelArguments) -> OpenAI | Together | Anthropic:
+    def stream(self, history: History) -> Iterator[str]:
+        """Yields the response text as it is generated. Closing the iterator cancels the request."""
+        pass
+
+    def query_stream(self, history: History, detector: CommandDetector) -> str:
+        """Streams the response and stops as soon as the detector sees a complete command."""
+        chunks = self.stream(history)
+        calls = StreamedToolCalls()
+        cut_off = False
+        try:
+            for chunk in chunks:
+                if not calls.add(chunk) and (cut_off := detector.feed(chunk)):
+                    break
+        finally:
+            chunks.close()
+        if cut_off:
+            self.last_stop_reason = "command_detected"
+        return calls.response(detector.response())
+
+    @abstractmethod
+    def get_client(self, args: ModelArguments) -> "OpenAI | Anthropic":
+        pass
+
+    def close(self):
+        """Releases what the model holds on to for itself. Its client is pooled and outlives it."""
         pass
 
 
+class ModelWrapper(APIModel):
+    """Adds behaviour around another model's queries. Anything not overridden is delegated to it."""
+
+    def __init__(self, inner: APIModel):
+        self.inner = inner
+
+    def __getattr__(self, name: str) -> Any:
+        if name == "inner":
+            raise AttributeError(name)
+        return getattr(self.inner, name)
+
+    def query(self, history: History) -> str:
+        return self.inner.query(history)
+
+    def stream(self, history: History) -> Iterator[str]:
+        return self.inner.stream(history)
+
+    def query_stream(self, history: History, detector: CommandDetector) -> str:
+        return self.inner.query_stream(history, detector)
+
+    def get_client(self, args: ModelArguments) -> "OpenAI | Anthropic":
+        return self.inner.get_client(args)
+
+    def set_tools(self, tools: list[ToolSpec], parallel: bool = True):
+        self.inner.set_tools(tools, parallel)
+
+    def close(self):
+        self.inner.close()
+
+    # Set by wrappers as well as by the model, so it is stored on the model that the metrics read it from.
+    @property
+    def last_stop_reason(self) -> str | None:
+        return self.inner.last_stop_reason
+
+    @last_stop_reason.setter
+    def last_stop_reason(self, value: str | None):
+        self.inner.last_stop_reason = value
+
+
+def rate_limiter(args: ModelArguments) -> RateLimiter | None:
+    if args.api_rate_limit_dir is None:
+        return None
+    return get_rate_limiter(args.api_rate_limit_dir, args.api_requests_per_minute, args.api_tokens_per_minute)
+
+
+def model_scope(args: ModelArguments, model: str) -> str:
+    credentials = (args.openai_api_key, args.together_api_key, args.fireworks_api_key, args.anthropic_api_key)
+    return rate_limit_scope(model, *credentials, args.api_base_url)
+
+
+def rate_limit_hooks(args: ModelArguments, asynchronous: bool = False) -> dict[str, list[Callable]]:
+    """httpx event hooks that teach the shared rate limiter the limits in each response's headers."""
+    limiter = rate_limiter(args)
+    if limiter is None:
+        return {}
+
+    def observe(response: "httpx.Response"):
+        # One client serves every model of a provider, so the model is read from the request.
+        with contextlib.suppress(ValueError, AttributeError, TypeError):
+            model = json.loads(response.request.content)["model"]
+            limiter.observe(model_scope(args, model), response.headers)
+
+    async def observe_async(response: "httpx.Response"):
+        observe(response)
+
+    return {"response": [observe_async if asynchronous else observe]}
+
+
+def estimate_prompt_tokens(history: History) -> int:
+    return sum(estimate_tokens(message["content"]) for message in history)
+
+
+def estimate_request_tokens(history: History, max_tokens: int) -> int:
+    # Providers count the prompt and the most that may be generated against the token limit up front.
+    return estimate_prompt_tokens(history) + max_tokens
+
+
+class RateLimitedModel(ModelWrapper):
+    """Waits for a slot under the shared rate limits before each query, and corrects its token count after.
+
+    It wraps the provider's model directly, so that every retry and hedged duplicate takes its own slot.
+    """
+
+    def __init__(self, inner: APIModel, limiter: RateLimiter, args: ModelArguments):
+        super().__init__(inner)
+        self.limiter = limiter
+        self.scope = model_scope(args, inner.model.value)
+
+    def _limited(self, history: History, call: Callable[[], str]) -> str:
+        estimated = estimate_request_tokens(history, self.inner.max_tokens)
+        self.limiter.acquire(self.scope, estimated)
+        request_usage.set(None)
+        try:
+            response = call()
+        except Exception as error:
+            if getattr(error, "status_code", None) == 429 and (delay := retry_after(error)) is not None:
+                self.limiter.block(self.scope, delay)
+            raise
+        # Without reported usage the estimate stands.
+        if (usage := request_usage.get()) is not None:
+            self.limiter.settle(self.scope, estimated, usage.prompt_tokens + usage.completion_tokens)
+        return response
+
+    def query(self, history: History) -> str:
+        return self._limited(history, lambda: self.inner.query(history))
+
+    def query_stream(self, history: History, detector: CommandDetector) -> str:
+        return self._limited(history, lambda: self.inner.query_stream(history, detector))
+
+
+def rate_limited(model: APIModel, args: ModelArguments) -> APIModel:
+    limiter = rate_limiter(args)
+    return model if limiter is None else RateLimitedModel(model, limiter, args)
+
+
+class CachedModel(ModelWrapper):
+    """Records responses to a ResponseCache and replays them, so runs can be repeated offline."""
+
+    def __init__(self, inner: APIModel, cache: ResponseCache, mode: CacheMode):
+        super().__init__(inner)
+        self.cache = cache
+        self.mode = mode
+
+    def _request(self, history: History, kind: str) -> dict[str, Any]:
+        return {
+            "kind": kind,
+            "model": self.inner.model,
+            "temperature": self.inner.temperature,
+            "top_p": self.inner.top_p,
+            "max_tokens": self.inner.max_tokens,
+            "messages": list(history),
+            # Only part of the key when tools are offered, so that existing cache entries stay valid.
+            **({"tools": [asdict(tool) for tool in self.inner.tools]} if self.inner.tools else {}),
+            **({"parallel_tool_calls": False} if self.inner.tools and not self.inner.parallel_tool_calls else {}),
+        }
+
+    def _lookup(self, request: dict[str, Any]) -> tuple[str, str | None]:
+        """Returns the request's key and its cached response, unless the provider has to be queried."""
+        key = ResponseCache.make_key(request)
+        if self.mode == CacheMode.record:
+            return key, None
+        entry = self.cache.get(key)
+        if entry is None:
+            if self.mode == CacheMode.replay:
+                raise CacheMissError(f"No cached response for request {key}.")
+            return key, None
+        self.last_stop_reason = "cached"
+        text, tool_calls = entry
+        return key, ModelResponse(text, [ToolCall(**call) for call in tool_calls]) if tool_calls else text
+
+    def _put(self, key: str, request: dict[str, Any], response: str):
+        tool_calls = [asdict(call) for call in getattr(response, "tool_calls", ())]
+        self.cache.put(key, request, response, tool_calls)
+
+    def query(self, history: History) -> str:
+        request = self._request(history, "query")
+        key, response = self._lookup(request)
+        if response is None:
+            response = self.inner.query(history)
+            self._put(key, request, response)
+        return response
+
+    def query_stream(self, history: History, detector: CommandDetector) -> str:
+        # Streamed responses are cut off after the first command, so they are cached separately.
+        request = self._request(history, "stream")
+        key, response = self._lookup(request)
+        if response is None:
+            response = self.inner.query_stream(history, detector)
+            self._put(key, request, response)
+        else:
+            # Only a replayed response has not been through the detector yet.
+            detector.feed(response)
+        return response
+
+    def close(self):
+        self.cache.close()
+        super().close()
+
+
+# Matched by class name, including base classes, so that no provider SDK has to be imported to classify errors.
+RETRYABLE_ERROR_NAMES = {"APIConnectionError", "APITimeoutError", "ConnectionError", "TimeoutError"}
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+
+ResultType = TypeVar("ResultType")
+
+
+def is_retryable(error: Exception) -> bool:
+    status_code = getattr(error, "status_code", None)
+    if isinstance(status_code, int):
+        return status_code in RETRYABLE_STATUS_CODES or status_code >= 500
+    return any(cls.__name__ in RETRYABLE_ERROR_NAMES for cls in type(error).__mro__)
+
+
+def retry_after(error: Exception) -> float | None:
+    """Returns the seconds the server asked to wait before retrying, if it said."""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if headers is None:
+        return None
+    if (milliseconds := headers.get("retry-after-ms")) is not None:
+        with contextlib.suppress(ValueError):
+            return float(milliseconds) / 1e3
+    if (value := headers.get("retry-after")) is None:
+        return None
+    with contextlib.suppress(ValueError):
+        return float(value)
+    # Retry-After may also be an HTTP date.
+    with contextlib.suppress(TypeError, ValueError):
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    return None
+
+
+def retry_delay(args: ModelArguments, attempt: int, error: Exception) -> float:
+    """Full-jitter exponential backoff, unless the server said how long to wait."""
+    delay = retry_after(error)
+    if delay is None:
+        delay = random.uniform(0, args.api_retry_base_delay * 2**attempt)
+    return min(delay, args.api_retry_max_delay)
+
+
+class LatencyTracker:
+    """Keeps recent query latencies to tell when a query has become slow enough to hedge."""
+
+    def __init__(self, percentile: float, window: int = 100, min_samples: int = 10):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.latencies: deque[float] = deque(maxlen=window)
+
+    def record(self, seconds: float):
+        self.latencies.append(seconds)
+
+    def threshold(self) -> float | None:
+        if len(self.latencies) < self.min_samples:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(self.percentile * len(latencies)))]
+
+
+class ResilientModel(ModelWrapper):
+    """Retries failed queries with backoff, hedges slow ones and fails over to a fallback model.
+
+    The provider SDKs' own retries are turned off by get_model, so that this is the only layer retrying.
+    Hedging sends a duplicate query once the first is slower than the configured percentile of recent
+    queries and returns whichever answers first; the slower one still runs to completion and is paid for.
+    """
+
+    def __init__(self, inner: APIModel, args: ModelArguments):
+        super().__init__(inner)
+        self.args = args
+        self.latencies = LatencyTracker(args.api_hedge_percentile) if args.api_hedge_percentile else None
+        self.hedge_executor: ThreadPoolExecutor | None = None
+        self.fallback: APIModel | None = None
+        self.fallback_lock = threading.Lock()
+
+    def _get_fallback(self) -> APIModel | None:
+        if self.args.api_fallback_model is None:
+            return None
+        with self.fallback_lock:
+            if self.fallback is None:
+                fallback_args = replace(self.args, model=self.args.api_fallback_model, api_max_retries=0)
+                fallback = model_registry[fallback_args.model](fallback_args)
+                fallback.set_tools(self.inner.tools, self.inner.parallel_tool_calls)
+                # The fallback's tokens count towards the run's usage like the primary's.
+                fallback.usage = self.inner.usage
+                fallback.usage_by_model = self.inner.usage_by_model
+                self.fallback = rate_limited(fallback, fallback_args)
+        return self.fallback
+
+    def _retrying(self, call: Callable[[], ResultType], can_retry: Callable[[], bool] = lambda: True) -> ResultType:
+        for attempt in range(self.args.api_max_retries + 1):
+            try:
+                return call()
+            except Exception as error:
+                if attempt == self.args.api_max_retries or not is_retryable(error) or not can_retry():
+                    raise
+                delay = retry_delay(self.args, attempt, error)
+                logger.warning(f"API request failed ({error!r}); retrying in {delay:.1f}s.")
+                time.sleep(delay)
+
+    def _hedged(self, call: Callable[[], ResultType]) -> ResultType:
+        if self.latencies is None:
+            return call()
+
+        start = time.perf_counter()
+        threshold = self.latencies.threshold()
+        if threshold is None:
+            result = call()
+            self.latencies.record(time.perf_counter() - start)
+            return result
+
+        if self.hedge_executor is None:
+            self.hedge_executor = ThreadPoolExecutor(thread_name_prefix="hedge")
+        futures = [self.hedge_executor.submit(call)]
+        done, _ = wait(futures, timeout=threshold)
+        if not done:
+            logger.warning(f"Query slower than {threshold:.1f}s; sending a hedged duplicate.")
+            futures.append(self.hedge_executor.submit(call))
+
+        error = None
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                error = e
+                continue
+            self.latencies.record(time.perf_counter() - start)
+            return result
+        raise error
+
+    def _failing_over(
+        self, call: Callable[[APIModel], ResultType], can_fail_over: Callable[[], bool] = lambda: True
+    ) -> ResultType:
+        try:
+            return call(self.inner)
+        except Exception as error:
+            fallback = self._get_fallback()
+            if fallback is None or not can_fail_over():
+                raise
+            logger.warning(f"{self.inner.model.value} failed ({error!r}); failing over to {fallback.model.value}.")
+            result = call(fallback)
+            self.inner.last_stop_reason = fallback.last_stop_reason
+            return result
+
+    def query(self, history: History) -> str:
+        return self._failing_over(lambda model: self._retrying(lambda: self._hedged(lambda: model.query(history))))
+
+    def query_stream(self, history: History, detector: CommandDetector) -> str:
+        # Only a stream that failed before producing any text can be retried, as the detector has already seen it.
+        def unstarted() -> bool:
+            return not detector.text()
+
+        return self._failing_over(
+            lambda model: self._retrying(lambda: model.query_stream(history, detector), unstarted), unstarted
+        )
+
+    def close(self):
+        # A hedged duplicate that lost the race may still be running; it is not waited for.
+        if self.hedge_executor is not None:
+            self.hedge_executor.shutdown(wait=False, cancel_futures=True)
+            self.hedge_executor = None
+        if self.fallback is not None:
+            self.fallback.close()
+        super().close()
+
+
+def chat_completion_chunks(
+    response,
+    on_usage: Callable[[Usage, str | None], None],
+    tools: list[ToolSpec] | None = None,
+    prompt_tokens: int = 0,
+) -> Iterator[str]:
+    """Yields the text deltas of a streamed chat completion, closing the connection when stopped early.
+
+    Tool calls arrive in fragments, so each is yielded as a ModelResponse once the stream ends. Usage only arrives
+    with the last chunk, so a stream stopped before it records an estimate from prompt_tokens and the text so far.
+    """
+    stop_reason = None
+    text: list[str] = []
+    calls: dict[int, list[str]] = {}
+    received = reported = False
+    try:
+        for chunk in response:
+            received = True
+            if chunk.choices and chunk.choices[0].finish_reason:
+                stop_reason = chunk.choices[0].finish_reason
+            if getattr(chunk, "usage", None):
+                reported = True
+                on_usage(Usage.from_openai(chunk.usage), stop_reason)
+            if chunk.choices and chunk.choices[0].delta.content:
+                text.append(chunk.choices[0].delta.content)
+                yield text[-1]
+            add_tool_call_deltas(calls, chunk)
+        for name, arguments in calls.values():
+            call = tool_call(tools or [], name, arguments)
+            text.append(ModelResponse(("\n" if text else "") + call.render(), [call]))
+            yield text[-1]
+    finally:
+        close = getattr(response, "close", None)
+        if close is not None:
+            close()
+        if received and not reported:
+            on_usage(Usage.estimate(prompt_tokens, "".join(text)), stop_reason)
+
+
+def add_tool_call_deltas(calls: dict[int, list[str]], chunk: Any):
+    """Accumulates the tool call fragments of a streamed chat completion chunk into name and arguments."""
+    if not chunk.choices:
+        return
+    for call in getattr(chunk.choices[0].delta, "tool_calls", None) or []:
+        name, arguments = calls.setdefault(call.index, ["", ""])
+        if call.function is not None:
+            calls[call.index] = [name + (call.function.name or ""), arguments + (call.function.arguments or "")]
+
+
+def anthropic_messages(history: History, prompt_caching: bool) -> dict[str, Any]:
+    """Splits off the system prompt and marks the system prompt and the latest message as cache breakpoints.
+
+    Anthropic reads the longest cached prefix ending at an earlier block boundary, so marking the newest
+    message on every turn lets each query reuse the whole conversation cached by the previous one.
+    """
+    if not prompt_caching:
+        return {"system": history[0]["content"], "messages": list(history[1:])}
+
+    cache_control = {"type": "ephemeral"}
+    messages = list(history[1:])
+    if messages:
+        last = messages[-1]
+        messages[-1] = {
+            "role": last["role"],
+            "content": [{"type": "text", "text": last["content"], "cache_control": cache_control}],
+        }
+    return {
+        "system": [{"type": "text", "text": history[0]["content"], "cache_control": cache_control}],
+        "messages": messages,
+    }
+
+
+def tool_parameters(tool: ToolSpec) -> dict[str, Any]:
+    if tool.argument is None:
+        return {"type": "object", "properties": {}}
+    return {
+        "type": "object",
+        "properties": {tool.argument: {"type": "string", "description": tool.argument_description}},
+        "required": [tool.argument],
+    }
+
+
+def openai_tools(tools: list[ToolSpec], parallel: bool = True) -> dict[str, Any]:
+    """The tools of a chat completion request, in the format OpenAI, Together and Fireworks share."""
+    if not tools:
+        return {}
+    return {
+        "tools": [
+            {
+                "type": "function",
+                "function": {"name": tool.name, "description": tool.description, "parameters": tool_parameters(tool)},
+            }
+            for tool in tools
+        ],
+        "parallel_tool_calls": parallel,
+    }
+
+
+def anthropic_tools(tools: list[ToolSpec], parallel: bool = True) -> dict[str, Any]:
+    if not tools:
+        return {}
+    return {
+        "tools": [
+            {"name": tool.name, "description": tool.description, "input_schema": tool_parameters(tool)}
+            for tool in tools
+        ],
+        **({} if parallel else {"tool_choice": {"type": "auto", "disable_parallel_tool_use": True}}),
+    }
+
+
+def tool_call(tools: list[ToolSpec], name: str, arguments: str | dict) -> ToolCall:
+    tool = next((tool for tool in tools if tool.name == name), ToolSpec(name, "", None))
+    if isinstance(arguments, str):
+        try:
+            arguments = json.loads(arguments) if arguments.strip() else {}
+        except json.JSONDecodeError:
+            # Models sometimes send the bare argument instead of a JSON object.
+            arguments = {tool.argument: arguments}
+    if not isinstance(arguments, dict):
+        arguments = {}
+    return tool.call(arguments)
+
+
+class ModelResponse(str):
+    """A response's text along with the native tool calls it made, which are run as they are.
+
+    The text has the calls written as XML after any prose, so the history, journal and cache still hold plain
+    text, but the calls are never parsed back out of it. A tag or closing tag inside a call's content therefore
+    stays part of it, and tags in the prose are not run alongside the calls.
+    """
+
+    tool_calls: tuple[ToolCall, ...]
+
+    def __new__(cls, text: str, tool_calls: list[ToolCall] | tuple[ToolCall, ...] = ()) -> "ModelResponse":
+        response = super().__new__(cls, text)
+        response.tool_calls = tuple(tool_calls)
+        return response
+
+
+def join_tool_calls(text: str | None, calls: list[ToolCall]) -> str:
+    if not calls:
+        return text or ""
+    return ModelResponse("\n".join(([text] if text else []) + [call.render() for call in calls]), calls)
+
+
+class StreamedToolCalls:
+    """Collects the tool calls of a stream, whose chunks are ModelResponses, while text chunks go to the detector."""
+
+    def __init__(self):
+        self.calls: list[ToolCall] = []
+        self.text: list[str] = []
+
+    def add(self, chunk: str) -> bool:
+        """Returns whether the chunk was a tool call."""
+        if not isinstance(chunk, ModelResponse):
+            return False
+        self.calls.extend(chunk.tool_calls)
+        self.text.append(chunk)
+        return True
+
+    def response(self, text: str) -> str:
+        return ModelResponse(text + "".join(self.text), self.calls) if self.calls else text
+
+
+def chat_completion_text(message: Any, tools: list[ToolSpec]) -> str:
+    calls = [tool_call(tools, call.function.name, call.function.arguments) for call in message.tool_calls or []]
+    return join_tool_calls(message.content, calls)
+
+
+def anthropic_content_text(content: list[Any], tools: list[ToolSpec]) -> str:
+    text = "".join(block.text for block in content if block.type == "text")
+    calls = [tool_call(tools, block.name, block.input) for block in content if block.type == "tool_use"]
+    return join_tool_calls(text, calls)
+
+
 class OpenAIModel(APIModel):
-    def get_client(self, args: ModelArguments) -> OpenAI:
+    def get_client(self, args: ModelArguments) -> "OpenAI":
+        from openai import OpenAI
+
         return OpenAI(
-            api_key=args.openai_api_key, max_retries=args.api_max_retries, timeout=args.api_timeout
+            base_url=args.api_base_url,
+            api_key=args.openai_api_key,
+            max_retries=args.api_max_retries,
+            timeout=args.api_timeout,
+            http_client=self.http_client(args),
         )
 
     def query(self, history: History) -> str:
-        response = self.get_client(self.args).chat.completions.create(
+        response = self.client.chat.completions.create(
+            model=self.model,
+            messages=list(history),
+            temperature=self.temperature,
+            top_p=self.top_p,
+            max_tokens=self.max_tokens,
+            **openai_tools(self.tools, self.parallel_tool_calls),
+        )
+        self.record_usage(Usage.from_openai(response.usage), response.choices[0].finish_reason)
+        return chat_completion_text(response.choices[0].message, self.tools)
+
+    def stream(self, history: History) -> Iterator[str]:
+        response = self.client.chat.completions.create(
             model=self.model,
             messages=list(history),
             temperature=self.temperature,
             top_p=self.top_p,
             max_tokens=self.max_tokens,
+            **openai_tools(self.tools, self.parallel_tool_calls),
+            stream=True,
+            stream_options={"include_usage": True},
         )
-        return response.choices[0].message.content
+        yield from chat_completion_chunks(response, self.record_usage, self.tools, estimate_prompt_tokens(history))
 
 
 class TogetherAIModel(APIModel):
-    def get_client(self, args: ModelArguments) -> Together:
-        return Together(
+    def get_client(self, args: ModelArguments) -> "OpenAI":
+        from openai import OpenAI
+
+        # Together's API is OpenAI-compatible, and the OpenAI client can use the pooled httpx client.
+        return OpenAI(
+            base_url=args.api_base_url or "https://api.together.xyz/v1",
             api_key=args.together_api_key,
             max_retries=args.api_max_retries,
             timeout=args.api_timeout,
+            http_client=self.http_client(args),
         )
 
     def query(self, history: History) -> str:
-        response = self.get_client(self.args).chat.completions.create(
+        response = self.client.chat.completions.create(
+            model=self.model,
+            messages=list(history),
+            temperature=self.temperature,
+            top_p=self.top_p,
+            max_tokens=self.max_tokens,
+            **openai_tools(self.tools, self.parallel_tool_calls),
+        )
+        self.record_usage(Usage.from_openai(response.usage), response.choices[0].finish_reason)
+        return chat_completion_text(response.choices[0].message, self.tools)
+
+    def stream(self, history: History) -> Iterator[str]:
+        response = self.client.chat.completions.create(
             model=self.model,
             messages=list(history),
             temperature=self.temperature,
             top_p=self.top_p,
             max_tokens=self.max_tokens,
+            **openai_tools(self.tools, self.parallel_tool_calls),
+            stream=True,
         )
-        return response.choices[0].message.content
+        yield from chat_completion_chunks(response, self.record_usage, self.tools, estimate_prompt_tokens(history))
 
 
 class FireworksAIModel(APIModel):
-    def get_client(self, args: ModelArguments) -> OpenAI:
+    def get_client(self, args: ModelArguments) -> "OpenAI":
+        from openai import OpenAI
+
         return OpenAI(
-            base_url="https://api.fireworks.ai/inference/v1",
+            base_url=args.api_base_url or "https://api.fireworks.ai/inference/v1",
             api_key=args.fireworks_api_key,
+            max_retries=args.api_max_retries,
             timeout=args.api_timeout,
+            http_client=self.http_client(args),
         )
 
     def query(self, history: History) -> str:
-        response = self.get_client(self.args).chat.completions.create(
+        response = self.client.chat.completions.create(
+            model=self.model,
+            messages=list(history),
+            temperature=self.temperature,
+            top_p=self.top_p,
+            max_tokens=self.max_tokens,
+            **openai_tools(self.tools, self.parallel_tool_calls),
+        )
+        self.record_usage(Usage.from_openai(response.usage), response.choices[0].finish_reason)
+        return chat_completion_text(response.choices[0].message, self.tools)
+
+    def stream(self, history: History) -> Iterator[str]:
+        response = self.client.chat.completions.create(
             model=self.model,
             messages=list(history),
             temperature=self.temperature,
             top_p=self.top_p,
             max_tokens=self.max_tokens,
+            **openai_tools(self.tools, self.parallel_tool_calls),
+            stream=True,
         )
-        return response.choices[0].message.content
+        yield from chat_completion_chunks(response, self.record_usage, self.tools, estimate_prompt_tokens(history))
+
+
+class AnthropicToolStream:
+    """Turns the content events of a streamed Anthropic message into text, and each tool call into a ModelResponse."""
+
+    def __init__(self, tools: list[ToolSpec]):
+        self.tools = tools
+        self.wrote_text = False
+        self.tool_name: str | None = None
+        self.tool_input = ""
+
+    def feed(self, event: Any) -> str | None:
+        text = None
+        if event.type == "content_block_start" and event.content_block.type == "tool_use":
+            self.tool_name, self.tool_input = event.content_block.name, ""
+        elif event.type == "content_block_delta" and event.delta.type == "text_delta":
+            text = event.delta.text
+        elif event.type == "content_block_delta" and event.delta.type == "input_json_delta":
+            self.tool_input += event.delta.partial_json
+        elif event.type == "content_block_stop" and self.tool_name is not None:
+            call = tool_call(self.tools, self.tool_name, self.tool_input)
+            text = ModelResponse(("\n" if self.wrote_text else "") + call.render(), [call])
+            self.tool_name = None
+        self.wrote_text = self.wrote_text or bool(text)
+        return text
+
+
+def anthropic_stream_usage(usage: Usage, stop_reason: str | None, text: str) -> Usage:
+    """Output tokens are only reported at the end of a stream, so a stream cut off before it estimates them."""
+    if stop_reason is None and text:
+        estimated = Usage.estimate(0, text)
+        usage.completion_tokens = max(usage.completion_tokens, estimated.completion_tokens)
+        usage.estimated_tokens += usage.completion_tokens
+    return usage
 
 
 class AnthropicModel(APIModel):
-    def get_client(self, args: ModelArguments) -> Anthropic:
+    def get_client(self, args: ModelArguments) -> "Anthropic":
+        from anthropic import Anthropic
+
         return Anthropic(
+            base_url=args.api_base_url,
             api_key=args.anthropic_api_key,
             max_retries=args.api_max_retries,
             timeout=args.api_timeout,
+            http_client=self.http_client(args),
         )
 
     def query(self, history: History) -> str:
-        response = self.get_client(self.args).messages.create(
+        response = self.client.messages.create(
             model=self.model,
-            system=history[0]["content"],
-            messages=list(history[1:]),
             temperature=self.temperature,
             top_p=self.top_p,
             max_tokens=self.max_tokens,
+            **anthropic_messages(history, self.args.prompt_caching),
+            **anthropic_tools(self.tools, self.parallel_tool_calls),
         )
-        return response.content[0].text
+        self.record_usage(Usage.from_anthropic(response.usage), response.stop_reason)
+        return anthropic_content_text(response.content, self.tools)
+
+    def stream(self, history: History) -> Iterator[str]:
+        usage = Usage()
+        stop_reason = None
+        text: list[str] = []
+        tool_stream = AnthropicToolStream(self.tools)
+        with self.client.messages.stream(
+            model=self.model,
+            temperature=self.temperature,
+            top_p=self.top_p,
+            max_tokens=self.max_tokens,
+            **anthropic_messages(history, self.args.prompt_caching),
+            **anthropic_tools(self.tools, self.parallel_tool_calls),
+        ) as response:
+            try:
+                # Input usage arrives with message_start, so it is known even if the stream is cut off early.
+                for event in response:
+                    if event.type == "message_start":
+                        usage = Usage.from_anthropic(event.message.usage)
+                    elif event.type == "message_delta":
+                        stop_reason = event.delta.stop_reason
+                        if event.usage:
+                            usage.completion_tokens = event.usage.output_tokens
+                    elif chunk := tool_stream.feed(event):
+                        text.append(chunk)
+                        yield chunk
+            finally:
+                self.record_usage(anthropic_stream_usage(usage, stop_reason, "".join(text)), stop_reason)
+
+
+model_registry: dict[ModelName, type[APIModel]] = {
+    ModelName.gpt_4o_mini: OpenAIModel,
+    ModelName.gpt_4o: OpenAIModel,
+    ModelName.claude3_haiku: AnthropicModel,
+    ModelName.claude3_sonnet: AnthropicModel,
+    ModelName.claude3_opus: AnthropicModel,
+    ModelName.claude3_5_sonnet: AnthropicModel,
+    ModelName.llama3_1_405b_together: TogetherAIModel,
+    ModelName.llama3_1_405b: FireworksAIModel,
+    ModelName.llama3_1_70b: TogetherAIModel,
+    ModelName.llama3_1_8b: TogetherAIModel,
+    ModelName.llama2_7b: TogetherAIModel,
+    ModelName.llama2_13b: TogetherAIModel,
+    ModelName.llama2_70b: TogetherAIModel,
+    ModelName.gemma2_27b: TogetherAIModel,
+    ModelName.gemma2_13b: TogetherAIModel,
+    ModelName.gemma_7b: TogetherAIModel,
+    ModelName.qwen1_5_72b: TogetherAIModel,
+    ModelName.qwen1_5_32b: TogetherAIModel,
+    ModelName.qwen1_5_14b: TogetherAIModel,
+    ModelName.qwen1_5_7b: TogetherAIModel,
+    ModelName.qwen1_5_4b: TogetherAIModel,
+}
 
 
 def get_model(args: ModelArguments) -> APIModel:
-    model_registry = {
-        ModelName.gpt_4o_mini: OpenAIModel,
-        ModelName.gpt_4o: OpenAIModel,
-        ModelName.claude3_haiku: AnthropicModel,
-        ModelName.claude3_sonnet: AnthropicModel,
-        ModelName.claude3_opus: AnthropicModel,
-        ModelName.claude3_5_sonnet: AnthropicModel,
-        ModelName.llama3_1_405b_together: TogetherAIModel,
-        ModelName.llama3_1_405b: FireworksAIModel,
-        ModelName.llama3_1_70b: TogetherAIModel,
-        ModelName.llama3_1_8b: TogetherAIModel,
-        ModelName.llama2_7b: TogetherAIModel,
-        ModelName.llama2_13b: TogetherAIModel,
-        ModelName.llama2_70b: TogetherAIModel,
-        ModelName.gemma2_27b: TogetherAIModel,
-        ModelName.gemma2_13b: TogetherAIModel,
-        ModelName.gemma_7b: TogetherAIModel,
-        ModelName.qwen1_5_72b: TogetherAIModel,
-        ModelName.qwen1_5_32b: TogetherAIModel,
-        ModelName.qwen1_5_14b: TogetherAIModel,
-        ModelName.qwen1_5_7b: TogetherAIModel,
-        ModelName.qwen1_5_4b: TogetherAIModel,
-    }
     model_class = model_registry[args.model]
-    return model_class(args)
+    model = ResilientModel(rate_limited(model_class(replace(args, api_max_retries=0)), args), args)
+    if args.cache_mode != CacheMode.off:
+        model = CachedModel(model, ResponseCache(args.cache_path), args.cache_mode)
+    return model
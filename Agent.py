@@ -1,9 +1,21 @@
-from dataclasses import dataclass
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
 
-from APIModel import ModelArguments, get_model
-from commands import BaseCommand
-from History import History, Role
-from templates import NO_COMMANDS_CALLED, TOO_MANY_COMMANDS
+from APIModel import APIModel, ModelArguments, ModelResponse, get_model
+from AsyncAPIModel import AsyncAPIModel, get_async_model
+from commands import BaseCommand, CommandCall, CommandDetector, CommandParser, ToolCall
+from ContextWindow import CompactionMode, ContextWindow
+from History import FsyncPolicy, History, Role
+from Metrics import MetricsExporter, RunMetrics
+from Observations import ObservationCompactor
+from templates import (
+    COMMAND_OUTPUT_LABEL,
+    EXCLUSIVE_COMMAND,
+    NO_COMMANDS_CALLED,
+    TOO_MANY_COMMANDS,
+    TOO_MANY_PARALLEL_COMMANDS,
+)
 
 
 @dataclass(frozen=True)
@@ -11,25 +23,80 @@ class AgentArguments:
     model: ModelArguments
     message_cap: int = 30  # The maximum number of messages the agent can send.
     bash_timeout: int = 20  # The maximum seconds a bash command can run for.
+    bash_persistent: bool = False  # Whether bash commands share one long-lived shell session.
+    bash_max_output_bytes: int = 20000  # Longer bash output is cut down to its head and tail.
+    bash_max_output_lines: int = 400  # Bash output with more lines is cut down to its head and tail.
+    bash_cpu_seconds: int | None = None  # The CPU time limit of each process a bash command starts.
+    bash_memory_mb: int | None = None  # The address space limit of each process a bash command starts.
+    bash_open_files: int | None = None  # The open file limit of each process a bash command starts.
+    bash_processes: int | None = None  # The process limit of the user running bash commands (not enforced for root).
+    bash_input_wait: float | None = 1.0  # Seconds a bash command can wait for input before it is stopped.
+    bash_idle_timeout: float | None = None  # Seconds a bash command can print nothing before it is stopped.
+    background_jobs: bool = True  # Whether long commands can be run as background jobs with bash_bg and job.
+    max_background_jobs: int = 4  # The maximum number of background jobs running at once.
+    browser_start_command: str = "browse-start"  # Starts the browser daemon on the first browse-* command.
+    browser_probe_command: str | None = "browse-observe"  # Succeeds once the browser daemon is ready.
+    browser_ready_timeout: float = 10.0  # The maximum seconds to wait for the browser daemon to be ready.
+    stream: bool = False  # Whether to stream responses and cut them off after the first complete command.
+    context_token_budget: int | None = None  # Estimated prompt tokens to stay under. Unlimited if None.
+    context_keep_recent: int = 6  # The number of most recent messages that are never compacted.
+    context_compaction: CompactionMode = CompactionMode.truncate  # How old bash outputs are compacted.
+    compact_observations: bool = True  # Whether page observations are sent as diffs and superseded ones collapsed.
+    max_parallel_commands: int = 1  # Up to this many bash commands in one response run at the same time.
+    native_tools: bool = False  # Whether commands are also offered as provider-native tools. XML tags still work.
 
 
 class Agent:
     def __init__(self, args: AgentArguments):
         self.history = History()
         self.message_left = args.message_cap
-        self.model = get_model(args.model)
+        self.model = self._get_model(args.model)
         self.commands: list[BaseCommand] = []
+        self.parser = CommandParser(self.commands)
         self.has_submitted = False
+        self.message_cap = args.message_cap
+        self.pending_response: str | None = None
+        self.stream = args.stream
+        self.context = ContextWindow(
+            args.context_token_budget,
+            args.context_keep_recent,
+            args.context_compaction,
+            collapse_observations=args.compact_observations,
+        )
+        self.observations = ObservationCompactor() if args.compact_observations else None
+        self.native_tools = args.native_tools
+        self.metrics = RunMetrics(self.model, tool_mode="native" if args.native_tools else "xml")
+        self.max_parallel_commands = args.max_parallel_commands
+        self.command_executor: ThreadPoolExecutor | None = None
+
+    def _get_model(self, args: ModelArguments) -> APIModel:
+        return get_model(args)
 
     def loop(self):
+        if self.pending_response is not None:
+            self._handle_commands(self._take_pending_response())
         while not self.has_submitted and self.message_left > 0:
-            response = self.model.query(self.history)
-            self.history.add(role=Role.assistant, content=response)
-            self._handle_commands(response)
+            with self.metrics.turn():
+                with self.metrics.span("query"):
+                    response = self._query()
+                with self.metrics.span("append"):
+                    self._add_response(response)
+                self._handle_commands(response)
             self.message_left -= 1
 
+    def _query(self) -> str:
+        history = self.context.render(self.history)
+        if self.stream:
+            return self.model.query_stream(history, CommandDetector(self.parser, self.max_parallel_commands))
+        return self.model.query(history)
+
     def add_commands(self, commands: list[BaseCommand]):
         self.commands.extend(commands)
+        self.parser = CommandParser(self.commands)
+        if self.native_tools:
+            self.model.set_tools(
+                [command.tool_spec() for command in self.commands], parallel=self.max_parallel_commands > 1
+            )
 
     def add_system_msg(self, content: str):
         self.history.add(role=Role.system, content=content)
@@ -40,24 +107,169 @@ class Agent:
     def save_history(self, path: str):
         self.history.save(path)
 
-    def _total_command_calls(self, content: str) -> int:
-        return sum(command.count_occurrences(content) for command in self.commands)
+    def open_journal(self, path: str, fsync: FsyncPolicy = FsyncPolicy.turn):
+        self.history.open_journal(path, fsync)
 
-    def _handle_commands(self, content: str):
-        total_call_num = self._total_command_calls(content)
-        if total_call_num == 0:
-            return self.history.add(role=Role.user, content=NO_COMMANDS_CALLED)
-        if total_call_num > 1:
-            return self.history.add(role=Role.user, content=TOO_MANY_COMMANDS)
+    def open_metrics(self, path: str | None, exporter: MetricsExporter | None = None, resume: bool = False):
+        """Opens the metrics file. When resuming, call this after resume, so that turns are numbered on from it."""
+        self.metrics.open(path, exporter, resume, turns_before=self.history.turn)
+
+    def resume(self, path: str, fsync: FsyncPolicy = FsyncPolicy.turn):
+        """Restores the agent from a journal and keeps appending to it, without repeating any model calls."""
+        self.history, events = History.from_journal(path)
+        self.history.open_journal(path, fsync, resume=True)
+        self.message_left = self.message_cap - self.history.turn
+        self.has_submitted = any(event["event"] == "submitted" for event in events)
+        # A response whose commands never ran is handled before the next query.
+        if len(self.history) and self.history[-1]["role"] == Role.assistant and not self.has_submitted:
+            turn = self.history.turn
+            calls = [event["calls"] for event in events if event["event"] == "tool_calls" and event["turn"] == turn]
+            content = self.history[-1]["content"]
+            self.pending_response = ModelResponse(content, [ToolCall(**call) for call in calls[-1]]) if calls else content
 
-        self._execute_commands(content)
+    def _add_response(self, response: str):
+        self.history.add(role=Role.assistant, content=response)
+        if tool_calls := getattr(response, "tool_calls", ()):
+            # The journal holds only the text, so the calls are recorded as they are for a resumed run to use.
+            self.history.add_event("tool_calls", turn=self.history.turn, calls=[asdict(call) for call in tool_calls])
 
-    def _execute_commands(self, content: str):
+    def _take_pending_response(self) -> str:
+        response, self.pending_response = self.pending_response, None
+        return response
+
+    def close(self):
         for command in self.commands:
-            outputs = command.execute(content)
+            command.close()
+        self.history.close_journal()
+        self.metrics.close()
+        if self.command_executor is not None:
+            self.command_executor.shutdown()
+        self.model.close()
+
+    def _check_command_calls(self, calls: list[CommandCall]) -> str | None:
+        """Returns an error message if the response does not call exactly one command, or several allowed ones.
+
+        Such a response wastes the turn, which is recorded in the metrics.
+        """
+        error = self._command_calls_error(calls)
+        if error is not None:
+            self.metrics.waste_turn("no_commands" if not calls else "invalid_calls")
+        return error
+
+    def _command_calls_error(self, calls: list[CommandCall]) -> str | None:
+        if len(calls) == 0:
+            return NO_COMMANDS_CALLED
+        if len(calls) == 1:
+            return None
+        if self.max_parallel_commands == 1:
+            return TOO_MANY_COMMANDS
+        for command, _ in calls:
+            if command.exclusive:
+                return EXCLUSIVE_COMMAND.format(command=command.xml_tag)
+        if len(calls) > self.max_parallel_commands:
+            return TOO_MANY_PARALLEL_COMMANDS.format(max_commands=self.max_parallel_commands)
+        return None
+
+    def _parse_calls(self, response: str) -> list[CommandCall]:
+        """Returns the response's native tool calls if it made any, and otherwise the commands it wrote as XML."""
+        tool_calls = getattr(response, "tool_calls", ())
+        if not tool_calls:
+            return self.parser.parse(response)
+        commands = self.parser.commands
+        return [(commands[call.name], call.content) for call in tool_calls if call.name in commands]
+
+    def _handle_commands(self, content: str):
+        with self.metrics.span("parse"):
+            calls = self._parse_calls(content)
+        if error := self._check_command_calls(calls):
+            with self.metrics.span("append"):
+                return self.history.add(role=Role.user, content=error)
+
+        self._execute_commands(calls)
+
+    def _execute_commands(self, calls: list[CommandCall]):
+        if len(calls) == 1:
+            command, command_content = calls[0]
+            with self.metrics.span("execute", command=command.xml_tag):
+                output = command.run(command_content)
+            with self.metrics.span("append"):
+                self.history.add(role=Role.user, content=self._compact_output(output))
+            return
 
-            for output in outputs:
-                self.history.add(role=Role.user, content=output)
+        with self.metrics.span("execute", command="parallel", count=len(calls)):
+            if all(command.concurrent for command, _ in calls):
+                if self.command_executor is None:
+                    self.command_executor = ThreadPoolExecutor(self.max_parallel_commands, "command")
+                outputs = list(self.command_executor.map(lambda call: call[0].run(call[1]), calls))
+            else:
+                outputs = [command.run(command_content) for command, command_content in calls]
+        with self.metrics.span("append"):
+            self.history.add(role=Role.user, content=self._combine_outputs(calls, outputs))
+
+    def _compact_output(self, output: str) -> str:
+        return output if self.observations is None else self.observations.compact(output)
+
+    def _combine_outputs(self, calls: list[CommandCall], outputs: list[str]) -> str:
+        """Labels each command's output and joins them in the order the commands were called."""
+        parts = []
+        for index, ((_, command_content), output) in enumerate(zip(calls, outputs), start=1):
+            first_line = command_content.strip().split("\n", 1)[0]
+            label = first_line if len(first_line) <= 80 else first_line[:77] + "..."
+            header = COMMAND_OUTPUT_LABEL.format(index=index, count=len(calls), command=label)
+            parts.append(f"{header}\n{self._compact_output(output)}")
+        return "\n\n".join(parts)
 
     def _submit_callback(self):
         self.has_submitted = True
+        self.history.add_event("submitted")
+
+
+class AsyncAgent(Agent):
+    """An Agent whose loop runs on an event loop, so that many agents can share one thread."""
+
+    def _get_model(self, args: ModelArguments) -> AsyncAPIModel:
+        return get_async_model(args)
+
+    async def loop(self):
+        if self.pending_response is not None:
+            await self._handle_commands(self._take_pending_response())
+        while not self.has_submitted and self.message_left > 0:
+            with self.metrics.turn():
+                with self.metrics.span("query"):
+                    response = await self._query()
+                with self.metrics.span("append"):
+                    self._add_response(response)
+                await self._handle_commands(response)
+            self.message_left -= 1
+
+    async def _query(self) -> str:
+        history = self.context.render(self.history)
+        if self.stream:
+            return await self.model.query_stream(history, CommandDetector(self.parser, self.max_parallel_commands))
+        return await self.model.query(history)
+
+    async def _handle_commands(self, content: str):
+        with self.metrics.span("parse"):
+            calls = self._parse_calls(content)
+        if error := self._check_command_calls(calls):
+            with self.metrics.span("append"):
+                return self.history.add(role=Role.user, content=error)
+
+        await self._execute_commands(calls)
+
+    async def _execute_commands(self, calls: list[CommandCall]):
+        if len(calls) == 1:
+            command, command_content = calls[0]
+            with self.metrics.span("execute", command=command.xml_tag):
+                output = await command.arun(command_content)
+            with self.metrics.span("append"):
+                self.history.add(role=Role.user, content=self._compact_output(output))
+            return
+
+        with self.metrics.span("execute", command="parallel", count=len(calls)):
+            if all(command.concurrent for command, _ in calls):
+                outputs = await asyncio.gather(*(command.arun(command_content) for command, command_content in calls))
+            else:
+                outputs = [await command.arun(command_content) for command, command_content in calls]
+        with self.metrics.span("append"):
+            self.history.add(role=Role.user, content=self._combine_outputs(calls, outputs))
@@ -0,0 +1,535 @@
+import asyncio
+import time
+from abc import ABC, abstractmethod
+from collections.abc import AsyncIterator, Awaitable, Callable
+from dataclasses import replace
+from typing import TYPE_CHECKING, Any
+
+from APIModel import (
+    AnthropicModel,
+    AnthropicToolStream,
+    APIModel,
+    CachedModel,
+    FireworksAIModel,
+    LatencyTracker,
+    ModelArguments,
+    ModelName,
+    ModelResponse,
+    ModelWrapper,
+    OpenAIModel,
+    ResultType,
+    StreamedToolCalls,
+    TogetherAIModel,
+    Usage,
+    add_tool_call_deltas,
+    anthropic_content_text,
+    anthropic_messages,
+    anthropic_stream_usage,
+    anthropic_tools,
+    chat_completion_text,
+    estimate_prompt_tokens,
+    estimate_request_tokens,
+    http_limits,
+    is_retryable,
+    model_registry,
+    model_scope,
+    openai_tools,
+    rate_limit_hooks,
+    rate_limiter,
+    request_usage,
+    retry_after,
+    retry_delay,
+    tool_call,
+)
+from ClientPool import client_pool
+from commands import CommandDetector, ToolSpec
+from History import History
+from Logger import logger
+from RateLimiter import RateLimiter
+from ResponseCache import CacheMode, ResponseCache
+
+if TYPE_CHECKING:
+    import httpx
+    from anthropic import AsyncAnthropic
+    from openai import AsyncOpenAI
+
+
+class AsyncAPIModel(ABC):
+    def __init__(self, args: ModelArguments):
+        self.args = args
+        self.model = args.model
+        self.temperature = args.temperature
+        self.top_p = args.top_p
+        self.max_tokens = args.max_tokens
+        self.client = client_pool.get(self.client_key(args), lambda: self.get_client(args))
+        self.usage = Usage()
+        self.usage_by_model: dict[ModelName, Usage] = {}
+        self.last_usage = Usage()
+        self.last_stop_reason: str | None = None
+        self.tools: list[ToolSpec] = []
+        self.parallel_tool_calls = True
+
+    client_key = APIModel.client_key
+    record_usage = APIModel.record_usage
+    set_tools = APIModel.set_tools
+    close = APIModel.close
+
+    @staticmethod
+    def http_client(args: ModelArguments) -> "httpx.AsyncClient":
+        import httpx
+
+        return httpx.AsyncClient(
+            timeout=args.api_timeout, limits=http_limits(args), event_hooks=rate_limit_hooks(args, asynchronous=True)
+        )
+
+    @abstractmethod
+    async def query(self, history: History) -> str:
+        pass
+
+    @abstractmethod
+    def stream(self, history: History) -> AsyncIterator[str]:
+        """Yields the response text as it is generated. Closing the iterator cancels the request."""
+        pass
+
+    async def query_stream(self, history: History, detector: CommandDetector) -> str:
+        """Streams the response and stops as soon as the detector sees a complete command."""
+        chunks = self.stream(history)
+        calls = StreamedToolCalls()
+        cut_off = False
+        try:
+            async for chunk in chunks:
+                if not calls.add(chunk) and (cut_off := detector.feed(chunk)):
+                    break
+        finally:
+            await chunks.aclose()
+        if cut_off:
+            self.last_stop_reason = "command_detected"
+        return calls.response(detector.response())
+
+    @abstractmethod
+    def get_client(self, args: ModelArguments) -> "AsyncOpenAI | AsyncAnthropic":
+        pass
+
+
+async def chat_completion_chunks(
+    response,
+    on_usage: Callable[[Usage, str | None], None],
+    tools: list[ToolSpec] | None = None,
+    prompt_tokens: int = 0,
+) -> AsyncIterator[str]:
+    """Yields the text deltas of a streamed chat completion, closing the connection when stopped early."""
+    stop_reason = None
+    text: list[str] = []
+    calls: dict[int, list[str]] = {}
+    received = reported = False
+    try:
+        async for chunk in response:
+            received = True
+            if chunk.choices and chunk.choices[0].finish_reason:
+                stop_reason = chunk.choices[0].finish_reason
+            if getattr(chunk, "usage", None):
+                reported = True
+                on_usage(Usage.from_openai(chunk.usage), stop_reason)
+            if chunk.choices and chunk.choices[0].delta.content:
+                text.append(chunk.choices[0].delta.content)
+                yield text[-1]
+            add_tool_call_deltas(calls, chunk)
+        for name, arguments in calls.values():
+            call = tool_call(tools or [], name, arguments)
+            text.append(ModelResponse(("\n" if text else "") + call.render(), [call]))
+            yield text[-1]
+    finally:
+        close = getattr(response, "close", None) or getattr(response, "aclose", None)
+        if close is not None:
+            await close()
+        if received and not reported:
+            on_usage(Usage.estimate(prompt_tokens, "".join(text)), stop_reason)
+
+
+class AsyncOpenAIModel(AsyncAPIModel):
+    def get_client(self, args: ModelArguments) -> "AsyncOpenAI":
+        from openai import AsyncOpenAI
+
+        return AsyncOpenAI(
+            base_url=args.api_base_url,
+            api_key=args.openai_api_key,
+            max_retries=args.api_max_retries,
+            timeout=args.api_timeout,
+            http_client=self.http_client(args),
+        )
+
+    async def query(self, history: History) -> str:
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=list(history),
+            temperature=self.temperature,
+            top_p=self.top_p,
+            max_tokens=self.max_tokens,
+            **openai_tools(self.tools, self.parallel_tool_calls),
+        )
+        self.record_usage(Usage.from_openai(response.usage), response.choices[0].finish_reason)
+        return chat_completion_text(response.choices[0].message, self.tools)
+
+    async def stream(self, history: History) -> AsyncIterator[str]:
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=list(history),
+            temperature=self.temperature,
+            top_p=self.top_p,
+            max_tokens=self.max_tokens,
+            **openai_tools(self.tools, self.parallel_tool_calls),
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        prompt_tokens = estimate_prompt_tokens(history)
+        async for chunk in chat_completion_chunks(response, self.record_usage, self.tools, prompt_tokens):
+            yield chunk
+
+
+class AsyncTogetherAIModel(AsyncAPIModel):
+    def get_client(self, args: ModelArguments) -> "AsyncOpenAI":
+        from openai import AsyncOpenAI
+
+        # Together's API is OpenAI-compatible, and the OpenAI client can use the pooled httpx client.
+        return AsyncOpenAI(
+            base_url=args.api_base_url or "https://api.together.xyz/v1",
+            api_key=args.together_api_key,
+            max_retries=args.api_max_retries,
+            timeout=args.api_timeout,
+            http_client=self.http_client(args),
+        )
+
+    async def query(self, history: History) -> str:
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=list(history),
+            temperature=self.temperature,
+            top_p=self.top_p,
+            max_tokens=self.max_tokens,
+            **openai_tools(self.tools, self.parallel_tool_calls),
+        )
+        self.record_usage(Usage.from_openai(response.usage), response.choices[0].finish_reason)
+        return chat_completion_text(response.choices[0].message, self.tools)
+
+    async def stream(self, history: History) -> AsyncIterator[str]:
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=list(history),
+            temperature=self.temperature,
+            top_p=self.top_p,
+            max_tokens=self.max_tokens,
+            **openai_tools(self.tools, self.parallel_tool_calls),
+            stream=True,
+        )
+        prompt_tokens = estimate_prompt_tokens(history)
+        async for chunk in chat_completion_chunks(response, self.record_usage, self.tools, prompt_tokens):
+            yield chunk
+
+
+class AsyncFireworksAIModel(AsyncAPIModel):
+    def get_client(self, args: ModelArguments) -> "AsyncOpenAI":
+        from openai import AsyncOpenAI
+
+        return AsyncOpenAI(
+            base_url=args.api_base_url or "https://api.fireworks.ai/inference/v1",
+            api_key=args.fireworks_api_key,
+            max_retries=args.api_max_retries,
+            timeout=args.api_timeout,
+            http_client=self.http_client(args),
+        )
+
+    async def query(self, history: History) -> str:
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=list(history),
+            temperature=self.temperature,
+            top_p=self.top_p,
+            max_tokens=self.max_tokens,
+            **openai_tools(self.tools, self.parallel_tool_calls),
+        )
+        self.record_usage(Usage.from_openai(response.usage), response.choices[0].finish_reason)
+        return chat_completion_text(response.choices[0].message, self.tools)
+
+    async def stream(self, history: History) -> AsyncIterator[str]:
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=list(history),
+            temperature=self.temperature,
+            top_p=self.top_p,
+            max_tokens=self.max_tokens,
+            **openai_tools(self.tools, self.parallel_tool_calls),
+            stream=True,
+        )
+        prompt_tokens = estimate_prompt_tokens(history)
+        async for chunk in chat_completion_chunks(response, self.record_usage, self.tools, prompt_tokens):
+            yield chunk
+
+
+class AsyncAnthropicModel(AsyncAPIModel):
+    def get_client(self, args: ModelArguments) -> "AsyncAnthropic":
+        from anthropic import AsyncAnthropic
+
+        return AsyncAnthropic(
+            base_url=args.api_base_url,
+            api_key=args.anthropic_api_key,
+            max_retries=args.api_max_retries,
+            timeout=args.api_timeout,
+            http_client=self.http_client(args),
+        )
+
+    async def query(self, history: History) -> str:
+        response = await self.client.messages.create(
+            model=self.model,
+            temperature=self.temperature,
+            top_p=self.top_p,
+            max_tokens=self.max_tokens,
+            **anthropic_messages(history, self.args.prompt_caching),
+            **anthropic_tools(self.tools, self.parallel_tool_calls),
+        )
+        self.record_usage(Usage.from_anthropic(response.usage), response.stop_reason)
+        return anthropic_content_text(response.content, self.tools)
+
+    async def stream(self, history: History) -> AsyncIterator[str]:
+        usage = Usage()
+        stop_reason = None
+        text: list[str] = []
+        tool_stream = AnthropicToolStream(self.tools)
+        async with self.client.messages.stream(
+            model=self.model,
+            temperature=self.temperature,
+            top_p=self.top_p,
+            max_tokens=self.max_tokens,
+            **anthropic_messages(history, self.args.prompt_caching),
+            **anthropic_tools(self.tools, self.parallel_tool_calls),
+        ) as response:
+            try:
+                async for event in response:
+                    if event.type == "message_start":
+                        usage = Usage.from_anthropic(event.message.usage)
+                    elif event.type == "message_delta":
+                        stop_reason = event.delta.stop_reason
+                        if event.usage:
+                            usage.completion_tokens = event.usage.output_tokens
+                    elif chunk := tool_stream.feed(event):
+                        text.append(chunk)
+                        yield chunk
+            finally:
+                self.record_usage(anthropic_stream_usage(usage, stop_reason, "".join(text)), stop_reason)
+
+
+async_model_classes: dict[type[APIModel], type[AsyncAPIModel]] = {
+    OpenAIModel: AsyncOpenAIModel,
+    TogetherAIModel: AsyncTogetherAIModel,
+    FireworksAIModel: AsyncFireworksAIModel,
+    AnthropicModel: AsyncAnthropicModel,
+}
+
+
+class AsyncModelWrapper(AsyncAPIModel):
+    """The asyncio counterpart of ModelWrapper. Anything not overridden is delegated to the wrapped model."""
+
+    def __init__(self, inner: AsyncAPIModel):
+        self.inner = inner
+
+    def __getattr__(self, name: str) -> Any:
+        if name == "inner":
+            raise AttributeError(name)
+        return getattr(self.inner, name)
+
+    async def query(self, history: History) -> str:
+        return await self.inner.query(history)
+
+    def stream(self, history: History) -> AsyncIterator[str]:
+        return self.inner.stream(history)
+
+    async def query_stream(self, history: History, detector: CommandDetector) -> str:
+        return await self.inner.query_stream(history, detector)
+
+    def get_client(self, args: ModelArguments) -> "AsyncOpenAI | AsyncAnthropic":
+        return self.inner.get_client(args)
+
+    def set_tools(self, tools: list[ToolSpec], parallel: bool = True):
+        self.inner.set_tools(tools, parallel)
+
+    def close(self):
+        self.inner.close()
+
+    last_stop_reason = ModelWrapper.last_stop_reason
+
+
+class AsyncRateLimitedModel(AsyncModelWrapper):
+    """The asyncio counterpart of RateLimitedModel. Waiting for a slot does not block the event loop."""
+
+    def __init__(self, inner: AsyncAPIModel, limiter: RateLimiter, args: ModelArguments):
+        super().__init__(inner)
+        self.limiter = limiter
+        self.scope = model_scope(args, inner.model.value)
+
+    async def _limited(self, history: History, call: Callable[[], Awaitable[str]]) -> str:
+        estimated = estimate_request_tokens(history, self.inner.max_tokens)
+        # The state file is locked and read off the event loop; only the wait itself happens on it.
+        if (wait := await asyncio.to_thread(self.limiter.reserve, self.scope, estimated)) > 0:
+            await asyncio.sleep(wait)
+        request_usage.set(None)
+        try:
+            response = await call()
+        except Exception as error:
+            if getattr(error, "status_code", None) == 429 and (delay := retry_after(error)) is not None:
+                await asyncio.to_thread(self.limiter.block, self.scope, delay)
+            raise
+        if (usage := request_usage.get()) is not None:
+            await asyncio.to_thread(
+                self.limiter.settle, self.scope, estimated, usage.prompt_tokens + usage.completion_tokens
+            )
+        return response
+
+    async def query(self, history: History) -> str:
+        return await self._limited(history, lambda: self.inner.query(history))
+
+    async def query_stream(self, history: History, detector: CommandDetector) -> str:
+        return await self._limited(history, lambda: self.inner.query_stream(history, detector))
+
+
+def async_rate_limited(model: AsyncAPIModel, args: ModelArguments) -> AsyncAPIModel:
+    limiter = rate_limiter(args)
+    return model if limiter is None else AsyncRateLimitedModel(model, limiter, args)
+
+
+class AsyncResilientModel(AsyncModelWrapper):
+    """The asyncio counterpart of ResilientModel. A hedged query's slower duplicate is cancelled."""
+
+    def __init__(self, inner: AsyncAPIModel, args: ModelArguments):
+        super().__init__(inner)
+        self.args = args
+        self.latencies = LatencyTracker(args.api_hedge_percentile) if args.api_hedge_percentile else None
+        self.fallback: AsyncAPIModel | None = None
+
+    def _get_fallback(self) -> AsyncAPIModel | None:
+        if self.args.api_fallback_model is None:
+            return None
+        if self.fallback is None:
+            fallback_args = replace(self.args, model=self.args.api_fallback_model, api_max_retries=0)
+            fallback = async_model_classes[model_registry[fallback_args.model]](fallback_args)
+            fallback.usage = self.inner.usage
+            fallback.usage_by_model = self.inner.usage_by_model
+            fallback.set_tools(self.inner.tools, self.inner.parallel_tool_calls)
+            self.fallback = async_rate_limited(fallback, fallback_args)
+        return self.fallback
+
+    async def _retrying(
+        self, call: Callable[[], Awaitable[ResultType]], can_retry: Callable[[], bool] = lambda: True
+    ) -> ResultType:
+        for attempt in range(self.args.api_max_retries + 1):
+            try:
+                return await call()
+            except Exception as error:
+                if attempt == self.args.api_max_retries or not is_retryable(error) or not can_retry():
+                    raise
+                delay = retry_delay(self.args, attempt, error)
+                logger.warning(f"API request failed ({error!r}); retrying in {delay:.1f}s.")
+                await asyncio.sleep(delay)
+
+    async def _hedged(self, call: Callable[[], Awaitable[ResultType]]) -> ResultType:
+        threshold = self.latencies.threshold() if self.latencies is not None else None
+        start = time.perf_counter()
+        if threshold is None:
+            result = await call()
+            if self.latencies is not None:
+                self.latencies.record(time.perf_counter() - start)
+            return result
+
+        tasks = {asyncio.ensure_future(call())}
+        done, _ = await asyncio.wait(tasks, timeout=threshold)
+        if not done:
+            logger.warning(f"Query slower than {threshold:.1f}s; sending a hedged duplicate.")
+            tasks.add(asyncio.ensure_future(call()))
+
+        pending = tasks
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self.latencies.record(time.perf_counter() - start)
+                        return task.result()
+            raise next(iter(done)).exception()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _failing_over(
+        self,
+        call: Callable[[AsyncAPIModel], Awaitable[ResultType]],
+        can_fail_over: Callable[[], bool] = lambda: True,
+    ) -> ResultType:
+        try:
+            return await call(self.inner)
+        except Exception as error:
+            fallback = self._get_fallback()
+            if fallback is None or not can_fail_over():
+                raise
+            logger.warning(f"{self.inner.model.value} failed ({error!r}); failing over to {fallback.model.value}.")
+            result = await call(fallback)
+            self.inner.last_stop_reason = fallback.last_stop_reason
+            return result
+
+    async def query(self, history: History) -> str:
+        return await self._failing_over(
+            lambda model: self._retrying(lambda: self._hedged(lambda: model.query(history)))
+        )
+
+    async def query_stream(self, history: History, detector: CommandDetector) -> str:
+        def unstarted() -> bool:
+            return not detector.text()
+
+        return await self._failing_over(
+            lambda model: self._retrying(lambda: model.query_stream(history, detector), unstarted), unstarted
+        )
+
+    def close(self):
+        if self.fallback is not None:
+            self.fallback.close()
+        super().close()
+
+
+class AsyncCachedModel(AsyncModelWrapper):
+    """The asyncio counterpart of CachedModel, sharing its cache entries."""
+
+    def __init__(self, inner: AsyncAPIModel, cache: ResponseCache, mode: CacheMode):
+        super().__init__(inner)
+        self.cache = cache
+        self.mode = mode
+
+    _request = CachedModel._request
+    _lookup = CachedModel._lookup
+    _put = CachedModel._put
+
+    async def query(self, history: History) -> str:
+        request = self._request(history, "query")
+        key, response = self._lookup(request)
+        if response is None:
+            response = await self.inner.query(history)
+            self._put(key, request, response)
+        return response
+
+    async def query_stream(self, history: History, detector: CommandDetector) -> str:
+        request = self._request(history, "stream")
+        key, response = self._lookup(request)
+        if response is None:
+            response = await self.inner.query_stream(history, detector)
+            self._put(key, request, response)
+        else:
+            detector.feed(response)
+        return response
+
+    def close(self):
+        self.cache.close()
+        super().close()
+
+
+def get_async_model(args: ModelArguments) -> AsyncAPIModel:
+    model_class = async_model_classes[model_registry[args.model]]
+    model = AsyncResilientModel(async_rate_limited(model_class(replace(args, api_max_retries=0)), args), args)
+    if args.cache_mode != CacheMode.off:
+        model = AsyncCachedModel(model, ResponseCache(args.cache_path), args.cache_mode)
+    return model
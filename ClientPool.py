@@ -0,0 +1,53 @@
+import atexit
+import inspect
+import threading
+from collections.abc import Callable, Hashable
+from typing import Any
+
+
+class ClientPool:
+    """Caches provider clients so that their connection pools are reused across queries and agents."""
+
+    def __init__(self):
+        self._clients: dict[Hashable, Any] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = factory()
+                self._clients[key] = client
+            return client
+
+    def _pop_all(self) -> list[Any]:
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        return clients
+
+    def close(self):
+        for client in self._pop_all():
+            close = getattr(client, "close", None)
+            if close is None:
+                continue
+            result = close()
+            if inspect.isawaitable(result):
+                # Async clients can't be awaited without their event loop; their sockets close with the process.
+                result.close()
+
+    async def aclose(self):
+        for client in self._pop_all():
+            close = getattr(client, "close", None)
+            if close is None:
+                continue
+            result = close()
+            if inspect.isawaitable(result):
+                await result
+
+    def __len__(self):
+        return len(self._clients)
+
+
+client_pool = ClientPool()
+atexit.register(client_pool.close)
@@ -0,0 +1,157 @@
+import re
+from enum import Enum
+
+from History import History, Role
+from Observations import is_diff, parse_observation
+
+COMPACTABLE_PREFIXES = ("BASH OUTPUT:", "BASH ERROR:", "JOB OUTPUT:", "JOB ERROR:")
+# The outputs of several commands called in one response are joined under labels (templates.COMMAND_OUTPUT_LABEL),
+# and each labelled output is compacted on its own.
+COMBINED_OUTPUT_PREFIX = "[Output of command "
+COMBINED_OUTPUT_LABEL = re.compile(r"^(\[Output of command \d+ of \d+: .*\])\n", re.MULTILINE)
+
+
+class CompactionMode(str, Enum):
+    truncate = "truncate"  # Keep the head and tail of old outputs.
+    placeholder = "placeholder"  # Replace old outputs with a one-line placeholder.
+
+
+def estimate_tokens(text: str) -> int:
+    # Roughly four characters per token for English and code, plus per-message overhead.
+    return len(text) // 4 + 4
+
+
+class ContextWindow:
+    """Keeps the history sent to the model within a token budget by compacting old bash outputs.
+
+    The system message, the task and the most recent messages are always sent whole. Compaction only ever
+    rewrites message contents, or drops whole assistant/user pairs as a last resort, so the role order that
+    History.add enforces is kept. Compacted contents are remembered so the prompt prefix stays byte-stable
+    between compactions, which keeps provider prompt caching effective.
+
+    With collapse_observations, every browser page observation is collapsed to a one-line reference as soon as
+    a later full observation supersedes it. Observations sent as diffs stay until their chain is superseded too.
+    """
+
+    def __init__(
+        self,
+        token_budget: int | None,
+        keep_recent: int = 6,
+        mode: CompactionMode = CompactionMode.truncate,
+        truncate_chars: int = 1000,
+        compact_to: float = 0.75,
+        collapse_observations: bool = False,
+    ):
+        self.token_budget = token_budget
+        self.keep_recent = keep_recent
+        self.mode = mode
+        self.truncate_chars = truncate_chars
+        self.compact_to = compact_to
+        self.collapse_observations = collapse_observations
+        self.compacted: dict[int, str] = {}
+        self.token_counts: list[int] = []
+        self.total_tokens = 0
+        # Messages from 2 (after the system prompt and task) up to dropped_until are left out.
+        self.dropped_until = 2
+        # Observations that a later full observation has not yet superseded.
+        self.live_observations: list[int] = []
+
+    def render(self, history: History) -> History:
+        if self.token_budget is None and not self.collapse_observations:
+            return history
+
+        for index in range(len(self.token_counts), len(history)):
+            tokens = estimate_tokens(history[index]["content"])
+            self.token_counts.append(tokens)
+            self.total_tokens += tokens
+            if self.collapse_observations:
+                self._collapse_observations(history, index)
+
+        if self.token_budget is not None and self.total_tokens > self.token_budget:
+            # Compact well below the budget so that the prefix is not rewritten again on the very next turn.
+            target = int(self.token_budget * self.compact_to)
+            self._compact_outputs(history, target)
+            self._drop_oldest_turns(history, target)
+
+        messages = []
+        for index in [*range(min(2, len(history))), *range(self.dropped_until, len(history))]:
+            message = history[index]
+            content = self.compacted.get(index)
+            messages.append(message if content is None else {"role": message["role"], "content": content})
+        return History.from_messages(messages)
+
+    def _collapse_observations(self, history: History, index: int):
+        message = history[index]
+        observation = parse_observation(message["content"]) if message["role"] == Role.user else None
+        if observation is None:
+            return
+
+        if not is_diff(observation[1]):
+            for earlier in self.live_observations:
+                if earlier >= self.dropped_until:
+                    self._replace(earlier, self.reference(history[earlier]["content"]))
+            self.live_observations.clear()
+        self.live_observations.append(index)
+
+    def _replace(self, index: int, content: str):
+        tokens = estimate_tokens(content)
+        self.compacted[index] = content
+        self.total_tokens -= self.token_counts[index] - tokens
+        self.token_counts[index] = tokens
+
+    def _compactable(self, history: History) -> range:
+        return range(self.dropped_until, max(self.dropped_until, len(history) - self.keep_recent))
+
+    def _compact_outputs(self, history: History, target: int):
+        for index in self._compactable(history):
+            if self.total_tokens <= target:
+                return
+
+            message = history[index]
+            if index in self.compacted or message["role"] != Role.user:
+                continue
+            if not message["content"].startswith((*COMPACTABLE_PREFIXES, COMBINED_OUTPUT_PREFIX)):
+                continue
+
+            compacted = self.compact(message["content"])
+            if estimate_tokens(compacted) < self.token_counts[index]:
+                self._replace(index, compacted)
+
+    def _drop_oldest_turns(self, history: History, target: int):
+        compactable = self._compactable(history)
+        while self.total_tokens > target and self.dropped_until + 1 < compactable.stop:
+            for index in (self.dropped_until, self.dropped_until + 1):
+                self.total_tokens -= self.token_counts[index]
+                self.compacted.pop(index, None)
+            self.dropped_until += 2
+
+    def compact(self, content: str) -> str:
+        if not content.startswith(COMBINED_OUTPUT_PREFIX):
+            return self.compact_output(content)
+        # Split into "", label, output, label, output, ...
+        parts = COMBINED_OUTPUT_LABEL.split(content)
+        sections = []
+        for label, output in zip(parts[1::2], parts[2::2]):
+            output = output.rstrip("\n")
+            if output.startswith(COMPACTABLE_PREFIXES):
+                output = self.compact_output(output)
+            sections.append(f"{label}\n{output}")
+        return "\n\n".join(sections)
+
+    def compact_output(self, content: str) -> str:
+        header, _, body = content.partition("\n")
+        line_count = body.count("\n") + 1
+        if self.mode == CompactionMode.placeholder:
+            return f"{header}\n[Output of an earlier command elided to save context ({line_count} lines).]"
+
+        half = self.truncate_chars // 2
+        if len(body) <= self.truncate_chars:
+            return content
+        marker = f"[... {len(body) - 2 * half} characters of an earlier output elided to save context ...]"
+        return f"{header}\n{body[:half]}\n{marker}\n{body[-half:]}"
+
+    @staticmethod
+    def reference(content: str) -> str:
+        url, body = parse_observation(content)
+        line_count = body.count("\n") + 1
+        return f"BASH OUTPUT:\n[Observation of {url} ({line_count} lines) elided; a later observation supersedes it.]"
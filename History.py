@@ -1,5 +1,7 @@
 import json
+import os
 from enum import Enum
+from typing import Any, TextIO
 
 from Logger import logger
 
@@ -10,10 +12,19 @@ class Role(str, Enum):
     system = "system"
 
 
+class FsyncPolicy(str, Enum):
+    never = "never"  # Leave flushing to disk to the OS.
+    turn = "turn"  # fsync after every model response, which is what costs money to regenerate.
+    always = "always"  # fsync after every message and event.
+
+
 # TODO: Add enum for roles
 class History:
     def __init__(self):
         self.logs: list[dict[str, str]] = []
+        self.turn = 0
+        self.journal: TextIO | None = None
+        self.fsync = FsyncPolicy.turn
 
     def add(self, role: Role, content: str):
         # anthropic has stricter requirements for the first message, so we need to check that the first message is always the system message
@@ -32,12 +43,69 @@ class History:
             case _:
                 pass
             
+        if role == Role.assistant:
+            self.turn += 1
         self.logs.append({"role": role, "content": content})
         self.log_msg(role, content)
+        self._write_journal({"role": role, "content": content}, sync=role == Role.assistant)
+
+    def open_journal(self, path: str, fsync: FsyncPolicy = FsyncPolicy.turn, resume: bool = False):
+        """Appends every later message to a JSONL journal. A fresh journal replaces any existing file."""
+        if resume and os.path.exists(path):
+            # Drop a last line cut short by a crash so that new records start on a line of their own.
+            with open(path, "rb+") as f:
+                f.truncate(f.read().rfind(b"\n") + 1)
+        self.journal = open(path, "a" if resume else "w")
+        self.fsync = fsync
+
+    def add_event(self, event: str, **data: Any):
+        """Records agent state that is not a message, such as a submission, in the journal."""
+        self._write_journal({"event": event, **data}, sync=True)
+
+    def _write_journal(self, record: dict[str, Any], sync: bool):
+        if self.journal is None:
+            return
+        self.journal.write(json.dumps(record) + "\n")
+        self.journal.flush()
+        if self.fsync == FsyncPolicy.always or (sync and self.fsync == FsyncPolicy.turn):
+            os.fsync(self.journal.fileno())
+
+    def close_journal(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    @staticmethod
+    def read_journal(path: str) -> tuple[list[dict[str, str]], list[dict[str, Any]]]:
+        """Returns the messages and events in a journal, ignoring a last line cut short by a crash."""
+        messages, events = [], []
+        with open(path) as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                record = json.loads(line)
+                if "event" in record:
+                    events.append(record)
+                else:
+                    messages.append({"role": Role(record["role"]), "content": record["content"]})
+        return messages, events
+
+    @classmethod
+    def from_journal(cls, path: str) -> tuple["History", list[dict[str, Any]]]:
+        messages, events = cls.read_journal(path)
+        history = cls.from_messages(messages)
+        history.turn = sum(1 for message in messages if message["role"] == Role.assistant)
+        return history, events
+
+    @classmethod
+    def from_messages(cls, messages: list[dict[str, str]]) -> "History":
+        """Wraps already-validated messages without re-checking or re-logging them."""
+        history = cls()
+        history.logs = messages
+        return history
 
     def log_msg(self, role: Role, content: str):
-        logger.info(f"===={role.upper()}====")
-        logger.info(content + "\n\n\n")
+        logger.info(content, extra={"role": role.value, "turn": self.turn})
 
     def save(self, path: str):
         with open(path, "w") as f:
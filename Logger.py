@@ -1,23 +1,183 @@
+import atexit
+import contextlib
+import json
 import logging
+import logging.handlers
+import queue
+import threading
+from collections.abc import Iterator
+from contextvars import ContextVar
+from dataclasses import dataclass
+from enum import Enum
 
+# The run a record belongs to. Set per thread or asyncio task, so that concurrent agents can share one logger.
+run_id_var: ContextVar[str | None] = ContextVar("run_id", default=None)
 
-def get_logger(log_file="history.log", log_name="ProjectLogger", log_level=logging.DEBUG):
-    logger = logging.getLogger(log_name)
-    logger.setLevel(log_level)
 
-    # Create file handler which logs even debug messages
-    fh = logging.FileHandler(log_file)
-    fh.setLevel(log_level)
+class LogFormat(str, Enum):
+    text = "text"  # The human-readable ====ROLE==== transcript.
+    jsonl = "jsonl"  # One JSON record per line.
 
-    # Create console handler with a higher log level
-    ch = logging.StreamHandler()
-    ch.setLevel(log_level)
 
-    # Add the handlers to the logger
-    logger.addHandler(fh)
-    logger.addHandler(ch)
+class LogDetail(str, Enum):
+    full = "full"  # Log message bodies.
+    metadata = "metadata"  # Log only the run, turn, role and size of each message.
 
-    return logger
 
+@dataclass(frozen=True)
+class LogArguments:
+    log_path: str = "history.log"  # The file to log to.
+    log_format: LogFormat = LogFormat.jsonl  # The format of the log file.
+    log_detail: LogDetail = LogDetail.full  # Whether message bodies are logged.
+    log_to_console: bool = True  # Whether to also log the transcript to the console.
 
-logger = get_logger()
+
+class RunContextFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "run_id", None) is None:
+            record.run_id = run_id_var.get()
+        return True
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self, detail: LogDetail):
+        super().__init__()
+        self.detail = detail
+
+    def format(self, record: logging.LogRecord) -> str:
+        role = getattr(record, "role", None)
+        if role is None:
+            return super().format(record)
+        body = record.getMessage()
+        if self.detail == LogDetail.metadata:
+            body = f"[{len(body)} characters]"
+        return f"===={role.upper()}====\n{body}\n\n\n"
+
+
+class JsonlFormatter(logging.Formatter):
+    def __init__(self, detail: LogDetail):
+        super().__init__()
+        self.detail = detail
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = record.getMessage()
+        data = {
+            "time": record.created,
+            "level": record.levelname,
+            "run_id": getattr(record, "run_id", None),
+            "turn": getattr(record, "turn", None),
+            "role": getattr(record, "role", None),
+            "chars": len(message),
+        }
+        if self.detail == LogDetail.full or data["role"] is None:
+            data["message"] = message
+        return json.dumps(data)
+
+
+class RunRouter(logging.Handler):
+    """Sends each record to the file of its run, or to the default file for records outside any routed run."""
+
+    def __init__(self, default: logging.Handler, formatter: logging.Formatter):
+        super().__init__()
+        self.default = default
+        self.formatter_for_runs = formatter
+        self.routes: dict[str, logging.Handler] = {}
+        self.routes_lock = threading.Lock()
+
+    def add_route(self, run_id: str, path: str):
+        handler = logging.FileHandler(path)
+        handler.setFormatter(self.formatter_for_runs)
+        with self.routes_lock:
+            self.routes[run_id] = handler
+
+    def remove_route(self, run_id: str):
+        with self.routes_lock:
+            handler = self.routes.pop(run_id, None)
+        if handler is not None:
+            handler.close()
+
+    def emit(self, record: logging.LogRecord):
+        run_id = getattr(record, "run_id", None)
+        with self.routes_lock:
+            handler = self.routes.get(run_id, self.default)
+        handler.handle(record)
+        # The route is closed by a record sent through the queue, so every earlier record of the run lands in it.
+        if getattr(record, "close_route", False):
+            self.remove_route(run_id)
+
+    def close(self):
+        with self.routes_lock:
+            handlers = [self.default, *self.routes.values()]
+            self.routes.clear()
+        for handler in handlers:
+            handler.close()
+        super().close()
+
+
+logger = logging.getLogger("ProjectLogger")
+logger.setLevel(logging.DEBUG)
+logger.addFilter(RunContextFilter())
+
+_listener: logging.handlers.QueueListener | None = None
+_router: RunRouter | None = None
+
+
+def setup_logging(args: LogArguments):
+    """Starts the background listener that writes log records, replacing any previous one.
+
+    Records are put on a queue by the agents and written by a single listener thread, so logging never blocks
+    the agent loop on file or terminal I/O.
+    """
+    global _listener, _router
+    shutdown_logging()
+
+    if args.log_format == LogFormat.jsonl:
+        formatter: logging.Formatter = JsonlFormatter(args.log_detail)
+    else:
+        formatter = TextFormatter(args.log_detail)
+    file_handler = logging.FileHandler(args.log_path)
+    file_handler.setFormatter(formatter)
+    _router = RunRouter(file_handler, formatter)
+
+    handlers: list[logging.Handler] = [_router]
+    if args.log_to_console:
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(TextFormatter(args.log_detail))
+        handlers.append(console_handler)
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+
+def shutdown_logging():
+    """Flushes every queued record and stops the listener."""
+    global _listener, _router
+    for handler in list(logger.handlers):
+        if isinstance(handler, logging.handlers.QueueHandler):
+            logger.removeHandler(handler)
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+    _listener = None
+    _router = None
+
+
+@contextlib.contextmanager
+def log_run(run_id: str, log_path: str | None = None) -> Iterator[None]:
+    """Tags every record logged inside the block with the run ID, and optionally routes them to their own file."""
+    token = run_id_var.set(run_id)
+    routed = log_path is not None and _router is not None
+    if routed:
+        _router.add_route(run_id, log_path)
+    try:
+        yield
+    finally:
+        if routed:
+            logger.debug("Run finished.", extra={"close_route": True})
+        run_id_var.reset(token)
+
+
+atexit.register(shutdown_logging)
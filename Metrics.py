@@ -0,0 +1,238 @@
+import contextlib
+import importlib
+import json
+import threading
+import time
+from collections import defaultdict
+from collections.abc import Iterator
+from dataclasses import asdict, dataclass
+from typing import Any, TextIO
+
+from APIModel import APIModel, ModelName, Usage
+from AsyncAPIModel import AsyncAPIModel
+from Logger import run_id_var
+
+
+@dataclass(frozen=True)
+class ModelPrice:
+    # USD per million tokens.
+    input: float
+    output: float
+    cached_input: float | None = None  # Defaults to the input price.
+    cache_write: float | None = None  # Defaults to the input price.
+
+
+# Approximate list prices; update them as providers change theirs.
+MODEL_PRICES: dict[ModelName, ModelPrice] = {
+    ModelName.gpt_4o_mini: ModelPrice(0.15, 0.60, cached_input=0.075),
+    ModelName.gpt_4o: ModelPrice(2.50, 10.00, cached_input=1.25),
+    ModelName.claude3_haiku: ModelPrice(0.25, 1.25, cached_input=0.03, cache_write=0.30),
+    ModelName.claude3_sonnet: ModelPrice(3.00, 15.00, cached_input=0.30, cache_write=3.75),
+    ModelName.claude3_opus: ModelPrice(15.00, 75.00, cached_input=1.50, cache_write=18.75),
+    ModelName.claude3_5_sonnet: ModelPrice(3.00, 15.00, cached_input=0.30, cache_write=3.75),
+    ModelName.llama3_1_405b: ModelPrice(3.00, 3.00),
+    ModelName.llama3_1_70b: ModelPrice(0.88, 0.88),
+    ModelName.llama3_1_8b: ModelPrice(0.18, 0.18),
+    ModelName.llama2_7b: ModelPrice(0.20, 0.20),
+    ModelName.llama2_13b: ModelPrice(0.22, 0.22),
+    ModelName.llama2_70b: ModelPrice(0.90, 0.90),
+    ModelName.llama3_1_405b_together: ModelPrice(3.50, 3.50),
+    ModelName.gemma2_27b: ModelPrice(0.80, 0.80),
+    ModelName.gemma_7b: ModelPrice(0.20, 0.20),
+    ModelName.qwen1_5_72b: ModelPrice(0.90, 0.90),
+    ModelName.qwen1_5_32b: ModelPrice(0.80, 0.80),
+    ModelName.qwen1_5_14b: ModelPrice(0.30, 0.30),
+    ModelName.qwen1_5_7b: ModelPrice(0.20, 0.20),
+    ModelName.qwen1_5_4b: ModelPrice(0.10, 0.10),
+}
+
+
+def estimate_cost(model: ModelName, usage: Usage) -> float | None:
+    """Returns the estimated cost of the usage in USD, or None if the model has no known price."""
+    price = MODEL_PRICES.get(model)
+    if price is None:
+        return None
+    cached_input = price.input if price.cached_input is None else price.cached_input
+    cache_write = price.input if price.cache_write is None else price.cache_write
+    uncached = usage.prompt_tokens - usage.cached_tokens - usage.cache_write_tokens
+    return (
+        uncached * price.input
+        + usage.cached_tokens * cached_input
+        + usage.cache_write_tokens * cache_write
+        + usage.completion_tokens * price.output
+    ) / 1e6
+
+
+class MetricsExporter:
+    """Receives every turn record as it is written, e.g. to forward it to Prometheus or OpenTelemetry."""
+
+    def export(self, record: dict[str, Any]):
+        pass
+
+
+class PrometheusExporter(MetricsExporter):
+    """Exposes span durations, tokens and cost as Prometheus metrics, optionally serving them on a port."""
+
+    def __init__(self, port: int | None = None):
+        import prometheus_client
+
+        self.spans = prometheus_client.Histogram(
+            "agent_span_seconds", "Time spent in each part of a turn.", ["span", "model"]
+        )
+        self.tokens = prometheus_client.Counter("agent_tokens", "Tokens used by the model.", ["kind", "model"])
+        self.cost = prometheus_client.Counter("agent_cost_usd", "Estimated model cost in USD.", ["model"])
+        self.turns = prometheus_client.Counter(
+            "agent_turns", "Completed turns.", ["model", "stop_reason", "tool_mode", "wasted"]
+        )
+        if port is not None:
+            prometheus_client.start_http_server(port)
+
+    def export(self, record: dict[str, Any]):
+        model = record["model"]
+        for span in record["spans"]:
+            self.spans.labels(span["name"], model).observe(span["seconds"])
+        for kind, tokens in record["usage"].items():
+            self.tokens.labels(kind, model).inc(tokens)
+        if record["cost"] is not None:
+            self.cost.labels(model).inc(record["cost"])
+        self.turns.labels(model, str(record["stop_reason"]), record["tool_mode"], str(record["wasted"])).inc()
+
+
+_exporters: dict[str, MetricsExporter] = {}
+_exporters_lock = threading.Lock()
+
+
+def get_exporter(spec: str | None) -> MetricsExporter | None:
+    """Builds the exporter named by spec once per process, so that agents sharing a process share its metrics.
+
+    spec is "prometheus", "prometheus:PORT", or "module:factory" for a callable returning a MetricsExporter.
+    """
+    if spec is None:
+        return None
+    with _exporters_lock:
+        if spec not in _exporters:
+            name, _, argument = spec.partition(":")
+            if name == "prometheus":
+                _exporters[spec] = PrometheusExporter(int(argument) if argument else None)
+            else:
+                _exporters[spec] = getattr(importlib.import_module(name), argument)()
+        return _exporters[spec]
+
+
+class RunMetrics:
+    """Times the parts of every turn and records the model's token usage, stop reason and estimated cost.
+
+    Each turn is written as one JSON line to the metrics file, if one is open, and passed to the exporter.
+    """
+
+    def __init__(self, model: APIModel | AsyncAPIModel, tool_mode: str = "xml"):
+        self.model = model
+        self.tool_mode = tool_mode  # How commands are called: "xml" tags only, or "native" tools as well.
+        self.file: TextIO | None = None
+        self.exporter: MetricsExporter | None = None
+        self.turns = 0
+        self.turns_before = 0  # The turns of the run that an earlier process already recorded.
+        self.turn_spans: list[dict[str, Any]] = []
+        self.span_totals: dict[str, float] = defaultdict(float)
+        self.wall_time = 0.0
+        self.cost: float | None = None
+        self.turn_wasted: str | None = None
+        self.wasted_turns: dict[str, int] = defaultdict(int)
+
+    def open(
+        self, path: str | None, exporter: MetricsExporter | None = None, resume: bool = False, turns_before: int = 0
+    ):
+        """Opens the metrics file, appending to it when resuming a run whose first turns_before turns it holds."""
+        self.turns_before = turns_before if resume else 0
+        if path is not None:
+            self.file = open(path, "a" if resume else "w")
+        self.exporter = exporter
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.turn_spans.append({"name": name, "seconds": seconds, **attributes})
+            self.span_totals[name] += seconds
+
+    def waste_turn(self, reason: str):
+        """Marks the current turn as wasted, e.g. because the response called no valid command."""
+        self.turn_wasted = reason
+
+    @contextlib.contextmanager
+    def turn(self) -> Iterator[None]:
+        self.turn_spans = []
+        self.turn_wasted = None
+        usage_before = Usage(**asdict(self.model.usage))
+        model_usage_before = {model: Usage(**asdict(usage)) for model, usage in self.model.usage_by_model.items()}
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            model_usage = {
+                model: usage - model_usage_before.get(model, Usage())
+                for model, usage in self.model.usage_by_model.items()
+            }
+            self._end_turn(time.perf_counter() - start, self.model.usage - usage_before, model_usage)
+
+    def _end_turn(self, seconds: float, usage: Usage, model_usage: dict[ModelName, Usage]):
+        self.turns += 1
+        self.wall_time += seconds
+        # A turn served by the fallback model is priced and labelled as that model.
+        model_usage = {model: usage for model, usage in model_usage.items() if usage != Usage()}
+        served_by = max(model_usage, key=lambda model: model_usage[model].prompt_tokens, default=self.model.model)
+        costs = [estimate_cost(model, usage) for model, usage in (model_usage or {served_by: usage}).items()]
+        cost = None if None in costs else sum(costs)
+        if cost is not None:
+            self.cost = (self.cost or 0.0) + cost
+        if self.turn_wasted is not None:
+            self.wasted_turns[self.turn_wasted] += 1
+
+        record = {
+            "time": time.time(),
+            "run_id": run_id_var.get(),
+            "turn": self.turns_before + self.turns,
+            "model": served_by.value,
+            "seconds": seconds,
+            "spans": self.turn_spans,
+            "usage": asdict(usage),
+            "stop_reason": self.model.last_stop_reason,
+            "cost": cost,
+            "tool_mode": self.tool_mode,
+            "wasted": self.turn_wasted,
+        }
+        if self.file is not None:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+        if self.exporter is not None:
+            self.exporter.export(record)
+
+    def summary(self) -> str:
+        if not self.turns:
+            return "No turns were run."
+        lines = [f"turns={self.turns} wall={self.wall_time:.2f}s"]
+        accounted = 0.0
+        for name, seconds in sorted(self.span_totals.items(), key=lambda item: -item[1]):
+            accounted += seconds
+            lines.append(
+                f"{name}: {seconds:.2f}s total, {seconds / self.turns * 1e3:.1f}ms per turn, "
+                f"{seconds / self.wall_time:.1%} of wall time"
+            )
+        lines.append(f"scaffold (outside spans): {max(0.0, self.wall_time - accounted):.2f}s")
+        wasted = sum(self.wasted_turns.values())
+        reasons = ", ".join(f"{reason}={count}" for reason, count in sorted(self.wasted_turns.items()))
+        lines.append(
+            f"wasted turns ({self.tool_mode} tools): {wasted} of {self.turns} ({wasted / self.turns:.1%})"
+            + (f", {reasons}" if reasons else "")
+        )
+        lines.append(f"usage: {self.model.usage}")
+        lines.append("cost: unknown" if self.cost is None else f"cost: ${self.cost:.4f} (estimated)")
+        return "\n".join(lines)
@@ -0,0 +1,71 @@
+import difflib
+import re
+
+OBSERVATION_PREFIX = "BASH OUTPUT:\nViewing URL: "
+DIFF_HEADER = "[Same page as the previous observation"
+ELEMENT_ID = re.compile(r"\((\d+)\)")
+
+
+def parse_observation(content: str) -> tuple[str, str] | None:
+    """Returns the URL and page body of a browse-* command's output, or None for any other output."""
+    if not content.startswith(OBSERVATION_PREFIX):
+        return None
+    url, _, body = content[len(OBSERVATION_PREFIX) :].partition("\n")
+    return url, body
+
+
+def is_diff(body: str) -> bool:
+    return body.startswith(DIFF_HEADER)
+
+
+class ObservationCompactor:
+    """Sends a page observation as the lines that changed since the previous observation of the same URL.
+
+    Scrolling, typing and clicking mostly return the page that was just observed, so only the changed lines
+    are sent, and removed lines are summarised by the element IDs they contained. The full page of the last
+    observation is remembered so that each diff is taken against what the model has already seen.
+    """
+
+    def __init__(self, min_unchanged: float = 0.5):
+        self.min_unchanged = min_unchanged
+        self.previous: tuple[str, list[str]] | None = None
+
+    def compact(self, output: str) -> str:
+        observation = parse_observation(output)
+        if observation is None:
+            return output
+
+        url, body = observation
+        lines = body.split("\n")
+        previous, self.previous = self.previous, (url, lines)
+        if previous is None or previous[0] != url:
+            return output
+
+        diff = self.diff(previous[1], lines)
+        if diff is None:
+            return output
+        compacted = f"{OBSERVATION_PREFIX}{url}\n{diff}"
+        return compacted if len(compacted) < len(output) else output
+
+    def diff(self, old: list[str], new: list[str]) -> str | None:
+        """Returns the changes from old to new, or None if too little is unchanged for a diff to help."""
+        matcher = difflib.SequenceMatcher(None, old, new, autojunk=False)
+        unchanged = sum(block.size for block in matcher.get_matching_blocks())
+        if unchanged < self.min_unchanged * len(new):
+            return None
+
+        changes = [f"{DIFF_HEADER}; {unchanged} unchanged lines are omitted and only changed lines are shown.]"]
+        for tag, old_start, old_end, new_start, new_end in matcher.get_opcodes():
+            if tag == "equal":
+                continue
+            if old_end > old_start:
+                changes.append(self._removed(old[old_start:old_end]))
+            changes.extend(new[new_start:new_end])
+        return "\n".join(changes)
+
+    @staticmethod
+    def _removed(lines: list[str]) -> str:
+        element_ids = [int(element_id) for line in lines for element_id in ELEMENT_ID.findall(line)]
+        if not element_ids:
+            return f"[{len(lines)} lines removed]"
+        return f"[{len(lines)} lines removed, with elements {min(element_ids)}-{max(element_ids)}]"
@@ -0,0 +1,170 @@
+import contextlib
+import datetime
+import fcntl
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections.abc import Iterator, Mapping
+from dataclasses import asdict, dataclass
+
+WINDOW = 60.0  # Provider limits are per minute, and a whole minute's budget may be used in a burst.
+
+# Response headers that carry the provider's limits, remaining budget and reset time, per dimension.
+LIMIT_HEADERS = {
+    "requests": (
+        ("x-ratelimit-limit-requests", "x-ratelimit-remaining-requests", "x-ratelimit-reset-requests"),
+        ("anthropic-ratelimit-requests-limit", "anthropic-ratelimit-requests-remaining",
+         "anthropic-ratelimit-requests-reset"),
+    ),
+    "tokens": (
+        ("x-ratelimit-limit-tokens", "x-ratelimit-remaining-tokens", "x-ratelimit-reset-tokens"),
+        ("anthropic-ratelimit-tokens-limit", "anthropic-ratelimit-tokens-remaining",
+         "anthropic-ratelimit-tokens-reset"),
+    ),
+}  # fmt: skip
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_UNITS = {"ms": 1e-3, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_reset(value: str, now: float) -> float | None:
+    """Returns the seconds until a limit resets, given as seconds, a duration such as "6m0s", or a timestamp."""
+    with contextlib.suppress(ValueError):
+        return float(value)
+    if parts := DURATION_PART.findall(value):
+        return sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+    with contextlib.suppress(ValueError):
+        return max(0.0, datetime.datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp() - now)
+    return None
+
+
+def rate_limit_scope(model: str, *credentials: str | None) -> str:
+    """Names the limit shared by every request for the model made with the same credentials and endpoint."""
+    digest = hashlib.sha256(json.dumps(credentials).encode()).hexdigest()[:12]
+    return f"{re.sub(r'[^A-Za-z0-9_.-]', '_', model)}-{digest}"
+
+
+@dataclass
+class RateState:
+    # Theoretical arrival times of the generic cell rate algorithm: a request can be sent once the time is
+    # within WINDOW of them. Each request moves them on by its share of the per-minute limit.
+    requests_tat: float = 0.0
+    tokens_tat: float = 0.0
+    requests_per_minute: float | None = None  # Learned from response headers.
+    tokens_per_minute: float | None = None
+    blocked_until: float = 0.0  # Set when the provider says the budget is used up, or answers 429.
+
+
+class RateLimiter:
+    """Client-side limits on requests and tokens per minute, shared by every thread and process on the host.
+
+    The state of each scope lives in a small JSON file that is read and updated under an exclusive flock, so
+    agents in separate processes draw on one budget. A query reserves its slot first and then sleeps until the
+    slot comes, which serves waiting callers in the order they asked instead of failing them. The limits are
+    the configured ones or those learned from the provider's rate limit headers, whichever is lower, and the
+    state is pulled back in line with the provider's own count of the remaining budget.
+    """
+
+    def __init__(
+        self, directory: str, requests_per_minute: float | None = None, tokens_per_minute: float | None = None
+    ):
+        self.directory = directory
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        os.makedirs(directory, exist_ok=True)
+
+    @contextlib.contextmanager
+    def _state(self, scope: str) -> Iterator[RateState]:
+        with open(os.path.join(self.directory, f"{scope}.json"), "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    state = RateState(**json.loads(f.read()))
+                except (json.JSONDecodeError, TypeError):
+                    state = RateState()
+                yield state
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(asdict(state)))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _lowest(configured: float | None, learned: float | None) -> float | None:
+        limits = [limit for limit in (configured, learned) if limit]
+        return min(limits) if limits else None
+
+    def reserve(self, scope: str, tokens: int) -> float:
+        """Takes the next free slot for a request of about this many tokens, returning the seconds until it."""
+        now = time.time()
+        with self._state(scope) as state:
+            wait = max(0.0, state.blocked_until - now)
+            if requests_per_minute := self._lowest(self.requests_per_minute, state.requests_per_minute):
+                state.requests_tat = max(state.requests_tat, now) + WINDOW / requests_per_minute
+                wait = max(wait, state.requests_tat - WINDOW - now)
+            if tokens_per_minute := self._lowest(self.tokens_per_minute, state.tokens_per_minute):
+                # A request larger than the whole limit still goes through, once the bucket is empty.
+                cost = min(tokens, tokens_per_minute)
+                state.tokens_tat = max(state.tokens_tat, now) + cost * WINDOW / tokens_per_minute
+                wait = max(wait, state.tokens_tat - WINDOW - now)
+        return wait
+
+    def acquire(self, scope: str, tokens: int):
+        if (wait := self.reserve(scope, tokens)) > 0:
+            time.sleep(wait)
+
+    def settle(self, scope: str, estimated: int, actual: int):
+        """Corrects a reservation once the request's real token count is known, returning unused tokens."""
+        with self._state(scope) as state:
+            if tokens_per_minute := self._lowest(self.tokens_per_minute, state.tokens_per_minute):
+                state.tokens_tat += (actual - estimated) * WINDOW / tokens_per_minute
+
+    def block(self, scope: str, seconds: float):
+        """Holds back every request in the scope, e.g. after a 429 with Retry-After."""
+        with self._state(scope) as state:
+            state.blocked_until = max(state.blocked_until, time.time() + seconds)
+
+    def observe(self, scope: str, headers: Mapping[str, str]):
+        """Learns the limits from a response's headers and catches up with the provider's remaining budget."""
+        now = time.time()
+        observed = {}
+        for dimension, header_sets in LIMIT_HEADERS.items():
+            for limit_header, remaining_header, reset_header in header_sets:
+                if limit_header in headers:
+                    remaining, reset = headers.get(remaining_header), headers.get(reset_header)
+                    observed[dimension] = (headers[limit_header], remaining, reset)
+                    break
+        if not observed:
+            return
+
+        with self._state(scope) as state:
+            for dimension, (limit, remaining, reset) in observed.items():
+                with contextlib.suppress(ValueError):
+                    limit = float(limit)
+                    setattr(state, f"{dimension}_per_minute", limit)
+                    if remaining is None:
+                        continue
+                    remaining = float(remaining)
+                    # The provider has room for `remaining` more, so the next slot is at least that far along.
+                    tat = f"{dimension}_tat"
+                    setattr(state, tat, max(getattr(state, tat), now + WINDOW - remaining * WINDOW / limit))
+                    if remaining < 1 and reset is not None and (seconds := parse_reset(reset, now)) is not None:
+                        state.blocked_until = max(state.blocked_until, now + seconds)
+
+
+_limiters: dict[tuple, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(
+    directory: str, requests_per_minute: float | None = None, tokens_per_minute: float | None = None
+) -> RateLimiter:
+    key = (os.path.abspath(directory), requests_per_minute, tokens_per_minute)
+    with _limiters_lock:
+        if key not in _limiters:
+            _limiters[key] = RateLimiter(directory, requests_per_minute, tokens_per_minute)
+        return _limiters[key]
@@ -0,0 +1,54 @@
+import hashlib
+import json
+import sqlite3
+import threading
+from enum import Enum
+from typing import Any
+
+
+class CacheMode(str, Enum):
+    off = "off"  # Always query the provider.
+    record = "record"  # Always query the provider and store every response.
+    replay = "replay"  # Only answer from the cache, failing on a miss.
+    read_through = "read_through"  # Answer from the cache, querying and storing on a miss.
+
+
+class CacheMissError(Exception):
+    pass
+
+
+class ResponseCache:
+    """Stores model responses in a local SQLite file, keyed by a hash of everything that determines them."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, request TEXT, response TEXT, tool_calls TEXT)"
+        )
+        if "tool_calls" not in {row[1] for row in self._conn.execute("PRAGMA table_info(responses)")}:
+            # Caches recorded before tool calls were stored alongside the response text.
+            self._conn.execute("ALTER TABLE responses ADD COLUMN tool_calls TEXT")
+
+    @staticmethod
+    def make_key(request: dict[str, Any]) -> str:
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key: str) -> tuple[str, list[dict[str, Any]]] | None:
+        """Returns the response text and its native tool calls, if the key is cached."""
+        with self._lock:
+            row = self._conn.execute("SELECT response, tool_calls FROM responses WHERE key = ?", (key,)).fetchone()
+        return None if row is None else (row[0], json.loads(row[1]) if row[1] else [])
+
+    def put(self, key: str, request: dict[str, Any], response: str, tool_calls: list[dict[str, Any]] | None = None):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, request, response, tool_calls) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(request), response, json.dumps(tool_calls) if tool_calls else None),
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,201 @@
+import asyncio
+import json
+import multiprocessing.util
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from enum import Enum
+
+from Agent import Agent, AgentArguments, AsyncAgent
+from ClientPool import client_pool
+from commands import close_browsers
+from Logger import LogArguments, log_run, logger, setup_logging, shutdown_logging
+from main import ScriptArguments, initialize_agent
+from simple_parsing import parse
+from simple_parsing.helpers import FlattenedAccess, FrozenSerializable
+
+
+class ExecutorKind(str, Enum):
+    thread = "thread"
+    process = "process"
+    asyncio = "asyncio"
+
+
+@dataclass(frozen=True)
+class BatchArguments(FlattenedAccess, FrozenSerializable):
+    agent: AgentArguments
+    tasks_path: str  # JSONL file with one task per line, e.g. {"id": "task-1", "instructions": "..."}.
+    output_dir: str = "batch_runs"  # Each task gets its own directory under here.
+    results_path: str | None = None  # Aggregated results. Defaults to OUTPUT_DIR/results.jsonl.
+    workers: int = 4  # The number of tasks to run concurrently.
+    executor: ExecutorKind = ExecutorKind.thread  # How tasks are run. asyncio runs AsyncAgents on one loop.
+    show_demonstration: bool = True  # Whether to show the demonstration.
+    log: LogArguments = field(default_factory=LogArguments)  # Each task also gets its own log file.
+    metrics_exporter: str | None = None  # "prometheus", "prometheus:PORT" or "module:factory" to export metrics.
+
+
+def load_tasks(path: str) -> list[dict]:
+    tasks = []
+    with open(path) as f:
+        for line_num, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            task = json.loads(line)
+            task.setdefault("id", str(line_num))
+            task["id"] = str(task["id"])
+            tasks.append(task)
+    return tasks
+
+
+def load_completed(results_path: str) -> set[str]:
+    """Returns the ids of tasks whose latest result has no error. Failed tasks are rerun from their journal."""
+    if not os.path.exists(results_path):
+        return set()
+
+    errors: dict[str, str | None] = {}
+    with open(results_path) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+                errors[result["id"]] = result.get("error")
+            except (json.JSONDecodeError, KeyError, TypeError):
+                # A line cut short by a crash is simply rerun.
+                continue
+    return {task_id for task_id, error in errors.items() if error is None}
+
+
+def task_arguments(args: BatchArguments, task: dict) -> ScriptArguments:
+    task_dir = os.path.abspath(os.path.join(args.output_dir, task["id"]))
+    working_dir = os.path.join(task_dir, "workdir")
+    os.makedirs(working_dir, exist_ok=True)
+    return ScriptArguments(
+        agent=args.agent,
+        instructions=task["instructions"],
+        submission_path=os.path.join(task_dir, "submission.txt"),
+        show_demonstration=args.show_demonstration,
+        history_path=os.path.join(task_dir, "history.json"),
+        working_dir=working_dir,
+        run_dir=task_dir,
+        run_id=task["id"],
+        log=args.log,
+        journal_path=os.path.join(task_dir, "journal.jsonl"),
+        metrics_path=os.path.join(task_dir, "metrics.jsonl"),
+        metrics_exporter=args.metrics_exporter,
+        # Tasks cut off by a crash carry on from their journal when the batch is restarted.
+        resume=True,
+    )
+
+
+def task_log_path(args: ScriptArguments) -> str:
+    return os.path.join(args.run_dir, "history.log")
+
+
+def agent_result(agent: Agent, args: ScriptArguments) -> dict:
+    result = {"submitted": agent.has_submitted, "messages_left": agent.message_left, "cost": agent.metrics.cost}
+    if agent.has_submitted:
+        with open(args.submission_path) as f:
+            result["submission"] = f.read()
+    return result
+
+
+def run_task(args: ScriptArguments, task_id: str) -> dict:
+    start = time.perf_counter()
+    result = {"id": task_id, "submitted": False, "submission": None, "error": None}
+    agent = None
+    with log_run(task_id, task_log_path(args)):
+        try:
+            agent = initialize_agent(args)
+            agent.loop()
+            agent.save_history(args.history_path)
+            result.update(agent_result(agent, args))
+        except Exception as e:
+            logger.error(f"Task {task_id} failed: {e}", exc_info=True)
+            result["error"] = f"{type(e).__name__}: {e}"
+        finally:
+            if agent is not None:
+                agent.close()
+    result["duration"] = time.perf_counter() - start
+    return result
+
+
+async def run_task_async(args: ScriptArguments, task_id: str) -> dict:
+    start = time.perf_counter()
+    result = {"id": task_id, "submitted": False, "submission": None, "error": None}
+    agent = None
+    with log_run(task_id, task_log_path(args)):
+        try:
+            agent = initialize_agent(args, AsyncAgent)
+            await agent.loop()
+            agent.save_history(args.history_path)
+            result.update(agent_result(agent, args))
+        except Exception as e:
+            logger.error(f"Task {task_id} failed: {e}", exc_info=True)
+            result["error"] = f"{type(e).__name__}: {e}"
+        finally:
+            if agent is not None:
+                agent.close()
+    result["duration"] = time.perf_counter() - start
+    return result
+
+
+def init_worker(log: LogArguments):
+    # Worker processes need their own logging listener; the parent's thread does not survive the fork.
+    setup_logging(log)
+    # Pool workers exit without running atexit handlers, so their browsers and log queue are cleaned up here.
+    multiprocessing.util.Finalize(None, close_browsers, exitpriority=10)
+    multiprocessing.util.Finalize(None, shutdown_logging, exitpriority=0)
+
+
+def make_executor(args: BatchArguments) -> Executor:
+    if args.executor == ExecutorKind.process:
+        return ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(args.log,))
+    return ThreadPoolExecutor(max_workers=args.workers)
+
+
+def run_pool(args: BatchArguments, jobs: list[tuple[ScriptArguments, str]], record):
+    with make_executor(args) as executor:
+        futures = [executor.submit(run_task, task_args, task_id) for task_args, task_id in jobs]
+        for future in as_completed(futures):
+            record(future.result())
+
+
+async def run_asyncio(args: BatchArguments, jobs: list[tuple[ScriptArguments, str]], record):
+    semaphore = asyncio.Semaphore(args.workers)
+
+    async def run_one(task_args: ScriptArguments, task_id: str):
+        async with semaphore:
+            record(await run_task_async(task_args, task_id))
+
+    try:
+        await asyncio.gather(*(run_one(task_args, task_id) for task_args, task_id in jobs))
+    finally:
+        await client_pool.aclose()
+
+
+def main(args: BatchArguments):
+    setup_logging(args.log)
+    results_path = args.results_path or os.path.join(args.output_dir, "results.jsonl")
+    os.makedirs(os.path.dirname(os.path.abspath(results_path)), exist_ok=True)
+
+    tasks = load_tasks(args.tasks_path)
+    completed = load_completed(results_path)
+    jobs = [(task_arguments(args, task), task["id"]) for task in tasks if task["id"] not in completed]
+    logger.info(f"====BATCH====\n{len(jobs)} tasks to run, {len(tasks) - len(jobs)} already completed.\n\n\n")
+
+    with open(results_path, "a") as results_file:
+
+        def record(result: dict):
+            # Results are only ever written from the main thread/process, one complete line at a time.
+            results_file.write(json.dumps(result) + "\n")
+            results_file.flush()
+            logger.info(f"====BATCH RESULT====\n{json.dumps(result)}\n\n\n")
+
+        if args.executor == ExecutorKind.asyncio:
+            asyncio.run(run_asyncio(args, jobs, record))
+        else:
+            run_pool(args, jobs, record)
+
+
+if __name__ == "__main__":
+    main(parse(BatchArguments))
@@ -0,0 +1,217 @@
+"""Measures the scaffold's own overhead by driving Agent.loop against the local mock LLM server.
+
+Each scenario runs in a fresh interpreter against scripted responses, so no API is called. Time spent waiting
+for the model is subtracted from the wall time, which leaves the turn loop, command parsing, command
+execution, logging and journaling. Results can be saved and compared against a run on another commit.
+
+Usage: python -m benchmarks.bench_agent [--scenario NAME ...] [--provider openai|anthropic] [--stream]
+                                        [--latency S] [--output FILE] [--compare FILE]
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections.abc import Callable
+from dataclasses import dataclass
+
+from benchmarks.mock_server import MockLLMServer
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROVIDER_MODELS = {
+    "openai": "gpt-4o-mini",
+    "anthropic": "claude-3-5-sonnet-20240620",
+}
+
+
+@dataclass(frozen=True)
+class Scenario:
+    description: str
+    turns: int  # Command turns before the final submission.
+    command: Callable[[int], str]  # The response for each turn.
+    setup: Callable[[str], None] = lambda working_dir: None
+
+
+def write_pages(working_dir: str):
+    # Browse dumps of one long page, each scrolled a little further, like repeated browse-scroll calls.
+    elements = [f"        ({i}) link: 'Section {i} of the article' [{'text ' * 12}]({i + 1})" for i in range(2000)]
+    for page in range(3):
+        window = elements[page * 100 : page * 100 + 600]
+        header = f"Viewing URL: https://example.com/article\n\nScroll percentage: {page * 5:.2f}%\n\nPage Content:\n"
+        with open(os.path.join(working_dir, f"page_{page}.txt"), "w") as f:
+            f.write(header + "\n".join(window) + "\n")
+
+
+SCENARIOS = {
+    "short_bash": Scenario("Many short bash calls.", 60, lambda turn: f"<bash>echo turn {turn}</bash>"),
+    "huge_output": Scenario("Bash calls that print megabytes.", 10, lambda turn: "<bash>seq 1 500000</bash>"),
+    "long_history": Scenario(
+        "Long responses that grow the history every turn.",
+        40,
+        lambda turn: "Let me think this through. " * 300 + f"<bash>echo {turn}</bash>",
+    ),
+    "browse_dumps": Scenario(
+        "Large page observations of the same URL.",
+        20,
+        lambda turn: f"<bash>cat page_{turn % 3}.txt</bash>",
+        write_pages,
+    ),
+}
+
+
+def run_scenario(name: str, provider: str, stream: bool, latency: float) -> dict:
+    """Runs one scenario in this interpreter. Only called in the child process started by measure()."""
+    from Agent import AgentArguments
+    from APIModel import ModelArguments, ModelName
+    from Logger import LogArguments, setup_logging
+    from main import ScriptArguments, initialize_agent
+
+    scenario = SCENARIOS[name]
+
+    def script(messages: list[dict[str, str]]) -> str:
+        turn = sum(message["role"] == "assistant" for message in messages)
+        return scenario.command(turn) if turn < scenario.turns else "<submit>done</submit>"
+
+    with tempfile.TemporaryDirectory() as run_dir, MockLLMServer(script, latency) as server:
+        scenario.setup(run_dir)
+        log = LogArguments(log_path=os.path.join(run_dir, "history.log"), log_to_console=False)
+        setup_logging(log)
+        base_url = server.url if provider == "anthropic" else server.openai_url
+        args = ScriptArguments(
+            agent=AgentArguments(
+                model=ModelArguments(
+                    model=ModelName(PROVIDER_MODELS[provider]),
+                    openai_api_key="mock",
+                    anthropic_api_key="mock",
+                    api_base_url=base_url,
+                ),
+                message_cap=scenario.turns + 1,
+                stream=stream,
+            ),
+            instructions="Run the scripted commands.",
+            submission_path=os.path.join(run_dir, "submission.txt"),
+            history_path=os.path.join(run_dir, "history.json"),
+            working_dir=run_dir,
+            run_dir=run_dir,
+            log=log,
+            journal_path=os.path.join(run_dir, "journal.jsonl"),
+            metrics_path=os.path.join(run_dir, "metrics.jsonl"),
+        )
+
+        agent = initialize_agent(args)
+        model_time = 0.0
+        query = agent._query
+
+        def timed_query() -> str:
+            nonlocal model_time
+            start = time.perf_counter()
+            try:
+                return query()
+            finally:
+                model_time += time.perf_counter() - start
+
+        agent._query = timed_query
+        start = time.perf_counter()
+        agent.loop()
+        loop_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        agent.save_history(args.history_path)
+        save_time = time.perf_counter() - start
+        agent.close()
+
+        turns = server.requests
+        prompt_chars = sum(len(message["content"]) for message in agent.context.render(agent.history))
+        return {
+            "scenario": name,
+            "turns": turns,
+            "submitted": agent.has_submitted,
+            "loop_s": loop_time,
+            "model_s": model_time,
+            "overhead_per_turn_ms": (loop_time - model_time) / turns * 1e3,
+            "turns_per_s": turns / loop_time,
+            "history_save_ms": save_time * 1e3,
+            "final_prompt_chars": prompt_chars,
+            # ru_maxrss is in kilobytes on Linux.
+            "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+
+
+def measure(name: str, provider: str, stream: bool, latency: float) -> dict:
+    command = [sys.executable, "-m", "benchmarks.bench_agent", "--child", name, "--provider", provider]
+    command += ["--latency", str(latency)] + (["--stream"] if stream else [])
+    result = subprocess.run(command, cwd=REPO_ROOT, capture_output=True, text=True)
+    if result.returncode != 0:
+        return {"scenario": name, "error": result.stderr.strip().splitlines()[-1]}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def git_commit() -> str | None:
+    result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True)
+    return result.stdout.strip() or None
+
+
+def print_results(results: list[dict], baseline: dict[str, dict]):
+    columns = ["overhead_per_turn_ms", "turns_per_s", "history_save_ms", "max_rss_mb"]
+    print(f"{'scenario':>14} {'turns':>6} " + " ".join(f"{column:>22}" for column in columns))
+    for result in results:
+        if "error" in result:
+            print(f"{result['scenario']:>14} failed: {result['error']}")
+            continue
+        cells = []
+        for column in columns:
+            cell = f"{result[column]:.2f}"
+            if column in baseline.get(result["scenario"], {}):
+                before = baseline[result["scenario"]][column]
+                cell += f" ({(result[column] - before) / before * 100:+.0f}%)" if before else ""
+            cells.append(f"{cell:>22}")
+        print(f"{result['scenario']:>14} {result['turns']:>6} " + " ".join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS, help="Defaults to every scenario.")
+    parser.add_argument("--provider", choices=PROVIDER_MODELS, default="openai")
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the mock server waits per response.")
+    parser.add_argument("--output", help="Saves the results as JSON.")
+    parser.add_argument("--compare", help="Results saved by an earlier run to show changes against.")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_scenario(args.child, args.provider, args.stream, args.latency)))
+        return
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {result["scenario"]: result for result in json.load(f)["results"]}
+
+    results = [measure(name, args.provider, args.stream, args.latency) for name in args.scenario or SCENARIOS]
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "commit": git_commit(),
+                    "python": platform.python_version(),
+                    "provider": args.provider,
+                    "stream": args.stream,
+                    "latency": args.latency,
+                    "results": results,
+                },
+                f,
+                indent=4,
+            )
+
+
+if __name__ == "__main__":
+    main()
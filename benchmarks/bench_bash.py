@@ -0,0 +1,41 @@
+"""Compares per-command overhead of spawning a shell per call against a persistent shell session.
+
+Usage: python -m benchmarks.bench_bash [--iterations N]
+"""
+
+import argparse
+import time
+
+from commands import BashCommand
+
+
+def bench(command: BashCommand, script: str, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        command._run(script)
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    for script in ["true", "echo hello", "ls /"]:
+        spawn = BashCommand(timeout=20)
+        persistent = BashCommand(timeout=20, persistent=True)
+        persistent._run("true")  # Start the session outside of the timed loop.
+        try:
+            spawn_time = bench(spawn, script, args.iterations)
+            persistent_time = bench(persistent, script, args.iterations)
+        finally:
+            persistent.close()
+        print(
+            f"{script!r:>14}: spawn {spawn_time * 1e3:7.3f} ms/cmd, "
+            f"persistent {persistent_time * 1e3:7.3f} ms/cmd, "
+            f"speedup {spawn_time / persistent_time:5.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
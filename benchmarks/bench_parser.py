@@ -0,0 +1,70 @@
+"""Compares the per-command regex scans with the single-pass CommandParser on large synthetic responses.
+
+Usage: python -m benchmarks.bench_parser [--iterations N]
+"""
+
+import argparse
+import random
+import re
+import string
+import time
+
+from commands import BashCommand, BrowseCommand, CommandParser, SubmitCommand
+
+
+def legacy_parse(commands, response: str) -> list[tuple]:
+    # The pre-CommandParser path: a fresh regex per command for counting, and again for execution.
+    def extract(tag: str) -> list[str]:
+        return re.compile(f"<{tag}>((?:(?!<{tag}>).)*?)</{tag}>", re.DOTALL).findall(response)
+
+    total = sum(len(extract(command.xml_tag)) for command in commands)
+    if total != 1:
+        return []
+    return [(command, content) for command in commands for content in extract(command.xml_tag)]
+
+
+def synthetic_response(size: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    words = ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 9))) for _ in range(500)]
+    prose = []
+    length = 0
+    while length < size:
+        word = rng.choice(words)
+        # Sprinkle in angle brackets so the tempered-dot pattern has to work for it.
+        if rng.random() < 0.02:
+            word = f"<{word}>"
+        prose.append(word)
+        length += len(word) + 1
+    return " ".join(prose) + "\n<bash>ls -la</bash>\n"
+
+
+def bench(fn, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    commands = [SubmitCommand("/dev/null"), BashCommand(timeout=20), BrowseCommand()]
+    command_parser = CommandParser(commands)
+
+    for size in [1_000, 10_000, 100_000, 1_000_000]:
+        response = synthetic_response(size)
+        assert [c.xml_tag for c, _ in legacy_parse(commands, response)] == [
+            c.xml_tag for c, _ in command_parser.parse(response)
+        ]
+        legacy = bench(lambda: legacy_parse(commands, response), args.iterations)
+        single = bench(lambda: command_parser.parse(response), args.iterations)
+        print(
+            f"{size:>9} chars: legacy {legacy * 1e3:9.3f} ms, "
+            f"single-pass {single * 1e3:9.3f} ms, speedup {legacy / single:6.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Exercises retries, hedging and failover against the mock LLM server with injected faults.
+
+Each scenario sends a series of queries through get_model and reports how many succeeded, the latency
+percentiles and how many requests reached the server, so the resilience settings can be compared.
+
+Usage: python -m benchmarks.bench_resilience [--queries N] [--scenario NAME ...]
+"""
+
+import argparse
+import logging
+import statistics
+import time
+from dataclasses import dataclass, field
+
+from APIModel import ModelArguments, ModelName, get_model
+from benchmarks.mock_server import Faults, MockLLMServer, cycle_script
+from History import History, Role
+from Logger import logger
+
+PRIMARY = ModelName.gpt_4o_mini
+FALLBACK = ModelName.gpt_4o
+
+
+@dataclass(frozen=True)
+class Scenario:
+    description: str
+    faults: Faults
+    settings: dict = field(default_factory=dict)  # ModelArguments overrides.
+
+
+SCENARIOS = {
+    "retry_after": Scenario(
+        "The first two requests are rate limited with Retry-After.",
+        Faults(fail_first=2, fail_status=429, retry_after=0.2),
+    ),
+    "flaky": Scenario("A fifth of requests fail with 503.", Faults(failure_rate=0.2)),
+    "flaky_no_retries": Scenario(
+        "A fifth of requests fail with 503, without retries.", Faults(failure_rate=0.2), {"api_max_retries": 0}
+    ),
+    "tail": Scenario("One request in ten takes two seconds longer.", Faults(slow_rate=0.1, slow_latency=2.0)),
+    "tail_hedged": Scenario(
+        "One request in ten takes two seconds longer, hedged at p90.",
+        Faults(slow_rate=0.1, slow_latency=2.0),
+        {"api_hedge_percentile": 0.9},
+    ),
+    "failover": Scenario(
+        "The primary model always fails and the fallback works.",
+        Faults(fail_models=(PRIMARY.value,)),
+        {"api_fallback_model": FALLBACK, "api_max_retries": 1},
+    ),
+}
+
+
+def run_scenario(scenario: Scenario, queries: int, latency: float) -> dict:
+    history = History.from_messages(
+        [{"role": Role.system, "content": "You are a test."}, {"role": Role.user, "content": "Say something."}]
+    )
+    with MockLLMServer(cycle_script(["<bash>true</bash>"]), latency, faults=scenario.faults) as server:
+        args = ModelArguments(
+            model=PRIMARY,
+            openai_api_key="mock",
+            api_base_url=server.openai_url,
+            api_retry_base_delay=0.05,
+            **scenario.settings,
+        )
+        model = get_model(args)
+        latencies = []
+        failures = 0
+        for _ in range(queries):
+            start = time.perf_counter()
+            try:
+                model.query(history)
+            except Exception:
+                failures += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+        requests = server.requests
+
+    latencies.sort()
+    return {
+        "succeeded": len(latencies),
+        "failed": failures,
+        "requests": requests,
+        "p50_ms": statistics.median(latencies) * 1e3 if latencies else None,
+        "p95_ms": latencies[int(0.95 * (len(latencies) - 1))] * 1e3 if latencies else None,
+        "max_ms": latencies[-1] * 1e3 if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds the mock server waits per response.")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS, help="Defaults to every scenario.")
+    args = parser.parse_args()
+    logger.setLevel(logging.ERROR)
+
+    for name in args.scenario or SCENARIOS:
+        result = run_scenario(SCENARIOS[name], args.queries, args.latency)
+
+        def ms(value: float | None) -> str:
+            return "-" if value is None else f"{value:.0f}ms"
+
+        print(
+            f"{name:>16}: {result['succeeded']}/{args.queries} succeeded, {result['requests']} requests, "
+            f"p50 {ms(result['p50_ms'])}, p95 {ms(result['p95_ms'])}, max {ms(result['max_ms'])}"
+        )
+        print(f"{'':>18}{SCENARIOS[name].description}")
+
+
+if __name__ == "__main__":
+    main()
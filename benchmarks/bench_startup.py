@@ -0,0 +1,95 @@
+"""Measures CLI import time and time-to-first-query per provider.
+
+Import time is taken from `python -X importtime`. Time-to-first-query is the wall-clock time for a fresh
+interpreter to import main and build a model that is ready to send its first request; no request is sent.
+
+Usage: python -m benchmarks.bench_startup [--runs N] [--top N]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROVIDER_MODELS = {
+    "openai": "gpt-4o-mini",
+    "anthropic": "claude-3-5-sonnet-20240620",
+    "together": "meta-llama/Meta-Llama-3.1-70B-Instruct-Turbo",
+    "fireworks": "accounts/fireworks/models/llama-v3p1-405b-instruct",
+}
+
+FIRST_QUERY_SCRIPT = """
+import main
+from APIModel import ModelArguments, ModelName, get_model
+get_model(ModelArguments(
+    model=ModelName({model!r}),
+    openai_api_key="x", together_api_key="x", fireworks_api_key="x", anthropic_api_key="x",
+))
+"""
+
+
+def import_times(module: str) -> list[tuple[int, str, int]]:
+    """Returns (cumulative microseconds, module, nesting depth) for every import made by `import module`."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+    )
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        times.append((int(cumulative), name.strip(), depth))
+    return times
+
+
+def time_to_first_query(model: str, runs: int) -> list[float] | str:
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, "-c", FIRST_QUERY_SCRIPT.format(model=model)],
+            cwd=REPO_ROOT,
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            return result.stderr.strip().splitlines()[-1]
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    times = import_times("main")
+    main_time = next((cumulative for cumulative, name, _ in times if name == "main"), 0)
+    print(f"import main: {main_time / 1e3:.1f} ms cumulative; slowest direct imports:")
+    direct = [(cumulative, name) for cumulative, name, depth in times if depth == 1]
+    for cumulative, name in sorted(direct, reverse=True)[: args.top]:
+        print(f"  {cumulative / 1e3:8.1f} ms  {name}")
+
+    print("time to first query (interpreter start to a ready model):")
+    for provider, model in PROVIDER_MODELS.items():
+        durations = time_to_first_query(model, args.runs)
+        if isinstance(durations, str):
+            print(f"  {provider:>10}: failed ({durations})")
+            continue
+        print(
+            f"  {provider:>10}: median {statistics.median(durations) * 1e3:7.1f} ms, "
+            f"min {min(durations) * 1e3:7.1f} ms over {len(durations)} runs"
+        )
+
+
+if __name__ == "__main__":
+    main()
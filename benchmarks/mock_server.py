@@ -0,0 +1,314 @@
+"""A local stand-in for the OpenAI and Anthropic chat endpoints that plays back scripted responses.
+
+Point a model at it with `api_base_url`: `http://HOST:PORT/v1` for OpenAI-compatible providers and
+`http://HOST:PORT` for Anthropic. Both plain and streamed responses are supported. Faults can be injected to
+exercise retries, hedging and failover: error responses, with or without Retry-After, and slow responses.
+
+Usage: python -m benchmarks.mock_server [--port N] [--latency S] [--chunk-delay S] [--fail-first N]
+                                        [--failure-rate P] [--fail-status CODE] [--retry-after S]
+                                        [--slow-rate P] [--slow-latency S] RESPONSE [RESPONSE ...]
+"""
+
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+# Given the request's messages, returns the text of the assistant's reply.
+ScriptType = Callable[[list[dict[str, str]]], str]
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+def message_text(content: str | list[dict[str, Any]]) -> str:
+    # Anthropic requests may send content as blocks, e.g. to carry cache_control.
+    if isinstance(content, str):
+        return content
+    return "".join(block.get("text", "") for block in content)
+
+
+@dataclass
+class Faults:
+    fail_first: int = 0  # The first N requests fail.
+    failure_rate: float = 0.0  # The chance that any later request fails.
+    fail_status: int = 503  # The status code of failed requests.
+    retry_after: float | None = None  # The Retry-After seconds sent with failures, if any.
+    slow_rate: float = 0.0  # The chance that a request is delayed by slow_latency on top of the usual latency.
+    slow_latency: float = 0.0
+    slow_requests: tuple[int, ...] = ()  # These requests, by number from 1, are always delayed by slow_latency.
+    fail_models: tuple[str, ...] = ()  # Requests for these models always fail, e.g. to force a failover.
+    seed: int = 0
+
+    def __post_init__(self):
+        self.random = random.Random(self.seed)
+        self.lock = threading.Lock()
+
+    def decide(self, request_number: int, model: str) -> tuple[bool, float]:
+        """Returns whether the request fails and the extra seconds it is delayed by."""
+        with self.lock:
+            fail = model in self.fail_models or request_number <= self.fail_first
+            fail = fail or self.random.random() < self.failure_rate
+            slow = self.random.random() < self.slow_rate or request_number in self.slow_requests
+        return fail, self.slow_latency if slow else 0.0
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "MockLLMServer"
+
+    def log_message(self, format: str, *args):
+        pass
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        path = self.path.rstrip("/")
+        if not path.endswith(("/chat/completions", "/messages")):
+            return self.send_json({"error": {"message": f"Unknown endpoint {self.path}"}}, status=404)
+
+        messages = [
+            {"role": message["role"], "content": message_text(message["content"])}
+            for message in request.get("messages", [])
+        ]
+        if "system" in request:
+            messages.insert(0, {"role": "system", "content": message_text(request["system"])})
+        prompt_tokens = sum(estimate_tokens(message["content"]) for message in messages)
+
+        request_number = self.server.count_request()
+        fail, delay = self.server.faults.decide(request_number, request.get("model", ""))
+        time.sleep(self.server.latency + delay)
+        if fail:
+            retry_after = self.server.faults.retry_after
+            headers = {} if retry_after is None else {"Retry-After": str(retry_after)}
+            error = {"type": "error", "error": {"type": "api_error", "message": "Injected fault."}}
+            return self.send_json(error, status=self.server.faults.fail_status, headers=headers)
+        text = self.server.script(messages)
+
+        if path.endswith("/chat/completions"):
+            if not request.get("stream"):
+                return self.send_json(openai_response(request["model"], text, prompt_tokens))
+            include_usage = request.get("stream_options", {}).get("include_usage", False)
+            self.send_events(openai_events(request["model"], text, prompt_tokens, include_usage))
+        elif request.get("stream"):
+            self.send_events(anthropic_events(request["model"], text, prompt_tokens))
+        else:
+            self.send_json(anthropic_response(request["model"], text, prompt_tokens))
+
+    def send_json(self, data: dict[str, Any], status: int = 200, headers: dict[str, str] | None = None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_events(self, events: Iterator[tuple[str | None, dict[str, Any] | str]]):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for index, (event, data) in enumerate(events):
+                if index and self.server.chunk_delay:
+                    time.sleep(self.server.chunk_delay)
+                payload = data if isinstance(data, str) else json.dumps(data)
+                frame = (f"event: {event}\n" if event else "") + f"data: {payload}\n\n"
+                self.write_chunk(frame.encode())
+            self.write_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading early, e.g. after the first complete command.
+            self.close_connection = True
+
+    def write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+def split_text(text: str, size: int) -> list[str]:
+    return [text[start : start + size] for start in range(0, len(text), size)] or [""]
+
+
+def openai_response(model: str, text: str, prompt_tokens: int) -> dict[str, Any]:
+    completion_tokens = estimate_tokens(text)
+    return {
+        "id": "chatcmpl-mock",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+def openai_events(model: str, text: str, prompt_tokens: int, include_usage: bool, chunk_chars: int = 16):
+    def chunk(delta: dict[str, str], finish_reason: str | None = None) -> dict[str, Any]:
+        return {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+    yield None, chunk({"role": "assistant", "content": ""})
+    for piece in split_text(text, chunk_chars):
+        yield None, chunk({"content": piece})
+    yield None, chunk({}, "stop")
+    if include_usage:
+        usage = openai_response(model, text, prompt_tokens)["usage"]
+        yield None, {**chunk({}), "choices": [], "usage": usage}
+    yield None, "[DONE]"
+
+
+def anthropic_usage(prompt_tokens: int, completion_tokens: int) -> dict[str, int]:
+    return {
+        "input_tokens": prompt_tokens,
+        "output_tokens": completion_tokens,
+        "cache_read_input_tokens": 0,
+        "cache_creation_input_tokens": 0,
+    }
+
+
+def anthropic_response(model: str, text: str, prompt_tokens: int) -> dict[str, Any]:
+    return {
+        "id": "msg_mock",
+        "type": "message",
+        "role": "assistant",
+        "model": model,
+        "content": [{"type": "text", "text": text}],
+        "stop_reason": "end_turn",
+        "stop_sequence": None,
+        "usage": anthropic_usage(prompt_tokens, estimate_tokens(text)),
+    }
+
+
+def anthropic_events(model: str, text: str, prompt_tokens: int, chunk_chars: int = 16):
+    message = {**anthropic_response(model, text, prompt_tokens), "content": [], "stop_reason": None}
+    message["usage"] = anthropic_usage(prompt_tokens, 1)
+    yield "message_start", {"type": "message_start", "message": message}
+    yield "content_block_start", {
+        "type": "content_block_start",
+        "index": 0,
+        "content_block": {"type": "text", "text": ""},
+    }
+    for piece in split_text(text, chunk_chars):
+        yield "content_block_delta", {
+            "type": "content_block_delta",
+            "index": 0,
+            "delta": {"type": "text_delta", "text": piece},
+        }
+    yield "content_block_stop", {"type": "content_block_stop", "index": 0}
+    yield "message_delta", {
+        "type": "message_delta",
+        "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+        "usage": {"output_tokens": estimate_tokens(text)},
+    }
+    yield "message_stop", {"type": "message_stop"}
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    """Serves scripted responses on a background thread. Use as a context manager."""
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        script: ScriptType,
+        latency: float = 0.0,
+        chunk_delay: float = 0.0,
+        port: int = 0,
+        faults: Faults | None = None,
+    ):
+        super().__init__(("127.0.0.1", port), MockHandler)
+        self.script = script
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.faults = faults or Faults()
+        self.requests = 0
+        self.requests_lock = threading.Lock()
+        self.thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def openai_url(self) -> str:
+        return f"{self.url}/v1"
+
+    def count_request(self) -> int:
+        with self.requests_lock:
+            self.requests += 1
+            return self.requests
+
+    def start(self) -> "MockLLMServer":
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self) -> "MockLLMServer":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def cycle_script(responses: list[str]) -> ScriptType:
+    """Replies with each response in turn, starting over after the last."""
+    replies = itertools.cycle(responses)
+    lock = threading.Lock()
+
+    def script(messages: list[dict[str, str]]) -> str:
+        with lock:
+            return next(replies)
+
+    return script
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("responses", nargs="+", help="The replies to play back in turn.")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before each response starts.")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="Seconds between streamed chunks.")
+    parser.add_argument("--fail-first", type=int, default=0, help="Fail the first N requests.")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="The chance that a request fails.")
+    parser.add_argument("--fail-status", type=int, default=503)
+    parser.add_argument("--retry-after", type=float, help="The Retry-After seconds sent with failures.")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="The chance that a request is slow.")
+    parser.add_argument("--slow-latency", type=float, default=0.0, help="Extra seconds for slow requests.")
+    args = parser.parse_args()
+
+    faults = Faults(
+        args.fail_first, args.failure_rate, args.fail_status, args.retry_after, args.slow_rate, args.slow_latency
+    )
+    server = MockLLMServer(cycle_script(args.responses), args.latency, args.chunk_delay, args.port, faults)
+    print(f"Serving on {server.url} (OpenAI base URL {server.openai_url})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Compares how often turns are wasted on responses that call no valid command, by tool mode.
+
+Reads the metrics.jsonl files written by runs, e.g. a batch run with native_tools and one without, and reports
+for each tool mode the share of turns whose response called no command or an invalid combination of commands.
+
+Usage: python -m benchmarks.wasted_turns PATH [PATH ...]
+PATH is a metrics file or a directory that is searched for metrics.jsonl files.
+"""
+
+import argparse
+import json
+import os
+from collections import Counter, defaultdict
+from collections.abc import Iterator
+
+
+def metrics_files(paths: list[str]) -> Iterator[str]:
+    for path in paths:
+        if os.path.isfile(path):
+            yield path
+            continue
+        for directory, _, files in os.walk(path):
+            if "metrics.jsonl" in files:
+                yield os.path.join(directory, "metrics.jsonl")
+
+
+def wasted_turn_rates(paths: list[str]) -> dict[str, dict]:
+    turns: Counter[str] = Counter()
+    runs: Counter[str] = Counter()
+    reasons: dict[str, Counter[str]] = defaultdict(Counter)
+    for path in metrics_files(paths):
+        modes = set()
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                # Records written before tool modes existed are XML runs.
+                mode = record.get("tool_mode", "xml")
+                modes.add(mode)
+                turns[mode] += 1
+                if record.get("wasted"):
+                    reasons[mode][record["wasted"]] += 1
+        runs.update(modes)
+
+    return {
+        mode: {
+            "runs": runs[mode],
+            "turns": turns[mode],
+            "wasted": sum(reasons[mode].values()),
+            "rate": sum(reasons[mode].values()) / turns[mode],
+            "reasons": dict(reasons[mode]),
+        }
+        for mode in sorted(turns)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="+")
+    args = parser.parse_args()
+
+    results = wasted_turn_rates(args.paths)
+    if not results:
+        print("No metrics found.")
+    for mode, result in results.items():
+        reasons = ", ".join(f"{reason}={count}" for reason, count in sorted(result["reasons"].items()))
+        print(
+            f"{mode:>8}: {result['wasted']} of {result['turns']} turns wasted ({result['rate']:.1%}) "
+            f"over {result['runs']} runs" + (f"; {reasons}" if reasons else "")
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+from commands.BaseCommand import BaseCommand, CallbackType
+from commands.CommandBlocker import CommandBlocker
+from commands.JobManager import JobError, JobManager
+
+
+class BackgroundCommand(BaseCommand):
+    exclusive = False
+    tool_argument = "command"
+    tool_argument_description = "The shell command to run in the background."
+
+    def __init__(self, jobs: JobManager, callback: CallbackType | None = None):
+        self.jobs = jobs
+        super().__init__(
+            xml_tag="bash_bg",
+            description="""To start a shell command that may take longer than the bash timeout, such as a build, download or training run, wrap it in <bash_bg></bash_bg> XML tags. It runs in the background and you get a job ID back right away. Example:
+<bash_bg>python3 train.py</bash_bg>""",
+            callback=callback,
+        )
+
+    def _run(self, content: str) -> str:
+        if blocked := CommandBlocker.blocked_command(content):
+            return f"JOB ERROR:\nInteractive command not allowed: `{blocked}` would wait for input from a terminal."
+
+        try:
+            job = self.jobs.start(content)
+        except JobError as e:
+            return f"JOB ERROR:\n{e}"
+
+        return (
+            f"JOB OUTPUT:\nStarted job {job.id}. Check on it with <job>status {job.id}</job>, read its new output "
+            f"with <job>tail {job.id}</job> and stop it with <job>kill {job.id}</job>."
+        )
+
+    def close(self):
+        self.jobs.close()
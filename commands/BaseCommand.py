@@ -1,39 +1,93 @@
+import asyncio
 import re
 from abc import ABC, abstractmethod
 from collections.abc import Callable
+from dataclasses import dataclass
 
 CallbackType = Callable[[], None]
 
 
+@dataclass(frozen=True)
+class ToolSpec:
+    """A command offered to the model as a provider-native tool, taking one string argument or none."""
+
+    name: str
+    description: str
+    argument: str | None
+    argument_description: str = ""
+
+    def call(self, arguments: dict) -> "ToolCall":
+        content = arguments.get(self.argument, "") if self.argument is not None else ""
+        return ToolCall(self.name, content if isinstance(content, str) else str(content))
+
+
+@dataclass(frozen=True)
+class ToolCall:
+    """A native call of a tool, run as its command with the content as is instead of being parsed out of text."""
+
+    name: str
+    content: str
+
+    def render(self) -> str:
+        """Writes the call as the command's XML, for the history that later queries read."""
+        return f"<{self.name}>{self.content}</{self.name}>"
+
+
 class BaseCommand(ABC):
+    # Whether the command must be the only one in a response.
+    exclusive = True
+    # Whether calls to the command in the same response may run at the same time.
+    concurrent = False
+    # The name and description of the command's argument when it is called as a native tool.
+    tool_argument: str | None = "content"
+    tool_argument_description = "The content of the command."
+
     def __init__(self, xml_tag: str, description: str, callback: CallbackType | None = None):
         self.xml_tag = xml_tag
         self.description = description
         self.callback = callback
+        self.pattern = re.compile(
+            f"<{self.xml_tag}>((?:(?!<{self.xml_tag}>).)*?)</{self.xml_tag}>", re.DOTALL
+        )
 
     def count_occurrences(self, response: str) -> int:
         return len(self.extract_content(response))
 
     def extract_content(self, response: str) -> list[str]:
         """Extracts content from innermost XML-like tags in the response string."""
-        pattern = re.compile(
-            f"<{self.xml_tag}>((?:(?!<{self.xml_tag}>).)*?)</{self.xml_tag}>", re.DOTALL
-        )
-        return pattern.findall(response)
+        return self.pattern.findall(response)
 
     @abstractmethod
     def _run(self, content: str) -> str:
         pass
 
+    def run(self, content: str) -> str:
+        result = self._run(content)
+        if self.callback:
+            self.callback()
+        return result
+
     def execute(self, response: str) -> list[str]:
-        results = []
-        contents = self.extract_content(response)
-        for content in contents:
-            result = self._run(content)
-            if self.callback:
-                self.callback()
-            results.append(result)
-        return results
+        return [self.run(content) for content in self.extract_content(response)]
+
+    async def _arun(self, content: str) -> str:
+        return await asyncio.to_thread(self._run, content)
+
+    async def arun(self, content: str) -> str:
+        result = await self._arun(content)
+        if self.callback:
+            self.callback()
+        return result
+
+    async def aexecute(self, response: str) -> list[str]:
+        return [await self.arun(content) for content in self.extract_content(response)]
+
+    def tool_spec(self) -> ToolSpec:
+        return ToolSpec(self.xml_tag, self.description, self.tool_argument, self.tool_argument_description)
+
+    def close(self):
+        """Releases any resources held by the command."""
+        pass
 
     def __str__(self):
         return f"{self.xml_tag}: {self.description}"
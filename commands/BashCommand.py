@@ -1,12 +1,56 @@
+import asyncio
+import itertools
+import os
+import selectors
+import signal
 import subprocess
+import time
 
 from commands.BaseCommand import BaseCommand, CallbackType
+from commands.BrowserManager import BrowserError, BrowserManager
 from commands.CommandBlocker import CommandBlocker
+from commands.InputWatcher import CommandStalledError, InputWatcher
+from commands.OutputCapture import OutputCapture
+from commands.ResourceLimits import ResourceLimits, shell_command
+from commands.ShellSession import ShellSession
+
+# Seconds between checks on whether a running command is waiting for input.
+WATCH_INTERVAL = 0.25
 
 
 class BashCommand(BaseCommand):
-    def __init__(self, timeout: int, callback: CallbackType | None = None):
+    exclusive = False
+    tool_argument = "command"
+    tool_argument_description = "The shell command to run."
+
+    def __init__(
+        self,
+        timeout: int,
+        callback: CallbackType | None = None,
+        persistent: bool = False,
+        cwd: str | None = None,
+        max_output_bytes: int = 20000,
+        max_output_lines: int = 400,
+        spill_dir: str = "bash_outputs",
+        browser: BrowserManager | None = None,
+        limits: ResourceLimits | None = None,
+        input_wait: float | None = 1.0,
+        idle_timeout: float | None = None,
+    ):
         self.timeout = timeout
+        self.cwd = cwd
+        self.max_output_bytes = max_output_bytes
+        self.max_output_lines = max_output_lines
+        self.spill_dir = spill_dir
+        self.output_counter = itertools.count(1)
+        self.limits = limits if limits else None
+        # Seconds a command may wait for input, or print nothing, before it is stopped early.
+        self.input_wait = input_wait
+        self.idle_timeout = idle_timeout
+        self.session = ShellSession(cwd=cwd, limits=self.limits) if persistent else None
+        # Commands in a persistent session share one shell, so they have to take turns.
+        self.concurrent = not persistent
+        self.browser = browser
         super().__init__(
             xml_tag="bash",
             description="""To run a shell command, wrap it in <bash></bash> XML tags. Examples:
@@ -21,24 +65,191 @@ print(np.sum([1, 2, 3]))
         )
 
     def _run(self, content: str) -> str:
-        if CommandBlocker.should_block(content):
-            return "BASH ERROR:\nInteractive command not allowed."
+        if blocked := CommandBlocker.blocked_command(content):
+            return self._blocked_message(blocked)
 
         try:
-            result = subprocess.run(
-                content, shell=True, capture_output=True, text=True, timeout=self.timeout
-            )
+            self._ensure_browser(content)
+        except BrowserError as e:
+            return f"BASH ERROR:\n{e}"
+
+        stdout, stderr = self._new_captures()
+        try:
+            if self.session is not None:
+                result = self.session.run(content, self.timeout, stdout, stderr)
+            else:
+                result = self._spawn(content, stdout, stderr)
         except subprocess.TimeoutExpired:
-            return "BASH ERROR:\nCommand timed out."
+            result = subprocess.CompletedProcess(content, None, stdout.render(), stderr.render())
+            return self._format_result(result, error=self._timeout_message())
+        except CommandStalledError as e:
+            result = subprocess.CompletedProcess(content, None, stdout.render(), stderr.render())
+            return self._format_result(result, error=str(e))
+
+        return self._format_result(result)
+
+    def _timeout_message(self) -> str:
+        return f"Command timed out after {self.timeout} seconds and was stopped."
+
+    @staticmethod
+    def _blocked_message(command: str) -> str:
+        return (
+            f"BASH ERROR:\nInteractive command not allowed: `{command}` would wait for input from a terminal. "
+            "Use a non-interactive alternative instead, e.g. `cat` instead of a pager or editor, `python3 script.py` "
+            "or input piped into the interpreter instead of a REPL, or `git commit -m` instead of an editor."
+        )
+
+    def _ensure_browser(self, content: str):
+        if self.browser is not None and self.browser.uses_browser(content):
+            self.browser.ensure_started()
+
+    def _new_captures(self) -> tuple[OutputCapture, OutputCapture]:
+        output_num = next(self.output_counter)
+        return tuple(
+            OutputCapture(
+                self.max_output_bytes,
+                self.max_output_lines,
+                os.path.join(self.spill_dir, f"bash_{output_num:04d}.{stream}.txt"),
+            )
+            for stream in ("stdout", "stderr")
+        )
+
+    def _spawn(
+        self, content: str, stdout: OutputCapture, stderr: OutputCapture
+    ) -> subprocess.CompletedProcess:
+        """Runs the command in a fresh shell, reading its output incrementally into the captures.
+
+        Raises subprocess.TimeoutExpired past the timeout and CommandStalledError if it waits for input.
+        """
+        deadline = time.monotonic() + self.timeout
+        watcher = InputWatcher(self.input_wait, self.idle_timeout)
+        # The command gets its own process group, so that everything it starts can be killed with it.
+        with watcher, subprocess.Popen(
+            shell_command(content, self.limits),
+            stdin=watcher.read_fd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=self.cwd,
+            start_new_session=True,
+        ) as process, selectors.DefaultSelector() as selector:
+            watcher.attach(process.pid)
+            captures = {process.stdout: stdout, process.stderr: stderr}
+            for stream in captures:
+                selector.register(stream, selectors.EVENT_READ)
+
+            while selector.get_map():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._kill_group(process.pid)
+                    raise subprocess.TimeoutExpired(content, self.timeout)
+
+                for key, _ in selector.select(timeout=min(remaining, WATCH_INTERVAL)):
+                    data = os.read(key.fileobj.fileno(), 65536)
+                    if data:
+                        captures[key.fileobj].write(data)
+                        watcher.output()
+                    else:
+                        selector.unregister(key.fileobj)
+
+                try:
+                    watcher.check()
+                except CommandStalledError:
+                    self._kill_group(process.pid)
+                    raise
 
+            returncode = process.wait(timeout=max(0, deadline - time.monotonic()))
+
+        return subprocess.CompletedProcess(content, returncode, stdout.render(), stderr.render())
+
+    async def _arun(self, content: str) -> str:
+        if self.session is not None:
+            return await super()._arun(content)
+        if blocked := CommandBlocker.blocked_command(content):
+            return self._blocked_message(blocked)
+
+        try:
+            await asyncio.to_thread(self._ensure_browser, content)
+        except BrowserError as e:
+            return f"BASH ERROR:\n{e}"
+
+        stdout, stderr = self._new_captures()
+        with InputWatcher(self.input_wait, self.idle_timeout) as watcher:
+            return await self._arun_watched(content, watcher, stdout, stderr)
+
+    async def _arun_watched(
+        self, content: str, watcher: InputWatcher, stdout: OutputCapture, stderr: OutputCapture
+    ) -> str:
+        process = await asyncio.create_subprocess_exec(
+            *shell_command(content, self.limits),
+            stdin=watcher.read_fd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=self.cwd,
+            start_new_session=True,
+        )
+
+        watcher.attach(process.pid)
+
+        async def read(stream: asyncio.StreamReader, capture: OutputCapture):
+            while data := await stream.read(65536):
+                capture.write(data)
+                watcher.output()
+
+        async def watch():
+            while True:
+                await asyncio.sleep(WATCH_INTERVAL)
+                # The check reads /proc for every process in the group, so it stays off the event loop.
+                await asyncio.to_thread(watcher.check)
+
+        run = asyncio.gather(read(process.stdout, stdout), read(process.stderr, stderr), process.wait())
+        monitor = asyncio.ensure_future(watch())
+        try:
+            await asyncio.wait_for(asyncio.wait([run, monitor], return_when=asyncio.FIRST_COMPLETED), self.timeout)
+            if not run.done():
+                monitor.result()
+            run.result()
+        except asyncio.TimeoutError:
+            self._kill_group(process.pid)
+            await asyncio.gather(run, return_exceptions=True)
+            result = subprocess.CompletedProcess(content, process.returncode, stdout.render(), stderr.render())
+            return self._format_result(result, error=self._timeout_message())
+        except CommandStalledError as e:
+            self._kill_group(process.pid)
+            await asyncio.gather(run, return_exceptions=True)
+            result = subprocess.CompletedProcess(content, process.returncode, stdout.render(), stderr.render())
+            return self._format_result(result, error=str(e))
+        finally:
+            monitor.cancel()
+
+        result = subprocess.CompletedProcess(content, process.returncode, stdout.render(), stderr.render())
+        return self._format_result(result)
+
+    @staticmethod
+    def _kill_group(pid: int):
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def _format_result(self, result: subprocess.CompletedProcess, error: str | None = None) -> str:
+        if result.returncode != 0 and self.browser is not None and self.browser.uses_browser(result.args):
+            self.browser.browse_failed()
         output = []
 
         if result.stdout:
             output.append(f"BASH OUTPUT:\n{result.stdout}")
         if result.stderr:
             output.append(f"BASH ERROR:\n{result.stderr}")
+        if self.limits is not None and (limit := self.limits.exceeded(result.returncode, result.stderr)):
+            output.append(f"RESOURCE LIMIT EXCEEDED:\nThe command was stopped by its {limit}.")
+        if error is not None:
+            output.append(f"BASH ERROR:\n{error}")
 
         if not output:
             return "BASH OUTPUT:\nCommand ran successfully with no output."
 
         return "\n".join(output)
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
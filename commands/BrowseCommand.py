@@ -1,9 +1,8 @@
 from commands.BaseCommand import BaseCommand, CallbackType
-import subprocess
-import time
-import os
 
 class BrowseCommand(BaseCommand):
+    tool_argument = None
+
     def __init__(self):
         super().__init__(
             xml_tag="browse",
@@ -11,14 +10,6 @@ class BrowseCommand(BaseCommand):
             callback=None,
         )
 
-        subprocess.Popen(
-            ["nohup", "browse-start"],
-            stdout=open("/dev/null", "w"),
-            stderr=open("/dev/null", "a"),
-            preexec_fn=os.setpgrp,
-        )
-        time.sleep(0.2)
-
     def _run(self, content: str) -> str:
         if content != "":
             return "ERROR: The browse command does not take any arguments."
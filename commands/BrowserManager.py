@@ -0,0 +1,138 @@
+import atexit
+import os
+import shlex
+import signal
+import subprocess
+import threading
+import time
+
+
+class BrowserError(Exception):
+    pass
+
+
+class BrowserManager:
+    """Starts the browser daemon on the first browse-* command and keeps it warm for every agent in the process.
+
+    The browse-* commands all talk to a single daemon, so one is shared per start command rather than started
+    per agent. Daemons are stopped when the process exits. A daemon that passed the readiness probe is taken to
+    be alive until a browse-* command fails, which makes the next command probe it again.
+    """
+
+    def __init__(self, start_command: str, probe_command: str | None, ready_timeout: float):
+        self.start_command = shlex.split(start_command)
+        self.probe_command = shlex.split(probe_command) if probe_command else None
+        self.ready_timeout = ready_timeout
+        self.process: subprocess.Popen | None = None
+        self.ready = False
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def uses_browser(command: str) -> bool:
+        return "browse-" in command
+
+    def is_running(self) -> bool:
+        if self.process is None:
+            return False
+        returncode = self.process.poll()
+        if returncode is None:
+            return True
+        if returncode != 0:
+            return False
+        # A start command that daemonises itself exits with 0, so only the probe can tell whether the daemon
+        # it left behind is still alive.
+        if not self.ready:
+            self.ready = self._probe(time.monotonic() + self.ready_timeout)
+        return self.ready
+
+    def browse_failed(self):
+        """Probes the daemon again before the next browse-* command, as a failed one may mean that it died."""
+        self.ready = False
+
+    def ensure_started(self):
+        """Starts the daemon if it is not running and waits until it passes the readiness probe."""
+        with self.lock:
+            if self.is_running():
+                return
+
+            try:
+                self.process = subprocess.Popen(
+                    self.start_command,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    start_new_session=True,
+                )
+            except OSError as e:
+                raise BrowserError(f"Could not start the browser: {e}") from e
+            self._wait_until_ready()
+
+    def _wait_until_ready(self):
+        deadline = time.monotonic() + self.ready_timeout
+        delay = 0.02
+        while True:
+            returncode = self.process.poll()
+            if returncode not in (None, 0):
+                raise BrowserError(f"The browser exited with code {returncode} while starting.")
+            if self._probe(deadline):
+                self.ready = True
+                return
+            if time.monotonic() + delay > deadline:
+                raise BrowserError(f"The browser was not ready after {self.ready_timeout} seconds.")
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+
+    def _probe(self, deadline: float) -> bool:
+        if self.probe_command is None:
+            return True
+        try:
+            probe = subprocess.run(
+                self.probe_command,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=max(0.1, deadline - time.monotonic()),
+            )
+        except (OSError, subprocess.TimeoutExpired):
+            return False
+        return probe.returncode == 0
+
+    def close(self):
+        with self.lock:
+            if self.process is None:
+                return
+            try:
+                os.killpg(self.process.pid, signal.SIGTERM)
+                self.process.wait(timeout=5)
+            except ProcessLookupError:
+                pass
+            except subprocess.TimeoutExpired:
+                os.killpg(self.process.pid, signal.SIGKILL)
+                self.process.wait()
+            self.process = None
+            self.ready = False
+
+
+_managers: dict[tuple, BrowserManager] = {}
+_managers_lock = threading.Lock()
+
+
+def get_browser_manager(
+    start_command: str = "browse-start", probe_command: str | None = "browse-observe", ready_timeout: float = 10.0
+) -> BrowserManager:
+    """Returns the process-wide manager for the start command, creating it on first use."""
+    key = (start_command, probe_command, ready_timeout)
+    with _managers_lock:
+        if key not in _managers:
+            _managers[key] = BrowserManager(start_command, probe_command, ready_timeout)
+        return _managers[key]
+
+
+def close_browsers():
+    with _managers_lock:
+        managers = list(_managers.values())
+    for manager in managers:
+        manager.close()
+
+
+atexit.register(close_browsers)
@@ -1,7 +1,22 @@
+import os
+import shlex
+
+
 class CommandBlocker:
-    """Blocks interactive commands to prevent infinite stalls."""
+    """Blocks interactive commands to prevent infinite stalls.
 
-    blocklist = ["vim", "vi", "emacs", "nano", "nohup", "git"]
+    The action is tokenized like a shell would, so every command in a pipeline, `&&`/`||`/`;` chain,
+    subshell, command substitution or `bash -c` string is checked, not just the first word. Interpreters
+    such as python3 or sqlite3 are only blocked when run bare with the terminal as stdin; fed from a pipe,
+    a `<`, `<<` or `<<<` redirect, or inside a command substitution, they read their input and exit. Likewise
+    pagers such as less or man only wait for keys when their output goes to the terminal, so they are allowed
+    when it is piped, redirected or substituted.
+    """
+
+    blocklist = [
+        "vim", "vi", "nvim", "emacs", "nano", "pico", "nohup",
+        "less", "more", "most", "man", "top", "htop", "tmux", "screen",
+    ]  # fmt: skip
     blocklist_standalone = [
         "python",
         "python3",
@@ -16,20 +31,210 @@ class CommandBlocker:
         "vim",
         "emacs",
         "nano",
+        "node",
+        "irb",
+        "ghci",
+        "psql",
+        "mysql",
+        "sqlite3",
+        "ssh",
+        "ftp",
+        "telnet",
     ]
+    # Commands that start an interactive session when given one of these flags.
+    interactive_flags = {
+        "python": ["-i"],
+        "python3": ["-i"],
+        "ipython": ["-i"],
+        "bash": ["-i"],
+        "sh": ["-i"],
+        "node": ["-i", "--interactive"],
+    }
+    # Commands that page their output when it goes to the terminal, and print it all otherwise.
+    pagers = {"less", "more", "most", "man", "top"}
+    # Words that run the command after them, along with their options that take a value and how many
+    # arguments they take before the command.
+    prefixes = {
+        "sudo": ({"-u", "-g", "-C", "-D", "-p", "-r", "-t", "-U", "-T", "-R", "--user", "--group", "--close-from",
+                  "--chdir", "--prompt", "--role", "--type", "--other-user", "--command-timeout", "--chroot"}, 0),
+        "env": ({"-u", "-C", "--unset", "--chdir"}, 0),
+        "time": ({"-f", "-o", "--format", "--output"}, 0),
+        "nice": ({"-n", "--adjustment"}, 0),
+        "exec": ({"-a"}, 0),
+        "command": (set(), 0),
+        "timeout": ({"-s", "-k", "--signal", "--kill-after"}, 1),
+        "xargs": ({"-a", "-d", "-E", "-I", "-L", "-n", "-P", "-s", "--arg-file", "--delimiter", "--max-args",
+                   "--max-lines", "--max-procs", "--max-chars", "--process-slot-var"}, 0),
+    }  # fmt: skip
+    # The ssh options that take a value; the first word after the options is the destination.
+    ssh_value_options = {f"-{flag}" for flag in "BbcDEeFIiJLlmOoPpQRSWw"}
+    # Redirections of a command's output, unless the word before them names a descriptor other than stdout.
+    output_redirects = {">", ">>", ">|", "&>", "&>>"}
+    separators = {";", "&", "&&", "|", "||", "|&", "(", ")", "{", "}", "\n", "!", "then", "do", "else", "elif"}
+    # Options that give git commit its message, so that it does not open an editor.
+    git_message_options = {"-m", "-F", "-C", "--message", "--file", "--reuse-message", "--no-edit", "--fixup"}
 
     @staticmethod
     def should_block(action: str) -> bool:
-        args = action.strip().split()
-        if len(args) == 0:
-            return False
+        return CommandBlocker.blocked_command(action) is not None
+
+    @staticmethod
+    def blocked_command(action: str) -> str | None:
+        """Returns the first interactive command in the action, if there is one."""
+        tokens = CommandBlocker._tokenize(action)
+        if tokens is None:
+            return None
+        for words, redirected, captured in CommandBlocker._simple_commands(tokens):
+            if blocked := CommandBlocker._check(words, redirected, captured):
+                return blocked
+        return None
+
+    @staticmethod
+    def _tokenize(action: str) -> list[str] | None:
+        lexer = shlex.shlex(action, posix=True, punctuation_chars=";&|()<>\n")
+        lexer.whitespace = " \t\r"
+        lexer.whitespace_split = True
+        try:
+            return list(lexer)
+        except ValueError:
+            # Unbalanced quotes; the shell will reject the command itself.
+            return None
+
+    @staticmethod
+    def _simple_commands(tokens: list[str]) -> list[tuple[list[str], bool, bool]]:
+        """Splits the tokens into simple commands, each with whether its stdin is redirected from the terminal
+        and whether its stdout is captured instead of going to the terminal."""
+        commands: list[list[str]] = [[]]
+        redirected = [False]
+        captured = [False]
+        # The kind of each open parenthesis, "$" for a command substitution.
+        parentheses: list[str] = []
+        heredoc_end = None
+        for index, token in enumerate(tokens):
+            if heredoc_end is not None:
+                # Skip the here-document's body up to its delimiter.
+                if token == heredoc_end and tokens[index - 1] == "\n":
+                    heredoc_end = None
+                continue
+            if token in ("<<", "<<-") and index + 1 < len(tokens):
+                heredoc_end = tokens[index + 1].lstrip("-")
+                redirected[-1] = True
+                continue
+            if token in ("<", "<<<"):
+                redirected[-1] = True
+            if token in CommandBlocker.output_redirects and not (
+                index > 0 and tokens[index - 1].isdigit() and tokens[index - 1] != "1"
+            ):
+                captured[-1] = True
+            # The command after a pipe reads from it, and one inside $(...) is not run from the terminal.
+            substitution = token == "(" and index > 0 and tokens[index - 1].endswith("$")
+            pipe = token in ("|", "|&") or substitution
+            if token == "(":
+                parentheses.append("$" if substitution else "(")
+            elif token == ")" and parentheses:
+                parentheses.pop()
+            if token in ("|", "|&") and commands[-1]:
+                captured[-1] = True
+            if token in CommandBlocker.separators and not commands[-1]:
+                redirected[-1] = redirected[-1] or pipe
+                captured[-1] = captured[-1] or "$" in parentheses
+                continue
+            if token in CommandBlocker.separators or token.startswith("\n"):
+                commands.append([])
+                redirected.append(pipe)
+                captured.append("$" in parentheses)
+                continue
+            if token.startswith("`") and token.endswith("`") and len(token) > 1:
+                # Command substitution with backticks.
+                nested = CommandBlocker._tokenize(token[1:-1]) or []
+                for words, _, _ in CommandBlocker._simple_commands(nested):
+                    commands.insert(-1, words)
+                    redirected.insert(-1, True)
+                    captured.insert(-1, True)
+                continue
+            commands[-1].append(token)
+        return [command for command in zip(commands, redirected, captured) if command[0]]
+
+    @staticmethod
+    def _skip_options(words: list[str], index: int, value_options: set[str]) -> int:
+        """Returns the index of the first word from index on that is not an option or an option's value."""
+        while index < len(words) and words[index].startswith("-") and words[index] != "-":
+            word = words[index]
+            index += 1
+            if word == "--":
+                break
+            if word.startswith("--"):
+                index += word in value_options
+                continue
+            # Bundled short options, e.g. -Hu bob, or one with its value attached, e.g. -ubob.
+            for position, flag in enumerate(word[1:], start=1):
+                if f"-{flag}" in value_options:
+                    index += position == len(word) - 1
+                    break
+        return index
+
+    @staticmethod
+    def _check(words: list[str], redirected: bool = False, captured: bool = False) -> str | None:
+        # Skip variable assignments, redirections and wrappers such as sudo, to find the command that runs.
+        index = 0
+        while index < len(words):
+            word = words[index]
+            if "=" in word.split("/")[0] and not word.startswith("-"):
+                index += 1
+            elif word in CommandBlocker.prefixes:
+                value_options, arguments = CommandBlocker.prefixes[word]
+                index = CommandBlocker._skip_options(words, index + 1, value_options) + arguments
+            else:
+                break
+        words = [word for word in words[index:] if word not in ("<", "<<<", ">", ">>", ">&", "<&", "&>")]
+        if not words:
+            return None
+
+        command, args = words[0], words[1:]
+        name = os.path.basename(command)
+        if name in CommandBlocker.pagers and (captured or name == "top" and CommandBlocker._top_batch_mode(args)):
+            return None
+        if command in CommandBlocker.blocklist or name in CommandBlocker.blocklist:
+            return name
+        standalone = command in CommandBlocker.blocklist_standalone or name in CommandBlocker.blocklist_standalone
+        if standalone and not args and not redirected:
+            return name
+        if any(flag in args for flag in CommandBlocker.interactive_flags.get(name, [])):
+            return f"{name} {' '.join(flag for flag in args if flag.startswith('-'))}"
+        if name == "ssh" and CommandBlocker._skip_options(args, 0, CommandBlocker.ssh_value_options) == len(args) - 1:
+            # A destination and no remote command opens a login shell.
+            return name
+        if name in ("bash", "sh") and "-c" in args and args.index("-c") + 1 < len(args):
+            return CommandBlocker.blocked_command(args[args.index("-c") + 1])
+        if name == "git":
+            return CommandBlocker._check_git(args)
+        return None
 
-        command = args[0]
-        if command in CommandBlocker.blocklist:
-            return True
+    @staticmethod
+    def _top_batch_mode(args: list[str]) -> bool:
+        """Whether top is run with -b, on its own or bundled as in -bn1, so that it prints and exits."""
+        short_options = [arg[1:] for arg in args if arg.startswith("-") and not arg.startswith("--")]
+        return "--batch" in args or any("b" in options for options in short_options)
 
-        is_standalone = len(args) == 1
-        if is_standalone and command in CommandBlocker.blocklist_standalone:
-            return True
+    @staticmethod
+    def _check_git(args: list[str]) -> str | None:
+        """git only waits for a terminal when it opens an editor: a commit without a message or a rebase -i."""
+        index = 0
+        while index < len(args) and args[index].startswith("-"):
+            # -C <path> and -c <name>=<value> take the next word.
+            index += 2 if args[index] in ("-C", "-c") else 1
+        if index >= len(args):
+            return None
 
-        return False
+        subcommand, options = args[index], args[index + 1 :]
+        if subcommand == "commit":
+            for option in options:
+                if option.split("=")[0] in CommandBlocker.git_message_options:
+                    return None
+                # Bundled short options, e.g. -am.
+                if option.startswith("-") and not option.startswith("--") and set(option[1:]) & {"m", "F", "C"}:
+                    return None
+            return "git commit"
+        if subcommand == "rebase" and ("-i" in options or "--interactive" in options):
+            return "git rebase -i"
+        return None
@@ -0,0 +1,43 @@
+from commands.CommandParser import CommandParser
+
+
+class CommandDetector:
+    """Incrementally watches a streamed response for the first complete command tag.
+
+    With max_calls above 1, it instead waits for that many commands, or for one that must be called alone.
+    """
+
+    def __init__(self, parser: CommandParser, max_calls: int = 1):
+        self.parser = parser
+        self.max_calls = max_calls
+        self.closing_tags = [f"</{tag}>" for tag in parser.commands]
+        self.longest_tag = max((len(tag) for tag in self.closing_tags), default=0)
+        self.chunks: list[str] = []
+        self.tail = ""
+        self.end: int | None = None
+
+    def feed(self, chunk: str) -> bool:
+        """Adds a chunk of the response and returns whether the last command to wait for has arrived."""
+        if self.end is not None:
+            return True
+
+        self.chunks.append(chunk)
+
+        # Only rescan the whole response when a closing tag could have just been completed.
+        window = self.tail + chunk
+        self.tail = window[-(self.longest_tag - 1) :] if self.longest_tag > 1 else ""
+        if not any(tag in window for tag in self.closing_tags):
+            return False
+
+        self.end = self.parser.calls_end(self.text(), self.max_calls)
+        return self.end is not None
+
+    def text(self) -> str:
+        if len(self.chunks) > 1:
+            self.chunks = ["".join(self.chunks)]
+        return self.chunks[0] if self.chunks else ""
+
+    def response(self) -> str:
+        """Returns the response, cut off just after the last command waited for."""
+        text = self.text()
+        return text if self.end is None else text[: self.end]
@@ -0,0 +1,40 @@
+import re
+from collections.abc import Iterator
+
+from commands.BaseCommand import BaseCommand
+
+CommandCall = tuple[BaseCommand, str]
+
+
+class CommandParser:
+    """Finds every registered command in a response with one precompiled pattern and a single scan."""
+
+    def __init__(self, commands: list[BaseCommand]):
+        self.commands = {command.xml_tag: command for command in commands}
+        tags = "|".join(re.escape(tag) for tag in self.commands)
+        self.pattern = re.compile(f"<(/?)({tags})>") if self.commands else None
+
+    def _iter_calls(self, response: str) -> Iterator[tuple[BaseCommand, str, int]]:
+        # Matches BaseCommand.extract_content: the content runs from the last opening tag before a
+        # closing tag, so only the innermost of nested same-name tags is a call.
+        if self.pattern is None:
+            return
+
+        open_ends: dict[str, int] = {}
+        for match in self.pattern.finditer(response):
+            closing, tag = match.groups()
+            if not closing:
+                open_ends[tag] = match.end()
+            elif tag in open_ends:
+                yield self.commands[tag], response[open_ends.pop(tag) : match.start()], match.end()
+
+    def parse(self, response: str) -> list[CommandCall]:
+        """Returns the (command, content) pairs of the response in the order they were closed."""
+        return [(command, content) for command, content, _ in self._iter_calls(response)]
+
+    def calls_end(self, response: str, max_calls: int = 1) -> int | None:
+        """Returns the index just past the max_calls-th complete command, or past an exclusive one if sooner."""
+        for count, (command, _, end) in enumerate(self._iter_calls(response), start=1):
+            if count >= max_calls or command.exclusive:
+                return end
+        return None
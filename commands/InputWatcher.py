@@ -0,0 +1,119 @@
+import os
+import platform
+import time
+
+# Syscall numbers of read and readv, as shown in /proc/PID/syscall.
+READ_SYSCALLS = {
+    "x86_64": {0, 19},
+    "aarch64": {63, 65},
+}
+
+
+class CommandStalledError(Exception):
+    pass
+
+
+def process_group_pids(pgid: int) -> list[int]:
+    """Returns the pids of every process in the process group."""
+    pids = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # Fields after the parenthesised command name: state, ppid, pgrp, ...
+        if int(stat.rsplit(")", 1)[1].split()[2]) == pgid:
+            pids.append(int(entry))
+    return pids
+
+
+class InputWatcher:
+    """Gives a command a stdin that never receives input, and notices when the command waits on it.
+
+    The write end of the pipe is held open, so a read blocks instead of seeing end of file. check() raises
+    CommandStalledError once a process in the command's group has been blocked reading that pipe for input_wait
+    seconds, or, if idle_timeout is set, once the command has printed nothing for that long.
+    """
+
+    def __init__(self, input_wait: float | None = 1.0, idle_timeout: float | None = None):
+        self.input_wait = input_wait
+        self.idle_timeout = idle_timeout
+        self.read_fd, self.write_fd = os.pipe()
+        self.pipe = f"pipe:[{os.fstat(self.read_fd).st_ino}]"
+        self.read_syscalls = READ_SYSCALLS.get(platform.machine(), set())
+        self.pgid: int | None = None
+        self.last_output = time.monotonic()
+        self.waiting_since: float | None = None
+
+    def attach(self, pgid: int):
+        """Starts watching the process group. The child holds its own copy of the read end by now."""
+        self.pgid = pgid
+        self.last_output = time.monotonic()
+        os.close(self.read_fd)
+        self.read_fd = -1
+
+    def output(self):
+        self.last_output = time.monotonic()
+
+    def check(self):
+        now = time.monotonic()
+        if self.idle_timeout is not None and now - self.last_output >= self.idle_timeout:
+            raise CommandStalledError(
+                f"The command printed nothing for {self.idle_timeout:g} seconds and was stopped. "
+                "If it is meant to run for long, run it in the background and check on it later."
+            )
+
+        if self.input_wait is None or self.pgid is None:
+            return
+        waiting = next((pid for pid in process_group_pids(self.pgid) if self._waiting_for_input(pid)), None)
+        if waiting is None:
+            self.waiting_since = None
+        elif self.waiting_since is None:
+            self.waiting_since = now
+        elif now - self.waiting_since >= self.input_wait:
+            raise CommandStalledError(
+                f"The command was stopped because `{self._name(waiting)}` was waiting for input, which cannot be "
+                "given interactively. Use non-interactive flags (e.g. -y, --no-pager, --batch) or pipe the input "
+                "in, e.g. `printf 'y\\n' | command`."
+            )
+
+    def _waiting_for_input(self, pid: int) -> bool:
+        try:
+            if os.readlink(f"/proc/{pid}/fd/0") != self.pipe:
+                return False
+            with open(f"/proc/{pid}/syscall") as f:
+                syscall = f.read().split()
+        except OSError:
+            return False
+        if syscall and syscall[0].isdigit() and self.read_syscalls:
+            # A process blocked in read(0, ...).
+            return int(syscall[0]) in self.read_syscalls and int(syscall[1], 16) == 0
+        # The syscall is unknown on this architecture or hidden, so fall back to where the process sleeps.
+        try:
+            with open(f"/proc/{pid}/wchan") as f:
+                return "pipe_read" in f.read()
+        except OSError:
+            return False
+
+    @staticmethod
+    def _name(pid: int) -> str:
+        try:
+            with open(f"/proc/{pid}/comm") as f:
+                return f.read().strip()
+        except OSError:
+            return str(pid)
+
+    def __enter__(self) -> "InputWatcher":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for fd in (self.read_fd, self.write_fd):
+            if fd >= 0:
+                os.close(fd)
+        self.read_fd = self.write_fd = -1
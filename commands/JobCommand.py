@@ -0,0 +1,41 @@
+from commands.BaseCommand import BaseCommand, CallbackType
+from commands.JobManager import JobError, JobManager
+
+
+class JobCommand(BaseCommand):
+    exclusive = False
+    tool_argument = "action"
+    tool_argument_description = "One of `status`, `status ID`, `tail ID` or `kill ID`."
+
+    def __init__(self, jobs: JobManager, callback: CallbackType | None = None):
+        self.jobs = jobs
+        super().__init__(
+            xml_tag="job",
+            description="""To check on background jobs started with <bash_bg></bash_bg>, wrap one of these in <job></job> XML tags:
+<job>status</job> lists every job and whether it is still running.
+<job>status 1</job> shows whether job 1 is still running.
+<job>tail 1</job> shows the output job 1 has printed since you last looked.
+<job>kill 1</job> stops job 1 and everything it started.""",
+            callback=callback,
+        )
+
+    def _run(self, content: str) -> str:
+        action, *args = content.split() or ["status"]
+        try:
+            if action == "status" and not args:
+                return "JOB OUTPUT:\n" + ("\n".join(job.status() for job in self.jobs.jobs.values()) or "No jobs.")
+            if action not in ("status", "tail", "kill") or len(args) != 1 or not args[0].isdigit():
+                return "JOB ERROR:\nExpected `status`, `status ID`, `tail ID` or `kill ID`."
+
+            job = self.jobs.get(int(args[0]))
+            if action == "kill":
+                self.jobs.kill(job)
+                output = self.jobs.read_new(job)
+            elif action == "tail":
+                output = self.jobs.read_new(job) or "No new output."
+            else:
+                output = ""
+        except JobError as e:
+            return f"JOB ERROR:\n{e}"
+
+        return f"JOB OUTPUT:\n{job.status()}" + (f"\n\n{output}" if output else "")
@@ -0,0 +1,139 @@
+import os
+import signal
+import subprocess
+import threading
+import time
+from dataclasses import dataclass
+
+from commands.ResourceLimits import ResourceLimits, shell_command
+
+
+class JobError(Exception):
+    pass
+
+
+@dataclass
+class Job:
+    id: int
+    command: str
+    process: subprocess.Popen
+    output_path: str  # Stdout and stderr, interleaved as the command wrote them.
+    started: float
+    ended: float | None = None
+    killed: bool = False
+    read_offset: int = 0  # How much of the output has been returned by read_new.
+
+    @property
+    def running(self) -> bool:
+        if self.ended is None and self.process.poll() is not None:
+            self.ended = time.monotonic()
+        return self.ended is None
+
+    def status(self) -> str:
+        running = self.running
+        seconds = (time.monotonic() if running else self.ended) - self.started
+        if running:
+            state = f"running for {seconds:.0f}s"
+        elif self.killed:
+            state = f"killed after {seconds:.0f}s"
+        else:
+            state = f"exited with code {self.process.returncode} after {seconds:.0f}s"
+        return f"Job {self.id} [{state}]: {self.command}"
+
+
+class JobManager:
+    """Runs shell commands in the background and keeps their output in files until it is read.
+
+    Jobs are not bound by the bash timeout. Each one gets its own process group, so killing a job stops
+    everything it started, and any jobs still running when the manager is closed are killed.
+    """
+
+    def __init__(
+        self,
+        output_dir: str = "jobs",
+        cwd: str | None = None,
+        limits: ResourceLimits | None = None,
+        max_jobs: int = 4,
+        max_output_bytes: int = 20000,
+        max_output_lines: int = 400,
+    ):
+        self.output_dir = output_dir
+        self.cwd = cwd
+        self.limits = limits
+        self.max_jobs = max_jobs
+        self.max_output_bytes = max_output_bytes
+        self.max_output_lines = max_output_lines
+        self.jobs: dict[int, Job] = {}
+        self.lock = threading.Lock()
+
+    def start(self, command: str) -> Job:
+        with self.lock:
+            running = sum(job.running for job in self.jobs.values())
+            if running >= self.max_jobs:
+                raise JobError(f"{running} jobs are already running, the most allowed. Wait for one or kill one.")
+
+            job_id = len(self.jobs) + 1
+            os.makedirs(self.output_dir, exist_ok=True)
+            output_path = os.path.join(self.output_dir, f"job_{job_id:04d}.txt")
+            with open(output_path, "wb") as output:
+                process = subprocess.Popen(
+                    shell_command(command, self.limits),
+                    stdin=subprocess.DEVNULL,
+                    stdout=output,
+                    stderr=subprocess.STDOUT,
+                    cwd=self.cwd,
+                    start_new_session=True,
+                )
+            job = Job(job_id, command, process, output_path, time.monotonic())
+            self.jobs[job_id] = job
+            return job
+
+    def get(self, job_id: int) -> Job:
+        if job_id not in self.jobs:
+            raise JobError(f"There is no job {job_id}.")
+        return self.jobs[job_id]
+
+    def read_new(self, job: Job) -> str:
+        """Returns the output the job has written since the last call, keeping only its tail if it is long."""
+        with self.lock:
+            running = job.running
+            with open(job.output_path, "rb") as f:
+                f.seek(job.read_offset)
+                data = f.read()
+            if running and b"\n" in data:
+                # Leave a partly written last line for the next read.
+                data = data[: data.rindex(b"\n") + 1]
+            job.read_offset += len(data)
+
+        skipped = max(0, len(data) - self.max_output_bytes)
+        data = data[skipped:]
+        lines = data.decode(errors="replace").splitlines(keepends=True)
+        if len(lines) > self.max_output_lines:
+            skipped += sum(len(line.encode()) for line in lines[: -self.max_output_lines])
+            lines = lines[-self.max_output_lines :]
+        text = "".join(lines)
+        if skipped:
+            text = f"[{skipped} earlier bytes skipped; the full output is in {job.output_path}]\n" + text
+        return text
+
+    def kill(self, job: Job, grace: float = 2.0):
+        """Stops the job's process group, giving it grace seconds to exit before it is killed outright."""
+        if not job.running:
+            return
+        job.killed = True
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(job.process.pid, sig)
+            except ProcessLookupError:
+                break
+            try:
+                job.process.wait(timeout=grace)
+                break
+            except subprocess.TimeoutExpired:
+                continue
+        if job.ended is None:
+            job.ended = time.monotonic()
+
+    def close(self):
+        for job in self.jobs.values():
+            self.kill(job, grace=0.5)
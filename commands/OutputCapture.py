@@ -0,0 +1,65 @@
+import os
+
+
+class OutputCapture:
+    """Collects a command's output stream in bounded memory.
+
+    Output up to the caps is kept whole. Past either cap, only the head and tail are kept in memory and the
+    full stream is spilled to disk, so that the agent can page through it with other commands. The tail is a
+    rolling window over everything written, so it is there whichever cap is reached first.
+    """
+
+    def __init__(self, max_bytes: int, max_lines: int, spill_path: str):
+        self.max_bytes = max_bytes
+        self.max_lines = max_lines
+        self.spill_path = spill_path
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total_bytes = 0
+        self.total_lines = 0
+        self.spill_file = None
+
+    @property
+    def truncated(self) -> bool:
+        return self.spill_file is not None
+
+    def write(self, data: bytes):
+        self.total_bytes += len(data)
+        self.total_lines += data.count(b"\n")
+        self.tail += data
+        del self.tail[: max(0, len(self.tail) - self.max_bytes // 2)]
+
+        if self.spill_file is None:
+            self.head += data
+            if len(self.head) > self.max_bytes or self.total_lines > self.max_lines:
+                self._start_spilling()
+            return
+
+        self.spill_file.write(data)
+
+    def _start_spilling(self):
+        os.makedirs(os.path.dirname(self.spill_path) or ".", exist_ok=True)
+        self.spill_file = open(self.spill_path, "wb")
+        self.spill_file.write(self.head)
+        del self.head[self.max_bytes // 2 :]
+
+    def close(self):
+        if self.spill_file is not None:
+            self.spill_file.close()
+
+    def render(self) -> str:
+        self.close()
+        if not self.truncated:
+            return self.head.decode(errors="replace")
+
+        half_lines = self.max_lines // 2
+        head_lines = self.head.decode(errors="replace").split("\n")[:half_lines]
+        tail = self.tail.decode(errors="replace")
+        # A final newline ends the last line rather than starting another one.
+        tail_lines = tail.removesuffix("\n").split("\n")[-half_lines:] if half_lines else []
+        marker = (
+            f"\n... [OUTPUT TRUNCATED: {self.total_bytes} bytes, {self.total_lines} lines in total. "
+            f"The full output was saved to {os.path.abspath(self.spill_path)}; "
+            "use head, tail, sed -n or grep to page through it.] ...\n"
+        )
+        return "\n".join(head_lines) + marker + "\n".join(tail_lines) + ("\n" if tail.endswith("\n") else "")
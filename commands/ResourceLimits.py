@@ -0,0 +1,65 @@
+import signal
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class ResourceLimits:
+    """Per-process rlimits applied to every bash command and the processes it starts.
+
+    The limits are set with ulimit by the shell that runs the command, so they cover the whole process tree and,
+    unlike a preexec_fn, are safe to use while other threads are running. As with any rlimit, the process count
+    is per user and is not enforced for root.
+    """
+
+    cpu_seconds: int | None = None  # CPU time of each process.
+    memory_mb: int | None = None  # Address space of each process.
+    open_files: int | None = None  # Open file descriptors of each process.
+    processes: int | None = None  # Processes of the user running the commands.
+
+    def __bool__(self) -> bool:
+        return any(limit is not None for limit in (self.cpu_seconds, self.memory_mb, self.open_files, self.processes))
+
+    def ulimit(self, cpu: bool = True) -> list[str]:
+        """bash ulimit commands that set the limits on the shell running them and everything it starts."""
+        commands = []
+        if cpu and self.cpu_seconds is not None:
+            # A higher hard limit makes the kernel send SIGXCPU first, so the overrun can be told apart from a kill.
+            commands += [f"ulimit -S -t {self.cpu_seconds}", f"ulimit -H -t {self.cpu_seconds + 1}"]
+        if self.memory_mb is not None:
+            commands.append(f"ulimit -v {self.memory_mb * 1024}")
+        if self.open_files is not None:
+            commands.append(f"ulimit -n {self.open_files}")
+        if self.processes is not None:
+            commands.append(f"ulimit -u {self.processes}")
+        return commands
+
+    def exceeded(self, returncode: int | None, stderr: str) -> str | None:
+        """Returns a message naming the limit the command most likely ran into, if any."""
+        if self.cpu_seconds is not None and returncode in (-signal.SIGXCPU, 128 + signal.SIGXCPU):
+            return f"CPU time limit of {self.cpu_seconds} seconds"
+        if self.memory_mb is not None and any(
+            error in stderr for error in ("MemoryError", "Cannot allocate memory", "bad_alloc", "out of memory")
+        ):
+            return f"memory limit of {self.memory_mb} MB"
+        if self.open_files is not None and "Too many open files" in stderr:
+            return f"open file limit of {self.open_files}"
+        if self.processes is not None and "fork" in stderr and "Resource temporarily unavailable" in stderr:
+            return f"process limit of {self.processes}"
+        return None
+
+
+def limited(program: list[str], limits: ResourceLimits | None, cpu: bool = True) -> list[str]:
+    """Returns the arguments that run the program under the limits.
+
+    bash sets the limits and then replaces itself with the program, so the program keeps its pid and process
+    group. If a limit cannot be set, bash exits with an error instead of running the program without it.
+    """
+    commands = limits.ulimit(cpu) if limits else []
+    if not commands:
+        return program
+    return ["bash", "-c", " && ".join([*commands, 'exec "$@"']), "bash", *program]
+
+
+def shell_command(command: str, limits: ResourceLimits | None) -> list[str]:
+    """The arguments that run a shell command like Popen(command, shell=True) does, under the limits."""
+    return limited(["/bin/sh", "-c", command], limits)
@@ -0,0 +1,172 @@
+import math
+import os
+import re
+import selectors
+import signal
+import subprocess
+import tempfile
+import time
+import uuid
+
+from commands.InputWatcher import process_group_pids
+from commands.OutputCapture import OutputCapture
+from commands.ResourceLimits import ResourceLimits, limited
+
+
+class ShellSession:
+    """A long-lived bash process that keeps its working directory, variables and functions between commands.
+
+    The CPU time limit is set for each command rather than for the shell, whose own CPU time adds up across
+    commands: the soft limit is raised to what the shell has used so far plus the allowance, and lifted again
+    once the command has finished.
+    """
+
+    def __init__(self, cwd: str | None = None, limits: ResourceLimits | None = None):
+        self.cwd = cwd
+        self.limits = limits
+        self.process: subprocess.Popen | None = None
+        self.sentinel = f"__SHELL_SESSION_{uuid.uuid4().hex}__"
+        self.sentinel_pattern = re.compile(re.escape(self.sentinel).encode() + rb"(\d*)\n")
+
+    def start(self):
+        self.process = subprocess.Popen(
+            limited(["bash", "--noprofile", "--norc"], self.limits, cpu=False),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=self.cwd,
+            start_new_session=True,
+        )
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def run(
+        self, command: str, timeout: float, stdout: OutputCapture, stderr: OutputCapture
+    ) -> subprocess.CompletedProcess:
+        """Runs a command in the session. Raises subprocess.TimeoutExpired if it does not finish in time."""
+        if not self.is_alive():
+            self.start()
+
+        # The command is sourced from a file so that it cannot read the framing out of the shell's stdin.
+        with tempfile.NamedTemporaryFile("w", suffix=".sh", delete=False) as script:
+            script.write(command + "\n")
+
+        try:
+            self.process.stdin.write(
+                f"{self._cpu_limit(running=True)}"
+                f". {script.name} </dev/null\n"
+                f"printf '%s%d\\n' {self.sentinel} $?\n"
+                f"{self._cpu_limit(running=False)}"
+                f"printf '%s\\n' {self.sentinel} >&2\n".encode()
+            )
+            self.process.stdin.flush()
+            try:
+                returncode = self._read_until_sentinel(time.monotonic() + timeout, stdout, stderr)
+            except TimeoutError:
+                self.interrupt()
+                raise subprocess.TimeoutExpired(command, timeout)
+        except BrokenPipeError:
+            returncode = None
+        finally:
+            os.unlink(script.name)
+
+        if returncode is None:
+            # The shell exited mid-command (e.g. the command called `exit`), so start a fresh one next time.
+            returncode = self.process.wait()
+            self.process = None
+
+        return subprocess.CompletedProcess(command, returncode, stdout.render(), stderr.render())
+
+    def _cpu_limit(self, running: bool) -> str:
+        """The ulimit line that sets the shell's soft CPU limit before a command runs, or lifts it afterwards."""
+        if self.limits is None or self.limits.cpu_seconds is None:
+            return ""
+        seconds = self.limits.cpu_seconds + self._shell_cpu_seconds() if running else "unlimited"
+        return f"ulimit -S -t {seconds}\n"
+
+    def _shell_cpu_seconds(self) -> int:
+        with open(f"/proc/{self.process.pid}/stat") as f:
+            # The fields after the parenthesised command name start at the state; utime and stime follow.
+            fields = f.read().rpartition(")")[2].split()
+        return math.ceil((int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK"))
+
+    def _read_until_sentinel(
+        self, deadline: float, stdout: OutputCapture | None = None, stderr: OutputCapture | None = None
+    ) -> int | None:
+        """Reads both streams up to their sentinels into the captures, returning the command's exit code.
+
+        Returns None if the shell died and raises TimeoutError past the deadline. Output is discarded when no
+        captures are given.
+        """
+        captures = {self.process.stdout: stdout, self.process.stderr: stderr}
+        pending = {stream: bytearray() for stream in captures}
+        exit_codes: dict = {}
+        # Enough trailing bytes are held back from the captures to catch a sentinel split across reads.
+        keep = len(self.sentinel) + 16
+
+        def flush(stream, data: bytes):
+            if captures[stream] is not None:
+                captures[stream].write(data)
+
+        with selectors.DefaultSelector() as selector:
+            for stream in captures:
+                os.set_blocking(stream.fileno(), False)
+                selector.register(stream, selectors.EVENT_READ)
+
+            while len(exit_codes) < len(captures):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    # Keep the partial output that was held back while looking for the sentinels.
+                    for stream, buffer in pending.items():
+                        if stream not in exit_codes:
+                            flush(stream, bytes(buffer))
+                    raise TimeoutError
+
+                for key, _ in selector.select(timeout=remaining):
+                    stream = key.fileobj
+                    buffer = pending[stream]
+                    data = os.read(stream.fileno(), 65536)
+                    if not data:
+                        for stream, buffer in pending.items():
+                            flush(stream, bytes(buffer))
+                        return None
+
+                    buffer += data
+                    match = self.sentinel_pattern.search(buffer)
+                    if match:
+                        exit_codes[stream] = match.group(1)
+                        flush(stream, bytes(buffer[: match.start()]))
+                        selector.unregister(stream)
+                    elif len(buffer) > keep:
+                        flush(stream, bytes(buffer[:-keep]))
+                        del buffer[:-keep]
+
+        return int(exit_codes[self.process.stdout])
+
+    def interrupt(self):
+        """Kills the running command, restarting the shell only if the command cannot be stopped on its own."""
+        for pid in self._child_pids():
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+        # Builtins such as `while true; do :; done` run inside the shell itself, so the shell has to go too.
+        try:
+            self._read_until_sentinel(time.monotonic() + 1)
+        except TimeoutError:
+            self.close()
+
+    def _child_pids(self) -> list[int]:
+        return [pid for pid in process_group_pids(self.process.pid) if pid != self.process.pid]
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.process.wait()
+        self.process = None
@@ -2,6 +2,9 @@ from commands.BaseCommand import BaseCommand, CallbackType
 
 
 class SubmitCommand(BaseCommand):
+    tool_argument = "answer"
+    tool_argument_description = "The answer to submit."
+
     def __init__(self, submission_path: str, callback: CallbackType | None = None):
         super().__init__(
             xml_tag="submit",
@@ -1,4 +1,25 @@
-from commands.BaseCommand import BaseCommand, CallbackType
+import importlib
+
+from commands.BaseCommand import BaseCommand, CallbackType, ToolCall, ToolSpec
 from commands.BashCommand import BashCommand
+from commands.ResourceLimits import ResourceLimits
 from commands.SubmitCommand import SubmitCommand
-from commands.BrowseCommand import BrowseCommand
\ No newline at end of file
+from commands.BrowseCommand import BrowseCommand
+from commands.BrowserManager import BrowserError, BrowserManager, close_browsers, get_browser_manager
+from commands.CommandDetector import CommandDetector
+from commands.CommandParser import CommandCall, CommandParser
+
+# Background jobs are optional, so their modules are only imported when one of their names is first used.
+_LAZY = {
+    "BackgroundCommand": "commands.BackgroundCommand",
+    "JobCommand": "commands.JobCommand",
+    "Job": "commands.JobManager",
+    "JobError": "commands.JobManager",
+    "JobManager": "commands.JobManager",
+}
+
+
+def __getattr__(name: str):
+    if name not in _LAZY:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(importlib.import_module(_LAZY[name]), name)
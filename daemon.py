@@ -0,0 +1,357 @@
+"""Runs agents from one long-lived process, so tasks skip interpreter start-up, SDK imports and client set-up.
+
+Tasks are submitted over localhost HTTP or a Unix socket and run on a fixed pool of worker threads, which share
+warm provider clients and the rendered system message. Events are streamed back as JSON lines.
+
+Endpoints:
+    POST /tasks     Submits a task, e.g. {"id": "task-1", "instructions": "..."}, and streams its events:
+                    queued, started, one turn event per turn, and finished with the result. With "wait": false
+                    in the body, only the queued event is returned.
+    GET /tasks/ID   Streams the task's events from the start, following them until it finishes. Finished tasks
+                    are kept for FINISHED_TASK_TTL seconds, and only the MAX_FINISHED_TASKS most recent ones.
+    GET /stats      Queue depth, worker utilization and task counts.
+
+Usage: python daemon.py --model MODEL [--port PORT | --socket_path PATH] [--workers N]
+Example: curl -N localhost:8765/tasks -d '{"instructions": "Print the date."}'
+"""
+
+import json
+import os
+import queue
+import re
+import signal
+import socketserver
+import threading
+import time
+import uuid
+from collections.abc import Iterator
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+from Agent import Agent, AgentArguments
+from APIModel import get_model
+from batch import agent_result, task_arguments, task_log_path
+from commands import get_browser_manager
+from History import Role
+from Logger import LogArguments, log_run, logger, setup_logging
+from main import ScriptArguments, initialize_agent
+from Metrics import MetricsExporter
+from simple_parsing import parse
+from simple_parsing.helpers import FlattenedAccess, FrozenSerializable
+
+
+# Task ids name their run directory, so they may not contain path separators or start with a dot.
+TASK_ID_PATTERN = re.compile(r"[A-Za-z0-9_-][A-Za-z0-9_.-]*")
+
+
+@dataclass(frozen=True)
+class DaemonArguments(FlattenedAccess, FrozenSerializable):
+    agent: AgentArguments
+    host: str = "127.0.0.1"  # The address to serve HTTP on. Keep it local; there is no authentication.
+    port: int = 8765
+    socket_path: str | None = None  # Serves on this Unix socket instead of HOST:PORT.
+    workers: int = 4  # The number of tasks to run concurrently.
+    output_dir: str = "daemon_runs"  # Each task gets its own directory under here.
+    results_path: str | None = None  # Every finished task's result. Defaults to OUTPUT_DIR/results.jsonl.
+    show_demonstration: bool = True  # Whether to show the demonstration.
+    log: LogArguments = field(default_factory=LogArguments)  # Each task also gets its own log file.
+    metrics_exporter: str | None = None  # "prometheus", "prometheus:PORT" or "module:factory" to export metrics.
+    warm_browser: bool = False  # Whether to start the browser daemon up front instead of on the first browse-*.
+    finished_task_ttl: float = 3600.0  # Seconds a finished task's events can still be followed for.
+    max_finished_tasks: int = 1000  # The number of finished tasks kept in memory; the oldest are dropped first.
+
+
+class Task:
+    """A submitted task and the events it has produced, which any number of clients can follow."""
+
+    def __init__(self, task_id: str, args: ScriptArguments):
+        self.id = task_id
+        self.args = args
+        self.submitted = time.monotonic()
+        self.events: list[dict[str, Any]] = []
+        self.finished = False
+        self.finished_at: float | None = None
+        self.condition = threading.Condition()
+
+    def emit(self, event: str, **fields: Any):
+        with self.condition:
+            self.events.append({"event": event, "id": self.id, "time": time.time(), **fields})
+            if event == "finished" and not self.finished:
+                self.finished = True
+                self.finished_at = time.monotonic()
+            self.condition.notify_all()
+
+    def follow(self) -> Iterator[dict[str, Any]]:
+        """Yields every event from the first, blocking for new ones until the task finishes."""
+        index = 0
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: len(self.events) > index or self.finished)
+                events = self.events[index:]
+                done = self.finished
+            index += len(events)
+            yield from events
+            if done:
+                return
+
+
+class TurnEvents(MetricsExporter):
+    """Emits each turn of an agent as an event of its task, passing the record on to the daemon's exporter."""
+
+    def __init__(self, task: Task, agent: Agent, exporter: MetricsExporter | None):
+        self.task = task
+        self.agent = agent
+        self.exporter = exporter
+
+    def export(self, record: dict[str, Any]):
+        if self.exporter is not None:
+            self.exporter.export(record)
+
+        history = self.agent.history
+        # The turn's response is the last assistant message, and its output the user message after it, if any.
+        index = next((i for i in range(len(history) - 1, -1, -1) if history[i]["role"] == Role.assistant), None)
+        self.task.emit(
+            "turn",
+            turn=record["turn"],
+            seconds=record["seconds"],
+            usage=record["usage"],
+            stop_reason=record["stop_reason"],
+            cost=record["cost"],
+            response=None if index is None else history[index]["content"],
+            output=history[index + 1]["content"] if index is not None and index + 1 < len(history) else None,
+        )
+
+
+class AgentDaemon:
+    def __init__(self, args: DaemonArguments):
+        self.args = args
+        self.queue: queue.Queue[Task | None] = queue.Queue()
+        self.tasks: dict[str, Task] = {}
+        self.workers: list[threading.Thread] = []
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.busy = 0
+        self.busy_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.completed = 0
+        self.failed = 0
+        results_path = args.results_path or os.path.join(args.output_dir, "results.jsonl")
+        os.makedirs(os.path.dirname(os.path.abspath(results_path)), exist_ok=True)
+        self.results_file = open(results_path, "a")
+
+    def warm_up(self):
+        """Imports the provider SDK and builds its client now, so that the first task does not pay for it."""
+        start = time.perf_counter()
+        # Only the pooled client is kept; the model's own resources, such as a hedge executor, are released.
+        model = get_model(self.args.agent.model)
+        try:
+            if self.args.warm_browser:
+                get_browser_manager(
+                    self.args.agent.browser_start_command,
+                    self.args.agent.browser_probe_command,
+                    self.args.agent.browser_ready_timeout,
+                ).ensure_started()
+        finally:
+            model.close()
+        logger.info(f"====DAEMON====\nWarmed up in {time.perf_counter() - start:.2f}s.\n\n\n")
+
+    def start(self):
+        for index in range(self.args.workers):
+            worker = threading.Thread(target=self._work, name=f"agent-worker-{index}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, task: dict) -> Task:
+        if not isinstance(task.get("instructions"), str):
+            raise ValueError('The task needs "instructions".')
+        task["id"] = str(task.get("id") or uuid.uuid4().hex[:12])
+        if not TASK_ID_PATTERN.fullmatch(task["id"]):
+            raise ValueError(f"Invalid task id {task['id']!r}. Use letters, digits, _, - and ., not starting with '.'.")
+        with self.lock:
+            self._evict()
+            if task["id"] in self.tasks and not self.tasks[task["id"]].finished:
+                raise ValueError(f"Task {task['id']} is already queued or running.")
+            # A finished task's directory holds its journal, which a new run under the same id would resume.
+            if task["id"] in self.tasks or os.path.exists(os.path.join(self.args.output_dir, task["id"])):
+                raise ValueError(f"Task {task['id']} has already run. Submit it with a new id.")
+            submitted = Task(task["id"], task_arguments(self.args, task))
+            self.tasks[submitted.id] = submitted
+        submitted.emit("queued", position=self.queue.qsize() + 1)
+        self.queue.put(submitted)
+        return submitted
+
+    def _evict(self):
+        """Drops finished tasks past their TTL, then the oldest ones past the maximum. Called with the lock held."""
+        now = time.monotonic()
+        finished = sorted((task for task in self.tasks.values() if task.finished), key=lambda task: task.finished_at)
+        expired = [task for task in finished if now - task.finished_at > self.args.finished_task_ttl]
+        excess = finished[len(expired) :][: max(0, len(finished) - len(expired) - self.args.max_finished_tasks)]
+        for task in expired + excess:
+            del self.tasks[task.id]
+
+    def _work(self):
+        while (task := self.queue.get()) is not None:
+            with self.lock:
+                self.busy += 1
+                self.wait_seconds += time.monotonic() - task.submitted
+            start = time.monotonic()
+            try:
+                result = self._run(task)
+            finally:
+                with self.lock:
+                    self.busy -= 1
+                    self.busy_seconds += time.monotonic() - start
+            with self.lock:
+                self.completed += 1
+                self.failed += result["error"] is not None
+                self.results_file.write(json.dumps(result) + "\n")
+                self.results_file.flush()
+            task.emit("finished", result=result)
+
+    def _run(self, task: Task) -> dict:
+        task.emit("started")
+        start = time.perf_counter()
+        result = {"id": task.id, "submitted": False, "submission": None, "error": None}
+        agent = None
+        with log_run(task.id, task_log_path(task.args)):
+            try:
+                agent = initialize_agent(task.args)
+                agent.metrics.exporter = TurnEvents(task, agent, agent.metrics.exporter)
+                agent.loop()
+                agent.save_history(task.args.history_path)
+                result.update(agent_result(agent, task.args))
+            except Exception as e:
+                logger.error(f"Task {task.id} failed: {e}", exc_info=True)
+                result["error"] = f"{type(e).__name__}: {e}"
+            finally:
+                if agent is not None:
+                    agent.close()
+        result["duration"] = time.perf_counter() - start
+        return result
+
+    def stats(self) -> dict:
+        with self.lock:
+            uptime = time.monotonic() - self.started
+            started = self.completed + self.busy
+            return {
+                "queue_depth": self.queue.qsize(),
+                "workers": len(self.workers),
+                "busy_workers": self.busy,
+                "utilization": self.busy_seconds / (uptime * len(self.workers)) if self.workers else 0.0,
+                "completed": self.completed,
+                "failed": self.failed,
+                "mean_wait_seconds": self.wait_seconds / started if started else None,
+                "uptime_seconds": uptime,
+            }
+
+    def close(self):
+        """Lets the workers finish their current tasks; queued tasks are dropped."""
+        while not self.queue.empty():
+            task = self.queue.get_nowait()
+            if task is not None:
+                task.emit("finished", result={"id": task.id, "error": "The daemon shut down."})
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.results_file.close()
+
+
+class DaemonHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "ThreadingHTTPServer"
+    daemon: AgentDaemon
+
+    def log_message(self, format: str, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.rstrip("/")
+        if path == "/stats":
+            return self.send_json(self.daemon.stats())
+        if path.startswith("/tasks/"):
+            task = self.daemon.tasks.get(path.removeprefix("/tasks/"))
+            if task is None:
+                return self.send_json({"error": f"Unknown task {path.removeprefix('/tasks/')}"}, status=404)
+            return self.send_events(task.follow())
+        self.send_json({"error": f"Unknown endpoint {self.path}"}, status=404)
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/tasks":
+            return self.send_json({"error": f"Unknown endpoint {self.path}"}, status=404)
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            wait = request.pop("wait", True)
+            task = self.daemon.submit(request)
+        except (ValueError, AttributeError) as e:
+            return self.send_json({"error": str(e)}, status=400)
+        if not wait:
+            return self.send_json(task.events[0], status=202)
+        self.send_events(task.follow())
+
+    def send_json(self, body: dict, status: int = 200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_events(self, events: Iterator[dict]):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for event in events:
+                line = (json.dumps(event) + "\n").encode()
+                self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away; the task carries on and can be followed again.
+            self.close_connection = True
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # Unix sockets have no client address, which the HTTP handler expects.
+        request, _ = super().get_request()
+        return request, ("local", 0)
+
+
+def make_server(args: DaemonArguments, daemon: AgentDaemon) -> socketserver.BaseServer:
+    handler = type("BoundDaemonHandler", (DaemonHandler,), {"daemon": daemon})
+    if args.socket_path is None:
+        return ThreadingHTTPServer((args.host, args.port), handler)
+    if os.path.exists(args.socket_path):
+        os.unlink(args.socket_path)
+    return UnixHTTPServer(args.socket_path, handler)
+
+
+def main(args: DaemonArguments):
+    setup_logging(args.log)
+    daemon = AgentDaemon(args)
+    daemon.warm_up()
+    daemon.start()
+    server = make_server(args, daemon)
+    # SIGTERM shuts down like Ctrl-C; serve_forever is stopped from another thread so it can return.
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    address = args.socket_path or f"http://{args.host}:{args.port}"
+    logger.info(f"====DAEMON====\nServing on {address} with {args.workers} workers.\n\n\n")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.close()
+        if args.socket_path is not None and os.path.exists(args.socket_path):
+            os.unlink(args.socket_path)
+
+
+if __name__ == "__main__":
+    main(parse(DaemonArguments))
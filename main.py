@@ -1,12 +1,24 @@
+import functools
 import json
-from dataclasses import dataclass
+import os
+import uuid
+from dataclasses import dataclass, field
 
 from Agent import Agent, AgentArguments
-from commands import BashCommand, SubmitCommand, BrowseCommand
-from Logger import logger
+from History import FsyncPolicy
+from Metrics import get_exporter
+from commands import BashCommand, BrowseCommand, ResourceLimits, SubmitCommand, get_browser_manager
+from Logger import LogArguments, log_run, logger, setup_logging
 from simple_parsing import parse
 from simple_parsing.helpers import FlattenedAccess, FrozenSerializable
-from templates import DEMONSTRATION, DEMONSTRATION_TEMPLATE, INSTRUCTION_TEMPLATE, SYSTEM_TEMPLATE
+from templates import (
+    DEMONSTRATION,
+    DEMONSTRATION_TEMPLATE,
+    INSTRUCTION_TEMPLATE,
+    NATIVE_TOOLS_TEMPLATE,
+    PARALLEL_COMMANDS_TEMPLATE,
+    SYSTEM_TEMPLATE,
+)
 
 
 @dataclass(frozen=True)
@@ -15,25 +27,105 @@ class ScriptArguments(FlattenedAccess, FrozenSerializable):
     instructions: str  # The instructions for the agent to follow.
     submission_path: str = "/home/agent/submission.txt"  # The path to save the submission to.
     show_demonstration: bool = True  # Whether to show the demonstration.
+    history_path: str = "history.json"  # The path to save the history to.
+    working_dir: str | None = None  # The directory bash commands run in. Defaults to the current directory.
+    run_dir: str = "."  # The directory for this run's files, such as full bash outputs.
+    run_id: str | None = None  # The ID this run's log records are tagged with. Random if not set.
+    log: LogArguments = field(default_factory=LogArguments)
+    journal_path: str = "journal.jsonl"  # The path each message is appended to as it happens.
+    journal_fsync: FsyncPolicy = FsyncPolicy.turn  # How often the journal is forced to disk.
+    resume: bool = False  # Whether to carry on from the journal at JOURNAL_PATH instead of starting over.
+    metrics_path: str | None = "metrics.jsonl"  # The file per-turn timings, tokens and costs are written to.
+    metrics_exporter: str | None = None  # "prometheus", "prometheus:PORT" or "module:factory" to export metrics.
 
 
-def initialize_agent(args: ScriptArguments):
-    agent = Agent(args.agent)
+def initialize_agent(args: ScriptArguments, agent_class: type[Agent] = Agent):
+    agent = agent_class(args.agent)
+    limits = ResourceLimits(
+        cpu_seconds=args.agent.bash_cpu_seconds,
+        memory_mb=args.agent.bash_memory_mb,
+        open_files=args.agent.bash_open_files,
+        processes=args.agent.bash_processes,
+    )
     commands = [
         SubmitCommand(args.submission_path, agent._submit_callback),
-        BashCommand(args.agent.bash_timeout),
+        BashCommand(
+            args.agent.bash_timeout,
+            persistent=args.agent.bash_persistent,
+            cwd=args.working_dir,
+            max_output_bytes=args.agent.bash_max_output_bytes,
+            max_output_lines=args.agent.bash_max_output_lines,
+            spill_dir=os.path.join(args.run_dir, "bash_outputs"),
+            browser=get_browser_manager(
+                args.agent.browser_start_command,
+                args.agent.browser_probe_command,
+                args.agent.browser_ready_timeout,
+            ),
+            limits=limits,
+            input_wait=args.agent.bash_input_wait,
+            idle_timeout=args.agent.bash_idle_timeout,
+        ),
         BrowseCommand(),
     ]
-    command_descriptions = "\n".join([str(command) for command in commands])
+    if args.agent.background_jobs:
+        from commands import BackgroundCommand, JobCommand, JobManager
+
+        jobs = JobManager(
+            output_dir=os.path.join(args.run_dir, "jobs"),
+            cwd=args.working_dir,
+            limits=limits,
+            max_jobs=args.agent.max_background_jobs,
+            max_output_bytes=args.agent.bash_max_output_bytes,
+            max_output_lines=args.agent.bash_max_output_lines,
+        )
+        commands += [BackgroundCommand(jobs), JobCommand(jobs)]
     agent.add_commands(commands)
-    sys_msg = SYSTEM_TEMPLATE.format(command_descriptions=command_descriptions)
-    if args.show_demonstration:
-        sys_msg += DEMONSTRATION_TEMPLATE.format(demonstration=DEMONSTRATION)
-    agent.add_system_msg(sys_msg)
+    resume = args.resume and os.path.exists(args.journal_path) and os.path.getsize(args.journal_path) > 0
+    if resume:
+        agent.resume(args.journal_path, args.journal_fsync)
+    agent.open_metrics(args.metrics_path, get_exporter(args.metrics_exporter), resume=resume)
+    if resume:
+        return agent
+
+    agent.open_journal(args.journal_path, args.journal_fsync)
+    command_descriptions = "\n".join([str(command) for command in commands])
+    agent.add_system_msg(
+        render_system_msg(
+            command_descriptions,
+            args.agent.max_parallel_commands,
+            tuple(command.xml_tag for command in commands if not command.exclusive),
+            args.agent.native_tools,
+            args.show_demonstration,
+        )
+    )
     agent.add_user_msg(INSTRUCTION_TEMPLATE.format(instructions=args.instructions))
     return agent
 
 
+@functools.lru_cache(maxsize=8)
+def render_system_msg(
+    command_descriptions: str,
+    max_parallel_commands: int,
+    parallel_commands: tuple[str, ...],
+    native_tools: bool,
+    show_demonstration: bool,
+) -> str:
+    """Renders the system message. It is the same for every run with the same commands, so it is built once.
+
+    parallel_commands are the tags of the commands that may be called together, i.e. those not exclusive.
+    """
+    sys_msg = SYSTEM_TEMPLATE.format(command_descriptions=command_descriptions)
+    if max_parallel_commands > 1 and parallel_commands:
+        tags = [f"<{tag}></{tag}>" for tag in parallel_commands]
+        commands = tags[0] if len(tags) == 1 else f"{', '.join(tags[:-1])} or {tags[-1]}"
+        sys_msg += PARALLEL_COMMANDS_TEMPLATE.format(max_commands=max_parallel_commands, commands=commands)
+    if native_tools:
+        sys_msg += NATIVE_TOOLS_TEMPLATE
+    if show_demonstration:
+        sys_msg += DEMONSTRATION_TEMPLATE.format(demonstration=DEMONSTRATION)
+    return sys_msg
+
+
 def log_args(args: ScriptArguments):
     args_dict = args.to_dict()
     del args_dict["agent"]["model"]["openai_api_key"]
@@ -45,16 +137,28 @@ def log_args(args: ScriptArguments):
     logger.info(f"====RUN ARGS====\n{arg_str}\n\n\n")
 
 
-def main(args: ScriptArguments):
+def run(args: ScriptArguments):
+    agent = None
     try:
         log_args(args)
         agent = initialize_agent(args)
         agent.loop()
-        agent.save_history("history.json")
+        agent.save_history(args.history_path)
+        logger.info(f"====TOTAL USAGE====\n{agent.model.usage}\n\n\n")
+        logger.info(f"====METRICS====\n{agent.metrics.summary()}\n\n\n")
     except KeyboardInterrupt:
         logger.error("KeyboardInterrupt caught", exc_info=True)
     except Exception as e:
         logger.error(f"Error: {e}", exc_info=True)
+    finally:
+        if agent is not None:
+            agent.close()
+
+
+def main(args: ScriptArguments):
+    setup_logging(args.log)
+    with log_run(args.run_id or uuid.uuid4().hex[:12]):
+        run(args)
 
 
 if __name__ == "__main__":
@@ -12,6 +12,17 @@ Only write out the full command XML tags when you are ready to execute them. You
 
 TOO_MANY_COMMANDS = "ERROR: You called too many commands. Only one command can be called at a time."
 NO_COMMANDS_CALLED = "ERROR: No valid command was called."
+TOO_MANY_PARALLEL_COMMANDS = "ERROR: You called too many commands. At most {max_commands} commands can be called at a time."
+EXCLUSIVE_COMMAND = "ERROR: The {command} command must be called on its own."
+COMMAND_OUTPUT_LABEL = "[Output of command {index} of {count}: {command}]"
+
+PARALLEL_COMMANDS_TEMPLATE = """
+
+Exception: you may call up to {max_commands} {commands} commands in one response when they do not depend on each other, such as several read-only inspections. They may run at the same time, and their outputs are returned together in the order you called them. Any other command must still be called on its own."""
+
+NATIVE_TOOLS_TEMPLATE = """
+
+Each command is also available as a tool. Calling the tool is the same as writing the command's XML tags, and is preferred."""
 
 DEMONSTRATION_TEMPLATE = """Here is a demonstration of how to correctly accomplish another task.
 It is included to show you how to correctly use the interface.
@@ -0,0 +1,107 @@
+import os
+import signal
+import time
+
+import pytest
+
+from commands import BashCommand, BrowserError, BrowserManager
+
+FAKES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fakes")
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    monkeypatch.setenv("FAKE_BROWSER_DIR", str(tmp_path))
+    manager = BrowserManager(os.path.join(FAKES, "browse-start"), os.path.join(FAKES, "browse-observe"), 5.0)
+    yield manager
+    manager.close()
+
+
+def starts(tmp_path) -> int:
+    path = tmp_path / "starts"
+    return len(path.read_text().splitlines()) if path.exists() else 0
+
+
+def daemon_pid(tmp_path) -> int:
+    return int((tmp_path / "pid").read_text())
+
+
+def test_starts_lazily_and_once(manager, tmp_path):
+    assert not manager.is_running()
+    assert starts(tmp_path) == 0
+
+    manager.ensure_started()
+    manager.ensure_started()
+    assert manager.is_running()
+    assert starts(tmp_path) == 1
+
+
+def test_restarts_a_daemon_that_died(manager, tmp_path):
+    manager.ensure_started()
+    # The start command has exited 0, so only the probe shows that the daemon is gone.
+    manager.process.wait(timeout=5)
+    os.kill(daemon_pid(tmp_path), signal.SIGKILL)
+    time.sleep(0.1)
+    # Readiness is cached until a browse command fails.
+    assert manager.is_running()
+    manager.browse_failed()
+    assert not manager.is_running()
+
+    manager.ensure_started()
+    assert manager.is_running()
+    assert starts(tmp_path) == 2
+
+
+def test_probes_once_after_the_start_command_exits(manager, monkeypatch):
+    manager.ensure_started()
+    manager.process.wait(timeout=5)
+    probes = []
+    probe = manager._probe
+    monkeypatch.setattr(manager, "_probe", lambda deadline: probes.append(deadline) or probe(deadline))
+
+    for _ in range(3):
+        manager.ensure_started()
+    assert probes == []
+
+    manager.browse_failed()
+    for _ in range(3):
+        manager.ensure_started()
+    assert len(probes) == 1
+
+
+def test_failed_browse_command_restarts_a_dead_daemon(manager, tmp_path):
+    bash = BashCommand(5, spill_dir=str(tmp_path / "outputs"), browser=manager)
+    observe = os.path.join(FAKES, "browse-observe")
+    bash.run(observe)
+    manager.process.wait(timeout=5)
+    os.kill(daemon_pid(tmp_path), signal.SIGKILL)
+    time.sleep(0.1)
+
+    # The cached readiness lets the next command through, and its failure makes the one after restart the daemon.
+    bash.run(observe)
+    assert starts(tmp_path) == 1
+    assert not manager.ready
+    bash.run(observe)
+    assert starts(tmp_path) == 2
+    assert manager.ready
+
+
+def test_close_stops_the_daemon(manager, tmp_path):
+    manager.ensure_started()
+    manager.close()
+    time.sleep(0.1)
+    assert not manager.is_running()
+    assert not manager._probe(time.monotonic() + 1)
+
+
+def test_failed_start_raises():
+    manager = BrowserManager("sh -c 'exit 3'", "false", 1.0)
+    with pytest.raises(BrowserError, match="exited with code 3"):
+        manager.ensure_started()
+
+
+def test_probe_timeout_raises(tmp_path, monkeypatch):
+    monkeypatch.setenv("FAKE_BROWSER_DIR", str(tmp_path))
+    manager = BrowserManager("true", os.path.join(FAKES, "browse-observe"), 0.3)
+    with pytest.raises(BrowserError, match="not ready"):
+        manager.ensure_started()
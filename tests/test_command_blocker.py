@@ -0,0 +1,44 @@
+import pytest
+
+from commands.CommandBlocker import CommandBlocker
+
+
+@pytest.mark.parametrize(
+    "action",
+    [
+        "top -b -n1",
+        "top -bn1 | head",
+        "man ls | cat",
+        "man ls > ls.txt",
+        "git log | less | cat",
+        "echo $(man ls)",
+        "ssh host uptime",
+        "ssh -i key -p 22 host uptime",
+        "sudo -u bob ls",
+        "timeout -s KILL 5 ls",
+    ],
+)
+def test_allowed(action):
+    assert CommandBlocker.blocked_command(action) is None
+
+
+@pytest.mark.parametrize(
+    "action, blocked",
+    [
+        ("top", "top"),
+        ("man ls", "man"),
+        ("man ls 2> errors.txt", "man"),
+        ("git log | less", "less"),
+        ("vim notes.txt | cat", "vim"),
+        ("ssh host", "ssh"),
+        ("ssh -i key host", "ssh"),
+        ("ssh -p 22 host", "ssh"),
+        ("ssh -p22 -o StrictHostKeyChecking=no host", "ssh"),
+        ("sudo -u bob vim", "vim"),
+        ("sudo -ubob -E vim notes.txt", "vim"),
+        ("sudo --user bob python3", "python3"),
+        ("timeout -s KILL 5 vim", "vim"),
+    ],
+)
+def test_blocked(action, blocked):
+    assert CommandBlocker.blocked_command(action) == blocked
@@ -0,0 +1,49 @@
+import json
+from collections.abc import Iterator
+
+from Agent import Agent, AgentArguments
+from APIModel import APIModel, ModelArguments
+from commands import BashCommand
+
+
+class ScriptedModel(APIModel):
+    def __init__(self, responses: list[str]):
+        super().__init__(ModelArguments())
+        self.responses = responses
+
+    def get_client(self, args: ModelArguments):
+        return None
+
+    def query(self, history) -> str:
+        return self.responses.pop(0)
+
+    def stream(self, history) -> Iterator[str]:
+        raise NotImplementedError
+
+
+def make_agent(tmp_path, responses: list[str], message_cap: int) -> Agent:
+    model = ScriptedModel(responses)
+    agent_class = type("ScriptedAgent", (Agent,), {"_get_model": lambda self, args: model})
+    agent = agent_class(AgentArguments(ModelArguments(), message_cap=message_cap))
+    agent.add_commands([BashCommand(5, spill_dir=str(tmp_path / "outputs"))])
+    return agent
+
+
+def test_resumed_run_numbers_its_turns_on(tmp_path):
+    journal, metrics = str(tmp_path / "journal.jsonl"), str(tmp_path / "metrics.jsonl")
+    agent = make_agent(tmp_path, ["<bash>true</bash>"] * 2, message_cap=2)
+    agent.open_metrics(metrics)
+    agent.open_journal(journal)
+    agent.add_system_msg("system")
+    agent.add_user_msg("task")
+    agent.loop()
+    agent.close()
+
+    resumed = make_agent(tmp_path, ["<bash>true</bash>"], message_cap=3)
+    resumed.resume(journal)
+    resumed.open_metrics(metrics, resume=True)
+    resumed.loop()
+    resumed.close()
+
+    with open(metrics) as f:
+        assert [json.loads(line)["turn"] for line in f] == [1, 2, 3]
@@ -0,0 +1,171 @@
+import asyncio
+from collections.abc import Iterator
+from types import SimpleNamespace
+
+import pytest
+
+from Agent import Agent, AgentArguments, AsyncAgent
+from APIModel import APIModel, ModelArguments, ModelResponse, chat_completion_chunks, chat_completion_text
+from AsyncAPIModel import AsyncAPIModel
+from commands import BaseCommand, CommandDetector, CommandParser, ToolCall
+from History import Role
+from templates import NO_COMMANDS_CALLED
+
+
+class RecordingCommand(BaseCommand):
+    exclusive = False
+
+    def __init__(self, xml_tag: str = "bash"):
+        self.contents: list[str] = []
+        super().__init__(xml_tag=xml_tag, description="Records what it is called with.")
+
+    def _run(self, content: str) -> str:
+        self.contents.append(content)
+        return f"ran {content!r}"
+
+
+class ScriptedModel(APIModel):
+    def __init__(self, responses: list[str]):
+        super().__init__(ModelArguments())
+        self.responses = responses
+
+    def get_client(self, args: ModelArguments):
+        return None
+
+    def query(self, history) -> str:
+        return self.responses.pop(0)
+
+    def stream(self, history) -> Iterator[str]:
+        raise NotImplementedError
+
+
+class AsyncScriptedModel(AsyncAPIModel):
+    def __init__(self, responses: list[str]):
+        super().__init__(ModelArguments())
+        self.responses = responses
+
+    def get_client(self, args: ModelArguments):
+        return None
+
+    async def query(self, history) -> str:
+        return self.responses.pop(0)
+
+    def stream(self, history):
+        raise NotImplementedError
+
+
+def make_agent(
+    agent_class: type[Agent],
+    model: APIModel | AsyncAPIModel,
+    max_parallel_commands: int = 1,
+    journal: str | None = None,
+):
+    agent_class = type(agent_class.__name__, (agent_class,), {"_get_model": lambda self, args: model})
+    agent = agent_class(AgentArguments(ModelArguments(), message_cap=1, max_parallel_commands=max_parallel_commands))
+    command = RecordingCommand()
+    agent.add_commands([command])
+    if journal is not None:
+        agent.open_journal(journal)
+    agent.add_system_msg("system")
+    agent.add_user_msg("task")
+    return agent, command
+
+
+TOOLS = [RecordingCommand().tool_spec()]
+
+
+def openai_message(content: str | None, *arguments: str) -> SimpleNamespace:
+    calls = [SimpleNamespace(function=SimpleNamespace(name="bash", arguments=argument)) for argument in arguments]
+    return SimpleNamespace(content=content, tool_calls=calls)
+
+
+def test_closing_tag_in_argument_is_kept():
+    response = chat_completion_text(openai_message(None, '{"content": "grep \\"</bash>\\" f"}'), TOOLS)
+    agent, command = make_agent(Agent, ScriptedModel([response]))
+
+    agent.loop()
+
+    assert command.contents == ['grep "</bash>" f']
+
+
+def test_tags_inside_a_heredoc_argument_do_not_run():
+    heredoc = "cat > notes.md <<EOF\n<bash>rm -rf x</bash>\nEOF"
+    response = ModelResponse(ToolCall("bash", heredoc).render(), [ToolCall("bash", heredoc)])
+    agent, command = make_agent(Agent, ScriptedModel([response]))
+
+    agent.loop()
+
+    assert command.contents == [heredoc]
+
+
+@pytest.mark.parametrize("max_parallel_commands", [1, 3])
+def test_tags_in_prose_next_to_a_tool_call_are_ignored(max_parallel_commands):
+    response = chat_completion_text(openai_message("First <bash>ls</bash>, then:", '{"content": "pwd"}'), TOOLS)
+    agent, command = make_agent(Agent, ScriptedModel([response]), max_parallel_commands)
+
+    agent.loop()
+
+    assert command.contents == ["pwd"]
+    assert agent.history[-1]["content"] == "ran 'pwd'"
+
+
+def test_xml_is_parsed_without_tool_calls():
+    agent, command = make_agent(Agent, ScriptedModel(["Run <bash>ls</bash>"]))
+
+    agent.loop()
+
+    assert command.contents == ["ls"]
+
+
+def test_unknown_tool_is_not_a_call():
+    response = ModelResponse("<missing>x</missing>", [ToolCall("missing", "x")])
+    agent, command = make_agent(Agent, ScriptedModel([response]))
+
+    agent.loop()
+
+    assert command.contents == []
+    assert agent.history[-1]["content"] == NO_COMMANDS_CALLED
+
+
+def test_async_agent_runs_tool_calls_as_they_are():
+    response = chat_completion_text(openai_message("<bash>ls</bash>", '{"content": "echo </bash>"}'), TOOLS)
+    agent, command = make_agent(AsyncAgent, AsyncScriptedModel([response]))
+
+    asyncio.run(agent.loop())
+
+    assert command.contents == ["echo </bash>"]
+
+
+def test_streamed_tool_calls_are_not_parsed_from_the_text():
+    def chunk(content=None, arguments=None, name=None):
+        function = SimpleNamespace(name=name, arguments=arguments)
+        calls = None if arguments is None else [SimpleNamespace(index=0, function=function)]
+        delta = SimpleNamespace(content=content, tool_calls=calls)
+        return SimpleNamespace(choices=[SimpleNamespace(delta=delta, finish_reason=None)], usage=None)
+
+    class StreamingModel(ScriptedModel):
+        def stream(self, history) -> Iterator[str]:
+            chunks = [chunk("Checking."), chunk(arguments='{"content": "echo ', name="bash")]
+            chunks.append(chunk(arguments='</bash>"}'))
+            yield from chat_completion_chunks(iter(chunks), self.record_usage, TOOLS)
+
+    command = RecordingCommand()
+    response = StreamingModel([]).query_stream([], CommandDetector(CommandParser([command])))
+
+    assert response.tool_calls == (ToolCall("bash", "echo </bash>"),)
+    assert response == "Checking.\n<bash>echo </bash></bash>"
+
+
+def test_resume_runs_the_journaled_tool_calls(tmp_path):
+    journal = str(tmp_path / "journal.jsonl")
+    call = ToolCall("bash", "echo </bash>")
+    agent, _ = make_agent(Agent, ScriptedModel([]), journal=journal)
+    agent._add_response(ModelResponse("<bash>ls</bash>\n" + call.render(), [call]))
+    agent.close()
+
+    resumed, command = make_agent(Agent, ScriptedModel([]))
+    resumed.resume(journal)
+    resumed.loop()
+
+    assert command.contents == ["echo </bash>"]
+    assert resumed.history[-1]["role"] == Role.user
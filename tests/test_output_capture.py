@@ -0,0 +1,39 @@
+from commands.OutputCapture import OutputCapture
+
+
+def capture_lines(tmp_path, lines: list[str], max_bytes: int, max_lines: int) -> tuple[OutputCapture, str]:
+    capture = OutputCapture(max_bytes, max_lines, str(tmp_path / "spill.txt"))
+    # Written in uneven chunks, like a pipe delivers them.
+    data = "".join(f"{line}\n" for line in lines).encode()
+    for start in range(0, len(data), 777):
+        capture.write(data[start : start + 777])
+    return capture, capture.render()
+
+
+def test_short_output_is_kept_whole(tmp_path):
+    capture, output = capture_lines(tmp_path, ["a", "b"], 20000, 400)
+
+    assert not capture.truncated
+    assert output == "a\nb\n"
+
+
+def test_line_cap_first_keeps_head_and_tail(tmp_path):
+    lines = [str(number) for number in range(1, 1001)]
+    capture, output = capture_lines(tmp_path, lines, 20000, 400)
+
+    head, _, tail = output.partition("\n... [OUTPUT TRUNCATED")
+    assert head.split("\n") == lines[:200]
+    assert tail.split("\n", 1)[1].split("\n")[-201:] == lines[-200:] + [""]
+    assert "500\n" not in output
+    assert (tmp_path / "spill.txt").read_text().split("\n")[:-1] == lines
+
+
+def test_byte_cap_first_keeps_head_and_tail(tmp_path):
+    lines = [f"{number:049d}" for number in range(100)]
+    capture, output = capture_lines(tmp_path, lines, 1000, 10000)
+
+    head, _, tail = output.partition("\n... [OUTPUT TRUNCATED")
+    assert head.split("\n")[:10] == lines[:10]
+    assert tail.split("\n", 1)[1].split("\n")[-11:] == lines[-10:] + [""]
+    assert lines[50] not in output
+    assert (tmp_path / "spill.txt").read_text().split("\n")[:-1] == lines
@@ -0,0 +1,137 @@
+"""Retries, hedging and failover of get_model's stack against the fault-injecting mock server."""
+
+import json
+import time
+import urllib.error
+import urllib.request
+from collections.abc import Iterator
+
+import pytest
+
+import APIModel
+from APIModel import ModelArguments, ModelName, Usage, get_model
+from benchmarks.mock_server import Faults, MockLLMServer, cycle_script
+from History import History, Role
+
+PRIMARY = ModelName.gpt_4o_mini
+FALLBACK = ModelName.gpt_4o
+HISTORY = History.from_messages(
+    [{"role": Role.system, "content": "You are a test."}, {"role": Role.user, "content": "Say something."}]
+)
+
+
+class MockServerError(Exception):
+    """Carries the status code and headers where the provider SDKs' errors do."""
+
+    def __init__(self, error: urllib.error.HTTPError):
+        super().__init__(f"HTTP {error.code}")
+        self.status_code = error.code
+        self.response = error
+
+
+class MockServerModel(APIModel.APIModel):
+    """Queries the mock server's OpenAI endpoint with urllib, so that no provider SDK is needed."""
+
+    def get_client(self, args: ModelArguments) -> str:
+        return args.api_base_url
+
+    def query(self, history: History) -> str:
+        body = {"model": self.model.value, "messages": [dict(message) for message in history]}
+        request = urllib.request.Request(
+            f"{self.client}/chat/completions", json.dumps(body).encode(), {"Content-Type": "application/json"}
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.args.api_timeout) as response:
+                data = json.load(response)
+        except urllib.error.HTTPError as error:
+            error.read()
+            raise MockServerError(error) from None
+        self.record_usage(Usage(data["usage"]["prompt_tokens"], data["usage"]["completion_tokens"]), "stop")
+        return f"{self.model.value}: {data['choices'][0]['message']['content']}"
+
+    def stream(self, history: History) -> Iterator[str]:
+        raise NotImplementedError
+
+
+@pytest.fixture(autouse=True)
+def mock_models(monkeypatch):
+    for name in (PRIMARY, FALLBACK):
+        monkeypatch.setitem(APIModel.model_registry, name, MockServerModel)
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def serve(faults: Faults, latency: float = 0.01) -> MockLLMServer:
+        servers.append(MockLLMServer(cycle_script(["<bash>true</bash>"]), latency, faults=faults).start())
+        return servers[-1]
+
+    yield serve
+    for server in servers:
+        server.stop()
+
+
+def model_for(server: MockLLMServer, **settings) -> APIModel.APIModel:
+    args = ModelArguments(
+        model=PRIMARY, api_base_url=server.openai_url, api_retry_base_delay=0.01, api_timeout=10, **settings
+    )
+    return get_model(args)
+
+
+@pytest.mark.parametrize("status", [429, 500, 503])
+def test_retryable_errors_are_retried(serve, status):
+    server = serve(Faults(fail_first=2, fail_status=status))
+    model = model_for(server, api_max_retries=3)
+
+    assert model.query(HISTORY) == f"{PRIMARY.value}: <bash>true</bash>"
+    assert server.requests == 3
+
+
+def test_retry_after_is_honoured(serve):
+    server = serve(Faults(fail_first=1, fail_status=429, retry_after=0.5))
+    model = model_for(server, api_max_retries=1)
+
+    start = time.perf_counter()
+    model.query(HISTORY)
+
+    assert time.perf_counter() - start >= 0.5
+    assert server.requests == 2
+
+
+def test_client_errors_are_raised_at_once(serve):
+    server = serve(Faults(fail_first=1, fail_status=400))
+    model = model_for(server, api_max_retries=3)
+
+    with pytest.raises(MockServerError) as error:
+        model.query(HISTORY)
+
+    assert error.value.status_code == 400
+    assert server.requests == 1
+
+
+def test_hedged_duplicate_wins_over_a_stalled_request(serve):
+    # Ten queries fill the latency window, then the eleventh stalls and is hedged at the median.
+    server = serve(Faults(slow_requests=(11,), slow_latency=5.0))
+    model = model_for(server, api_hedge_percentile=0.5)
+    for _ in range(10):
+        model.query(HISTORY)
+
+    start = time.perf_counter()
+    response = model.query(HISTORY)
+    elapsed = time.perf_counter() - start
+    model.close()
+
+    assert response == f"{PRIMARY.value}: <bash>true</bash>"
+    assert elapsed < 2.0
+    assert server.requests == 12
+
+
+def test_failover_switches_to_the_backup_model(serve):
+    server = serve(Faults(fail_models=(PRIMARY.value,)))
+    model = model_for(server, api_max_retries=1, api_fallback_model=FALLBACK)
+
+    assert model.query(HISTORY) == f"{FALLBACK.value}: <bash>true</bash>"
+    # Both attempts at the primary, then one at the fallback.
+    assert server.requests == 3
+    assert set(model.usage_by_model) == {FALLBACK}